@@ -6,10 +6,11 @@ from pathlib import Path
 import matplotlib.gridspec as gridspec
 from matplotlib.patches import FancyBboxPatch
 import math
-import SimpleITK as sitk
 import csv
 from tqdm import tqdm
 import argparse
+from case_index import load_case_index, load_case_meta
+from mhd_io import read_mhd_header
 
 parser = argparse.ArgumentParser(description='PyTorch DataBowl3 Detector')
 parser.add_argument('--model', '-m', metavar='MODEL', default='base',
@@ -18,6 +19,8 @@ parser.add_argument('--cross', default=None, type=str, metavar='N',
                     help='which data cross be used')
 parser.add_argument('--epoch', default=None, type=str, metavar='N',
                     help='which data cross be used')
+parser.add_argument('--level', default=0, type=int, metavar='N',
+                    help='pyramid level of id_clean the bboxes were predicted on')
 
 args = parser.parse_args()
 
@@ -70,30 +73,12 @@ def iou(box0, box1):
     union = box0[3] * box0[3] * box0[3] + box1[3] * box1[3] * box1[3] - intersection
     return intersection / union
 
-def load_itk_image(filename):
-    with open(filename) as f:
-        contents = f.readlines()
-        line = [k for k in contents if k.startswith('TransformMatrix')][0]
-        transformM = np.array(line.split(' = ')[1].split(' ')).astype('float')
-        transformM = np.round(transformM)
-        if np.any( transformM!=np.array([1,0,0, 0, 1, 0, 0, 0, 1])):
-            isflip = True
-        else:
-            isflip = False
-
-    itkimage = sitk.ReadImage(filename)
-    numpyImage = sitk.GetArrayFromImage(itkimage)
-     
-    numpyOrigin = np.array(list(reversed(itkimage.GetOrigin())))
-    numpySpacing = np.array(list(reversed(itkimage.GetSpacing())))
-     
-    return numpyImage, numpyOrigin, numpySpacing, isflip
-
 def main(bbox_path, preprocess_path, lunaseg_path, save_file):
     total_list = []
     epochs = args.epoch
     epochs = epochs.split('.') 
     count = 0
+    case_index = load_case_index(preprocess_path)   # one index for every fold
     for i in range(1):
         total_list.append([])        
         # with Path('test_0222_%s/LUNA_test.json' %str(i+1)).open('rt', encoding='utf-8') as fp:
@@ -102,25 +87,28 @@ def main(bbox_path, preprocess_path, lunaseg_path, save_file):
         for x in tqdm(range(len(idcs))):            
             # pbb = np.load('%s%s/bbox_%s/%s_pbb.npy' %(bbox_path, str(i+1), epochs[i], idcs[x]), mmap_mode='r')            
             pbb = np.load('%s/bbox_%s/%s_pbb.npy' %(bbox_path, epochs[i], idcs[x]), mmap_mode='r')            
-            lbb = np.load("%s%s_label.npy" % (preprocess_path, idcs[x]), allow_pickle=True)            
+            meta = load_case_meta(preprocess_path, idcs[x], case_index, args.level)
+            lbb = meta['label']
 
             pbb = nms(pbb, 0.1)            
 
-            Mask,origin,spacing,isflip = load_itk_image('%s%s.mhd' %(lunaseg_path, idcs[x]))
+            if 'isflip' in meta:
+                isflip = meta['isflip']
+            else:
+                isflip = read_mhd_header('%s%s.mhd' %(lunaseg_path, idcs[x]))['isflip']
             
-            origin = np.load('%s%s_origin.npy' %(preprocess_path, idcs[x]), mmap_mode='r')
-            spacing = np.load('%s%s_spacing.npy' %(preprocess_path, idcs[x]), mmap_mode='r')
-            resolution = np.array([1, 1, 1])
-            extendbox = np.load('%s%s_extendbox.npy' %(preprocess_path, idcs[x]), mmap_mode='r')
+            origin = meta['origin']
+            spacing = meta['spacing']
+            resolution = meta['resolution']   # of id_clean at this level
+            extendbox = meta['extendbox']
                         
             pbb = np.array(pbb[:, :-1])            
             pbb[:, 1:] = np.array(pbb[:, 1:] + np.expand_dims(extendbox[:,0], 1).T)
             pbb[:, 1:] = np.array(pbb[:, 1:] * np.expand_dims(resolution, 1).T / np.expand_dims(spacing, 1).T)
 
             if isflip:
-                Mask = np.load('%s%s_mask.npy' %(preprocess_path, idcs[x]), mmap_mode='r')
-                pbb[:, 2] = pbb[:, 2] - Mask.shape[1]
-                pbb[:, 3] = pbb[:, 3] - Mask.shape[2] 
+                pbb[:, 2] = pbb[:, 2] - meta['mask_shape'][1]
+                pbb[:, 3] = pbb[:, 3] - meta['mask_shape'][2] 
                 
             pos = VoxelToWorldCoord(pbb[:, 1:], origin, spacing)            
 
@@ -0,0 +1,291 @@
+#!/usr/bin/python3
+#coding=utf-8
+
+"""
+Micro-benchmarks of the preprocessing / data loading building blocks.
+
+    python benchmark.py resample [--shape 300 512 512] [--spacing 1.25 0.7 0.7] [--mhd CT.mhd]
+    python benchmark.py codec [--data-dir PREPROCESS_DIR --cases 5] [--codecs zlib zstd] [--disk-mbps 150]
+    python benchmark.py loader --data-dir PREPROCESS_DIR [--split LUNA_train.json] [--runs 1 4 16] [--volume-cache 2]
+    python benchmark.py loader --data-dir PREPROCESS_DIR --crops-per-load 4
+"""
+
+import os
+import sys
+import time
+import shutil
+import tempfile
+import argparse
+import resource
+import concurrent.futures
+import numpy as np
+
+
+def _make_volume(args):
+    if args.mhd:
+        from prepare import load_itk_image, fuse_intensity
+        img, _, spacing, _ = load_itk_image(args.mhd)
+        full = np.ones(img.shape, bool)
+        return fuse_intensity(img, full, full), spacing
+    rng = np.random.RandomState(0)
+    # smooth-ish uint8 volume, so interpolation differences are meaningful
+    small = rng.randint(0, 256, [max(s // 8, 2) for s in args.shape]).astype(np.float32)
+    from scipy.ndimage import zoom
+    img = zoom(small, np.array(args.shape) / np.array(small.shape), order=1).astype(np.uint8)
+    return img, np.array(args.spacing)
+
+
+def _max_rss_mb():
+    # ru_maxrss is in KB on Linux, in bytes on macOS
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss / 1024. ** (2 if sys.platform == 'darwin' else 1)
+
+
+def _run_resample(infile, spacing, args, backend, order, outfile):
+    from prepare import resample
+    if backend == 'torch':
+        import torch
+    img = np.load(infile)
+    rss0 = _max_rss_mb()
+    t = time.time()
+    out, true_spacing = resample(img, spacing, np.array([1, 1, 1]), order=order, backend=backend,
+                                 slab=args.slab, workers=args.workers)
+    elapsed = time.time() - t
+    np.save(outfile, out)
+    return elapsed, _max_rss_mb() - rss0, img.shape, out.shape, true_spacing
+
+
+def bench_resample(args):
+    tmpdir = tempfile.mkdtemp()
+    infile = os.path.join(tmpdir, 'input.npy')
+    img, spacing = _make_volume(args)
+    np.save(infile, img)
+    del img
+    print('backend      order  time(s)  peak extra RSS(MB)  max|diff|  voxels differing')
+    for order in args.orders:
+        ref = None
+        for backend in ['scipy', 'scipy_slab', 'torch']:
+            if backend == 'torch' and order != 1:
+                continue
+            outfile = os.path.join(tmpdir, '{}_{}.npy'.format(backend, order))
+            # One fresh process per run, so that the peak RSS belongs to this backend only
+            with concurrent.futures.ProcessPoolExecutor(max_workers=1) as executor:
+                elapsed, rss, in_shape, out_shape, _ = executor.submit(_run_resample, infile, spacing, args, backend, order, outfile).result()
+            out = np.load(outfile, mmap_mode='r')
+            if ref is None:
+                ref = out
+            diff = np.abs(out.astype(np.int16) - ref.astype(np.int16))
+            print('{:12s} {:5d} {:8.2f} {:19.0f} {:10d} {:17.2e}'.format(
+                backend, order, elapsed, rss, int(diff.max()), float(np.mean(diff > 0))))
+    shutil.rmtree(tmpdir)
+    print('input {} -> output {}, {} workers, slab {}'.format(in_shape, out_shape, args.workers, args.slab))
+
+
+def _lung_like_volume(shape, pad_value=170):
+    # pad_value outside an ellipsoid "lung", smoothed noise inside, like a preprocessed id_clean
+    rng = np.random.RandomState(0)
+    from scipy.ndimage import zoom
+    small = rng.randint(0, 256, [max(s // 4, 2) for s in shape]).astype(np.float32)
+    img = zoom(small, np.array(shape) / np.array(small.shape), order=1).astype(np.uint8)
+    grid = np.ogrid[tuple(slice(0, s) for s in shape)]
+    inside = sum(((g - s / 2.) / (s * 0.4)) ** 2 for g, s in zip(grid, shape)) < 1
+    img[~inside] = pad_value
+    return img[np.newaxis], inside
+
+
+def _bench_volumes(args):
+    if args.data_dir is None:
+        img, mask = _lung_like_volume(args.shape)
+        yield 'synthetic', img, mask
+        return
+    from volume_store import load_volume
+    names = sorted(f[:-len('_clean.npy')] for f in os.listdir(args.data_dir) if f.endswith('_clean.npy'))
+    names += sorted(f[:-len('_clean.vol')] for f in os.listdir(args.data_dir) if f.endswith('_clean.vol'))
+    for name in names[:args.cases]:
+        img = np.asarray(load_volume(os.path.join(args.data_dir, name + '_clean.npy')))
+        mask = np.asarray(load_volume(os.path.join(args.data_dir, name + '_mask.npy')))
+        yield name, img, mask
+
+
+def _timeit(fn, repeat):
+    best = float('inf')
+    for _ in range(repeat):
+        t = time.time()
+        fn()
+        best = min(best, time.time() - t)
+    return best
+
+
+def bench_codec(args):
+    from volume_store import save_chunked, ChunkedVolume, available_codecs
+    codecs = [c for c in args.codecs if c in available_codecs()]
+    missing = sorted(set(args.codecs) - set(codecs))
+    if missing:
+        print('skipping {} (module not installed)'.format(', '.join(missing)))
+    tmpdir = tempfile.mkdtemp()
+    rng = np.random.RandomState(0)
+    # Decode times are measured with the files in the page cache: this is the CPU cost of a format.
+    # Effective bandwidth = raw MB delivered per second when the disk delivers --disk-mbps of file bytes.
+    print('volume      format   kind   ratio  write MB/s  decode MB/s  crop/s  effective MB/s @ {:.0f} MB/s disk'.format(args.disk_mbps))
+    totals = {}
+    for name, img, mask in _bench_volumes(args):
+        crop = np.minimum(args.crop, img.shape[1:])
+        starts = [[rng.randint(0, s - c + 1) for s, c in zip(img.shape[1:], crop)] for _ in range(args.crops)]
+        for kind, array, fill_value in [('clean', img, int(np.median(img[:, 0, 0]))), ('mask', mask, False)]:
+            npy = os.path.join(tmpdir, '{}.npy'.format(kind))
+            raw_mb = array.nbytes / 1024. ** 2
+            rows = [('npy', lambda: np.save(npy, array), npy, lambda: np.load(npy),
+                     lambda z, y, x: np.array(np.load(npy, mmap_mode='r')[..., z:z+crop[0], y:y+crop[1], x:x+crop[2]]))]
+            for codec in codecs:
+                vol = os.path.join(tmpdir, '{}_{}.vol'.format(kind, codec))
+                rows.append((codec, lambda vol=vol, codec=codec: save_chunked(vol, array, fill_value=fill_value, codec=codec, clevel=args.level),
+                             vol, lambda vol=vol: np.asarray(ChunkedVolume(vol)),
+                             lambda z, y, x, vol=vol: ChunkedVolume(vol)[..., z:z+crop[0], y:y+crop[1], x:x+crop[2]]
+                             if array.ndim == 4 else ChunkedVolume(vol)[z:z+crop[0], y:y+crop[1], x:x+crop[2]]))
+            for fmt, write, path, decode, read_crop in rows:
+                t_write = _timeit(write, 1)
+                ratio = array.nbytes / float(os.path.getsize(path))
+                decode_mbps = raw_mb / _timeit(decode, args.repeat)
+                t_crops = _timeit(lambda: [read_crop(*s) for s in starts], args.repeat)
+                effective = min(decode_mbps, ratio * args.disk_mbps)
+                print('{:11s} {:8s} {:5s} {:6.1f} {:11.0f} {:12.0f} {:7.0f} {:14.0f}'.format(
+                    name[:11], fmt, kind, ratio, raw_mb / t_write, decode_mbps, len(starts) / t_crops, effective))
+                total = totals.setdefault((fmt, kind), [0, 0])
+                total[0] += array.nbytes
+                total[1] += os.path.getsize(path)
+    print('overall compression ratio: ' + ', '.join('{} {} {:.1f}'.format(fmt, kind, raw / float(disk))
+                                                  for (fmt, kind), (raw, disk) in sorted(totals.items())))
+    shutil.rmtree(tmpdir)
+
+
+class _CountingVolume(object):
+    """ A stored volume counting the voxels read from it into `count` (multiprocessing.Value) """
+    def __init__(self, volume, count):
+        self.volume = volume
+        self.count = count
+        self.shape, self.dtype, self.nbytes = volume.shape, volume.dtype, volume.nbytes
+
+    @property
+    def ndim(self):
+        return len(self.shape)
+
+    def __len__(self):
+        return len(self.volume)
+
+    def _counted(self, data):
+        with self.count.get_lock():
+            self.count.value += int(np.prod(data.shape))
+        return data
+
+    def __getitem__(self, key):
+        if isinstance(key, slice):   # channels, read when the result is sliced
+            return _CountingVolume(self.volume[key], self.count)
+        return self._counted(self.volume[key])
+
+    def __array__(self, dtype=None, copy=None):
+        data = self._counted(np.asarray(self.volume))
+        return data if dtype is None else data.astype(dtype)
+
+
+def bench_loader(args):
+    import json
+    import multiprocessing
+    from importlib import import_module
+    from torch.utils.data import DataLoader
+    from data_detector import DataBowl3Detector, resolution_config
+    from epoch_plan import EpochPlanSampler, EpochPlanBatchSampler
+    from volume_cache import VolumeCache
+
+    class CountingDetector(DataBowl3Detector):
+        read = multiprocessing.Value('q', 0)
+
+        def open_volume(self, filename):
+            return _CountingVolume(DataBowl3Detector.open_volume(self, filename), self.read)
+
+    class OneByOneDetector(CountingDetector):
+        __getitems__ = None   # the DataLoader gets the samples of a batch one by one, each crop reads the volume
+
+    config = resolution_config(import_module('net.{}'.format(args.model)).config, args.resolution, args.level)
+    if args.split:
+        with open(args.split, 'rt', encoding='utf-8') as f:
+            names = json.load(f)
+    else:
+        names = sorted({f[:-len('_clean.npy')] for f in os.listdir(args.data_dir) if f.endswith('_clean.npy')} |
+                       {f[:-len('_clean.vol')] for f in os.listdir(args.data_dir) if f.endswith('_clean.vol')})
+    volume_cache = args.volume_cache if args.volume_cache is not None else 0. if args.crops_per_load else 1.
+    # the same epoch (seed) is replayed for every run length, only the order of the samples changes; with
+    # --crops-per-load K, runs of K crops one by one are compared with batches of whole runs (__getitems__)
+    if args.crops_per_load:
+        modes = [(args.crops_per_load, False), (args.crops_per_load, True)]
+    else:
+        modes = [(run, False) for run in args.runs]
+    print('run  crops per load  samples  samples/s  volume switches  voxels read/sample  cache hit rate')
+    for run, grouped in modes:
+        cache = VolumeCache(volume_cache * 1024 ** 3) if volume_cache > 0 else None
+        detector = CountingDetector if grouped or not args.crops_per_load else OneByOneDetector
+        dataset = detector(args.data_dir, names, config, phase='train', level=args.level, cache=cache)
+        if grouped:
+            batches = EpochPlanBatchSampler(dataset, args.batch_size, args.seed, run).batches()
+            batches = batches[:-(-args.samples // args.batch_size)]
+            plan = np.concatenate(batches)
+            loader = DataLoader(dataset, batch_sampler=batches, num_workers=args.workers)
+        else:
+            plan = EpochPlanSampler(dataset, args.seed, run).plan()[:args.samples]
+            loader = DataLoader(dataset, batch_size=args.batch_size, sampler=plan, num_workers=args.workers)
+        dataset.read.value = 0
+        t = time.time()
+        for _ in loader:
+            pass
+        elapsed = time.time() - t
+        switches = np.count_nonzero(np.diff(plan['case'])) + 1
+        print('{:3d} {:15d} {:8d} {:10.1f} {:16d} {:18.2f}M {:>15}'.format(
+            run, run if grouped else 1, len(plan), len(plan) / elapsed, switches, dataset.read.value / 1e6 / len(plan),
+            '{:.1%}'.format(cache.stats()['hit_rate']) if cache is not None else '-'))
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Preprocessing / data loading benchmarks')
+    subparsers = parser.add_subparsers(dest='command')
+
+    p = subparsers.add_parser('resample', help='compare the backends of prepare.resample')
+    p.add_argument('--shape', default=[300, 512, 512], type=int, nargs=3, help='synthetic volume shape (z y x)')
+    p.add_argument('--spacing', default=[1.25, 0.7, 0.7], type=float, nargs=3, help='synthetic volume spacing (mm)')
+    p.add_argument('--mhd', default=None, type=str, help='use this CT instead of a synthetic volume')
+    p.add_argument('--orders', default=[1, 2], type=int, nargs='+', help='interpolation orders to run')
+    p.add_argument('--slab', default=32, type=int, help='slab size of the slab backends')
+    p.add_argument('--workers', default=4, type=int, help='threads of the slab backends')
+    p.set_defaults(func=bench_resample)
+
+    p = subparsers.add_parser('codec', help='compression ratio / decode speed of the volume codecs against np.load')
+    p.add_argument('--data-dir', default=None, type=str, help='preprocess_result_path to take id_clean / id_mask from')
+    p.add_argument('--cases', default=5, type=int, help='number of cases of --data-dir to use')
+    p.add_argument('--shape', default=[300, 250, 300], type=int, nargs=3, help='synthetic volume shape (z y x)')
+    p.add_argument('--codecs', default=['raw', 'zlib', 'zstd', 'blosc'], nargs='+', choices=['raw', 'zlib', 'zstd', 'blosc'], help='volume_store codecs to compare')
+    p.add_argument('--level', default=None, type=int, help='compression level (codec default if not given)')
+    p.add_argument('--crop', default=[96, 96, 96], type=int, nargs=3, help='size of the random crops read')
+    p.add_argument('--crops', default=20, type=int, help='number of random crops read per volume')
+    p.add_argument('--repeat', default=3, type=int, help='best of this many runs')
+    p.add_argument('--disk-mbps', default=150., type=float, help='disk / network bandwidth for the effective MB/s column')
+    p.set_defaults(func=bench_codec)
+
+    p = subparsers.add_parser('loader', help='train DataLoader throughput on one epoch plan, by run length')
+    p.add_argument('--data-dir', required=True, type=str, help='preprocess_result_path')
+    p.add_argument('--split', default=None, type=str, help='json list of the cases (all cases of --data-dir if not given)')
+    p.add_argument('--model', default='OSAF_YOLOv3', type=str, help='model of net/ whose config is used')
+    p.add_argument('--resolution', default=1., type=float, help='voxel spacing (mm) of id_clean')
+    p.add_argument('--level', default=0, type=int, help='pyramid level of id_clean')
+    p.add_argument('--seed', default=0, type=int, help='seed of the epoch plan')
+    p.add_argument('--runs', default=[1, 4, 16], type=int, nargs='+', help='run lengths (crops of a volume in a row) to compare')
+    p.add_argument('--samples', default=200, type=int, help='number of samples of the epoch to load')
+    p.add_argument('--batch-size', default=4, type=int, help='batch size')
+    p.add_argument('--workers', default=0, type=int, help='DataLoader workers')
+    p.add_argument('--volume-cache', default=None, type=float,
+                   help='GB of VolumeCache per worker, 0 for none (default 1, 0 with --crops-per-load)')
+    p.add_argument('--crops-per-load', default=None, type=int, metavar='K',
+                   help='compare runs of K crops read one by one with batches of whole runs (instead of --runs)')
+    p.set_defaults(func=bench_loader)
+
+    args = parser.parse_args()
+    if args.command is None:
+        parser.print_help()
+    else:
+        args.func(args)
@@ -0,0 +1,174 @@
+#!/usr/bin/python3
+#coding=utf-8
+
+"""
+One metadata / label index per preprocessing run, instead of id_spacing.npy, id_origin.npy,
+id_extendbox.npy and id_label.npy for every series.
+
+preprocess_result_path/case_index.npz holds, row i describing seriesuid[i]:
+    seriesuid    (N,)      str
+    spacing      (N, 3)    original voxel spacing (z, y, x) in mm
+    origin       (N, 3)    world origin (z, y, x) in mm
+    resolution   (N, 3)    voxel spacing (z, y, x) of id_clean in mm (prepare.py config 'resolution')
+    extendbox    (N, 3, 2) lung box cut out of the resampled volume
+    shape        (N, 3)    shape of id_clean (without the channel axis)
+    mask_shape   (N, 3)    shape of the original CT / lung mask
+    isflip       (N,)      the CT had a flipped TransformMatrix
+    label_start  (N + 1,)  rows label_start[i]:label_start[i+1] of `labels` belong to case i
+    labels       (M, 4)    (z, y, x, d) in id_clean voxels, [[0, 0, 0, 0]] when a case has no nodule
+
+Pyramid level l of id_clean (see prepare.resample_case) has voxels 2**l times larger, centred on every 2**l-th
+voxel of level 0: its labels and extendbox are the level 0 ones divided by 2**l and its resolution is multiplied by
+2**l (load_label / load_case_meta level).
+
+Usage:
+    python case_index.py build PREPROCESS_DIR LUNA_SEGMENT_DIR   # index the per-case .npy files of an older run
+"""
+
+import os
+import sys
+import numpy as np
+
+INDEX_FILENAME = 'case_index.npz'
+_FIELDS = ('spacing', 'origin', 'resolution', 'extendbox', 'shape', 'mask_shape', 'isflip')
+DEFAULT_RESOLUTION = (1., 1., 1.)   # runs from before the target spacing was configurable
+
+
+class CaseIndex(object):
+    def __init__(self, cases=None):
+        # cases: {seriesuid: {'spacing', 'origin', 'resolution', 'extendbox', 'shape', 'mask_shape', 'isflip', 'label'}}
+        self.cases = dict(cases or {})
+
+    def __contains__(self, name):
+        return name in self.cases
+
+    def __len__(self):
+        return len(self.cases)
+
+    def names(self):
+        return sorted(self.cases)
+
+    def get(self, name):
+        return self.cases[name]
+
+    def label(self, name):
+        return self.cases[name]['label']
+
+    def update(self, name, meta):
+        meta = dict(meta)
+        meta.setdefault('resolution', DEFAULT_RESOLUTION)
+        for key in _FIELDS:
+            meta[key] = np.asarray(meta[key])
+        meta['label'] = np.asarray(meta['label'], np.float64).reshape((-1, 4))
+        self.cases[name] = meta
+
+    @classmethod
+    def load(cls, filename):
+        index = cls()
+        with np.load(filename) as data:
+            arrays = {k: data[k] for k in data.files}
+        start = arrays['label_start']
+        if 'resolution' not in arrays:
+            arrays['resolution'] = np.tile(DEFAULT_RESOLUTION, (len(arrays['seriesuid']), 1))
+        for i, name in enumerate(arrays['seriesuid']):
+            meta = {key: arrays[key][i] for key in _FIELDS}
+            meta['isflip'] = bool(meta['isflip'])
+            meta['label'] = arrays['labels'][start[i]:start[i + 1]]
+            index.cases[str(name)] = meta
+        return index
+
+    def save(self, filename):
+        from preprocess_manifest import atomic_write
+        names = self.names()
+        arrays = {'seriesuid': np.array(names, dtype=str)}
+        for key in _FIELDS:
+            arrays[key] = np.array([self.cases[n][key] for n in names])
+        labels = [self.cases[n]['label'] for n in names]
+        arrays['label_start'] = np.cumsum([0] + [len(l) for l in labels])
+        arrays['labels'] = np.concatenate(labels, axis=0) if labels else np.zeros((0, 4))
+
+        def write(tmp):
+            with open(tmp, 'wb') as f:
+                np.savez(f, **arrays)
+        atomic_write(filename, write)
+
+
+def index_path(data_dir):
+    return os.path.join(data_dir, INDEX_FILENAME)
+
+
+def load_case_index(data_dir):
+    """ The CaseIndex of a preprocessing run, None for runs that only have per-case files. """
+    path = index_path(data_dir)
+    if os.path.exists(path):
+        return CaseIndex.load(path)
+    return None
+
+
+def load_label(data_dir, name, index=None, level=0):
+    """ (z, y, x, d) rows of a case, from the index when there is one, else from id_label.npy """
+    if index is not None and name in index:
+        label = index.label(name)
+    else:
+        label = np.load(os.path.join(data_dir, '{}_label.npy'.format(name)), allow_pickle=True)
+    return _scale_label(label, level) if level else label
+
+
+def _scale_label(label, level):
+    # (z, y, x, d) scale, extra columns (e.g. malignancy) do not
+    label = np.array(label, np.float64).reshape((len(label), -1))
+    label[:, :4] /= 2. ** level
+    return label
+
+
+def level_meta(meta, level):
+    """ meta with label, extendbox and shape in the voxels of pyramid level `level` """
+    if not level:
+        return meta
+    meta = dict(meta)
+    meta['label'] = _scale_label(meta['label'], level)
+    meta['extendbox'] = np.asarray(meta['extendbox']) / 2. ** level
+    meta['resolution'] = np.asarray(meta.get('resolution', DEFAULT_RESOLUTION)) * 2. ** level
+    if 'shape' in meta:
+        shape = np.asarray(meta['shape'])
+        for _ in range(level):
+            shape = (shape + 1) // 2
+        meta['shape'] = shape
+    return meta
+
+
+def load_case_meta(data_dir, name, index=None, level=0):
+    """ spacing / origin / resolution / extendbox / isflip / mask_shape of a case, from the index or from the per-case files.
+    Per-case files do not record the resolution, they are taken as DEFAULT_RESOLUTION. """
+    if index is not None and name in index:
+        return level_meta(index.get(name), level)
+    from volume_store import load_volume
+    load = lambda suffix: np.load(os.path.join(data_dir, '{}_{}.npy'.format(name, suffix)), mmap_mode='r')
+    meta = {'spacing': np.array(load('spacing')), 'origin': np.array(load('origin')),
+            'resolution': np.array(DEFAULT_RESOLUTION),
+            'extendbox': np.array(load('extendbox')), 'mask_shape': np.array(load_volume(os.path.join(data_dir, name + '_mask.npy')).shape),
+            'label': load_label(data_dir, name)}
+    return level_meta(meta, level)
+
+
+def build_from_case_files(data_dir, luna_segment):
+    """ Index the per-case files written by older versions of prepare.py (the flip flag comes from the mhd) """
+    from volume_store import load_volume
+    from mhd_io import read_mhd_header
+    index = CaseIndex()
+    names = sorted(f[:-len('_label.npy')] for f in os.listdir(data_dir) if f.endswith('_label.npy'))
+    for name in names:
+        meta = load_case_meta(data_dir, name)
+        meta['isflip'] = read_mhd_header(os.path.join(luna_segment, name + '.mhd'))['isflip']
+        meta['shape'] = np.array(load_volume(os.path.join(data_dir, name + '_clean.npy')).shape[1:])
+        index.update(name, meta)
+    return index
+
+
+if __name__ == '__main__':
+    if len(sys.argv) != 4 or sys.argv[1] != 'build':
+        print(__doc__)
+        sys.exit(1)
+    index = build_from_case_files(sys.argv[2], sys.argv[3])
+    index.save(index_path(sys.argv[2]))
+    print('{} cases indexed in {}'.format(len(index), index_path(sys.argv[2])))
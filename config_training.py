@@ -3,6 +3,10 @@ config = {'luna_root':'/home/liuxinglong/data/LUNA/',
           'luna_data':'/home/liuxinglong/data/LUNA/allset/',
           'luna_label':'/home/liuxinglong/data/LUNA/annotations.csv',                    
           'preprocess_result_path':'/home/liuxinglong/data2/LUNA_preprocess/',                    
+          'volume_format':'npy',  # 'npy' or 'chunked' (32^3 blocks, crops read only the blocks they need)
+          'volume_codec':'raw',   # 'raw', 'zlib', 'zstd' or 'blosc': compressed chunked id_clean / id_mask
+          'pyramid_levels':0,     # coarser levels (2 mm, 4 mm, ...) stored with each id_clean (chunked)
+          'resolution':[1,1,1],   # target spacing (z y x, mm) of id_clean, e.g. [2,2,2] for fast screening
          }
 
 config_cluster = {'luna_root':'/home/liuxinglong/data/LUNA/',
@@ -10,4 +14,6 @@ config_cluster = {'luna_root':'/home/liuxinglong/data/LUNA/',
           'luna_data':'/home/liuxinglong/data/LUNA/allset/',
           'luna_label':'/home/liuxinglong/data/LUNA/annotations.csv',                    
           'preprocess_result_path':'/mnt/lustre/liuxinglong/data/LUNA_preprocess/',                    
+          'volume_format':'chunked',
+          'volume_codec':'zlib',
          }
\ No newline at end of file
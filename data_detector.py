@@ -6,28 +6,110 @@ from torch.utils.data import Dataset
 import os
 import time
 import collections
-import random
-import warnings
-from scipy.ndimage import zoom
-from scipy.ndimage.interpolation import rotate
+from scipy.ndimage import affine_transform
 import json
 from pathlib import Path
+from volume_store import load_volume, VolumeRegion
+from shard_store import ShardIndex
+from case_index import load_case_index, load_label
 
 
+def resolution_config(config, reso, level=0):
+    """ Copy of a model config for id_clean resampled to `reso` mm and read at pyramid `level`.
+
+    anchors and bound_size keep their size in mm and crop_size its field of view (rounded up to a multiple of
+    max_stride); sizelim* and radius_lim stay in mm, the datasets divide them by config['reso'] and 2**level.
+    """
+    config = dict(config)
+    scale = float(config['reso']) * 2 ** config.get('level', 0) / (float(reso) * 2 ** level)
+    max_stride = config['max_stride']
+    config['anchors'] = [a * scale for a in config['anchors']]
+    config['bound_size'] = int(round(config['bound_size'] * scale))
+    config['crop_size'] = [max(int(np.ceil(c * scale / max_stride)), 1) * max_stride for c in config['crop_size']]
+    config['reso'] = reso
+    config['level'] = level
+    return config
+
+
+def check_resolution(case_index, names, reso):
+    """ ValueError when a case of the index was not resampled to `reso` mm """
+    if case_index is None:
+        return
+    for name in names:
+        if name in case_index and not np.allclose(case_index.get(name)['resolution'], reso):
+            raise ValueError('{} was preprocessed at {} mm, the model config expects {} mm (see resolution_config)'.format(
+                name, case_index.get(name)['resolution'].tolist(), reso))
+
+
+
+def plan_params(row):
+    """ Crop.draw parameters of an epoch_plan row """
+    return row['start'], row['scale'], row['angle'], row['axisorder'], row['flip']
+
+
+def merge_boxes(boxes):
+    """ Groups (lo, hi, members) of the boxes (lo, hi) whose bounding box is not larger than they are together """
+    groups = []
+    for i, (lo, hi) in enumerate(boxes):
+        size = np.prod(np.maximum(hi - lo, 0))
+        for group in groups:
+            newlo, newhi = np.minimum(group[0], lo), np.maximum(group[1], hi)
+            if np.prod(newhi - newlo) <= group[3] + size:
+                group[:2] = newlo, newhi
+                group[2].append(i)
+                group[3] += size
+                break
+        else:
+            groups.append([lo, hi, [i], size])
+    return [group[:3] for group in groups]
+
+
+NODULE_DTYPE = np.dtype([('case', 'i4'), ('target', 'f8', 4), ('malignancy', 'f8'), ('weight', 'f4')])
+
+
+def nodule_table(labels, sizelims):
+    """ One NODULE_DTYPE row per nodule of labels (one (z, y, x, d[, malignancy]) array per case) larger than one of
+    the sizelims, with sampling weight 1, 2, 4, 8 for each of sizelims[0..3] its diameter is above """
+    rows = []
+    for index, label in enumerate(labels):
+        for t in label:
+            weight = sum(w for lim, w in zip(sizelims, [1, 2, 4, 8]) if t[3] > lim)
+            if weight:
+                rows.append((index, t[:4], t[4] if len(t) > 4 else 0, weight))
+    return np.array(rows, NODULE_DTYPE)
+
 
 class DataBowl3Detector(Dataset):
-    def __init__(self, data_dir, split, config, phase='train', split_comber=None):
+    def __init__(self, data_dir, split, config, phase='train', split_comber=None, shard_dir=None, staging=None, level=0,
+                 cache=None, arena=None, defer_augment=False, r_rand=None):
+        # shard_dir: read the volumes from the shards packed there by shard_store.py
+        # staging: staging.Staging of the fold, staged files are read from the local copy
+        # cache: volume_cache.VolumeCache, volumes read again by the same worker come from memory
+        # arena: volume_arena.VolumeArena holding the volumes, shared by all workers (built from open_volume)
+        # defer_augment: train samples are (window, label, coord, affine), augment_batch makes the crops of a batch
+        # level: pyramid level of id_clean (voxels 2**level times larger), labels and sizelim are rescaled to it
+        # r_rand: fraction of random crops in the train epochs, config['r_rand_crop'] by default
         assert phase in ['train', 'val', 'test']
         self.phase = phase
+        self.level = level
+        self.shards = ShardIndex(shard_dir, data_dir) if shard_dir else None
+        self.staging = staging
+        self.cache = cache
+        self.arena = arena
+        self.defer_augment = defer_augment and phase == 'train'
+        self._shapes = {}
+        self._loaded = {}   # volume regions read for the samples of the batch being made (__getitems__)
         self.max_stride = config['max_stride']       
         self.stride = config['stride']       
-        sizelim = config['sizelim']/config['reso']
-        sizelim2 = config['sizelim2']/config['reso']
-        sizelim3 = config['sizelim3']/config['reso']
-        sizelim4 = config['sizelim4']/config['reso']
+        sizelim = config['sizelim']/config['reso']/2**level
+        sizelim2 = config['sizelim2']/config['reso']/2**level
+        sizelim3 = config['sizelim3']/config['reso']/2**level
+        sizelim4 = config['sizelim4']/config['reso']/2**level
         self.blacklist = config['blacklist']
         self.isScale = config['aug_scale']
-        self.r_rand = config['r_rand_crop']  # random ratio for sample augmentation == 0.3
+        self.r_rand = config['r_rand_crop'] if r_rand is None else r_rand  # random ratio for sample augmentation == 0.3
+        if not 0 <= self.r_rand < 1:
+            raise ValueError('r_rand has to be in [0, 1), not {}'.format(self.r_rand))
         self.augtype = config['augtype']
         self.pad_value = config['pad_value']
         self.split_comber = split_comber
@@ -46,9 +128,10 @@ class DataBowl3Detector(Dataset):
         self.filenames = [os.path.join(data_dir, '{}_clean.npy'.format(idx)) for idx in idcs]
         
         labels = []
-        
+        case_index = load_case_index(data_dir)
+        check_resolution(case_index, idcs, config['reso'])
         for idx in idcs:
-            l = np.load(Path(data_dir)/'{}_label.npy'.format(idx), allow_pickle=True) # l = [z, y, x, d]
+            l = load_label(data_dir, idx, case_index, level) # l = [z, y, x, d]
             if np.all(l==0):
                 l = np.array([])
             labels.append(l)
@@ -56,37 +139,91 @@ class DataBowl3Detector(Dataset):
 
         # Balance nodules of different diameters by sizelim. sizelim2, sizelim3 by augment bigger nodules, which are fewer in dataset.
         if self.phase != 'test':
-            self.bboxes = []
-            for index, label in enumerate(labels):
-                if len(label) > 0 :
-                    for t in label:   # t = (z, y, x, d)
-                        if t[3] > sizelim:
-                            self.bboxes.append([np.concatenate([[index], t])])
-                        if t[3] > sizelim2:
-                            self.bboxes += [[np.concatenate([[index], t])]] * 2
-                        if t[3] > sizelim3:
-                            self.bboxes += [[np.concatenate([[index], t])]] * 4
-                        if t[3] > sizelim4:
-                            self.bboxes += [[np.concatenate([[index], t])]] * 8
-
-            # Finally, a balanced label collection is generated.
-            if len(self.bboxes) > 0:
-                self.bboxes = np.concatenate(self.bboxes, axis=0)
-            else:
-                self.bboxes = np.array(self.bboxes)
+            self.bboxes = nodule_table(labels, [sizelim, sizelim2, sizelim3, sizelim4])
+            self._cumweight = np.cumsum(self.bboxes['weight'], dtype=np.float64)
+            self.n_pos = int(round(self._cumweight[-1])) if len(self.bboxes) else 0
 
-        self.crop = Crop(config)
+        self.crop = Crop(config, level)
         self.label_mapping = LabelMapping(config, self.phase)
 
+    def nodule(self, i):
+        """ Row of self.bboxes of positive sample i, 0 <= i < n_pos: each nodule comes up `weight` times """
+        return int(np.searchsorted(self._cumweight, i, side='right'))
+
+    def load_volume(self, filename):
+        if filename in self._loaded:
+            return self._loaded[filename]
+        if self.arena is not None and filename in self.arena:
+            return self.arena[filename]
+        if self.cache is not None:
+            return self.cache.get((filename, self.level), lambda: self.open_volume(filename))
+        return self.open_volume(filename)
+
+    def open_volume(self, filename):
+        """ The volume as stored (memory-mapped or lazily decoded), from the shards / staged copy if any """
+        resolve = self.staging.resolve if self.staging is not None else None
+        if self.shards is not None:
+            return self.shards.load_volume(filename, resolve, self.level)
+        return load_volume(resolve(filename) if resolve else filename, self.level)
+
+    def volume_shape(self, i):
+        """ (z, y, x) shape of volume i """
+        if i not in self._shapes:
+            self._shapes[i] = tuple(self.open_volume(self.filenames[i]).shape[1:])
+        return self._shapes[i]
+
+    def __getitems__(self, indices):
+        """ Samples of a batch (the DataLoader hands over the whole batch). Consecutive epoch plan rows of the same
+        case (the runs of epoch_plan.EpochPlanBatchSampler) read the volume once for each group of overlapping crops. """
+        samples = []
+        k = 0
+        while k < len(indices):
+            run = 1
+            if isinstance(indices[k], np.void):
+                case = indices[k]['case']
+                while (k + run < len(indices) and isinstance(indices[k + run], np.void)
+                       and indices[k + run]['case'] == case):
+                    run += 1
+            regions = [None] * run
+            if run > 1:
+                filename = self.filenames[case]
+                volume = self.load_volume(filename)
+                if not isinstance(volume, np.ndarray) or isinstance(volume, np.memmap):   # not in memory (arena, cache)
+                    shape = np.array(volume.shape[1:])
+                    boxes = [self.crop.source_box(plan_params(row), self.defer_augment) for row in indices[k:k + run]]
+                    boxes = [(np.clip(lo, 0, shape), np.clip(hi, 0, shape)) for lo, hi in boxes]
+                    for lo, hi, members in merge_boxes(boxes):
+                        if len(members) > 1:
+                            region = VolumeRegion(volume, np.stack([lo, hi], 1))
+                            for i in members:
+                                regions[i] = region
+            for idx, region in zip(indices[k:k + run], regions):
+                if region is not None:
+                    self._loaded[filename] = region
+                try:
+                    samples.append(self[idx])
+                finally:
+                    self._loaded.clear()
+            k += run
+        return samples
+
     def __getitem__(self, idx, split=None):
-        t = time.time()
-        np.random.seed(int(str(t%1)[2:7]))
+        plan = None
+        if isinstance(idx, np.void):
+            # a row of an epoch_plan.EpochPlanSampler plan: all the random choices of the sample are in it
+            plan = idx
+            np.random.seed(int(plan['seed']))
+        else:
+            t = time.time()
+            np.random.seed(int(str(t%1)[2:7]))
 
         isRandomImg  = False
         if self.phase == 'train' or self.phase == 'val':
-            if idx >= len(self.bboxes):
+            if plan is not None:
+                isRandom = bool(plan['random'])
+            elif idx >= self.n_pos:
                 isRandom = True
-                idx = np.random.randint(0, len(self.bboxes))
+                idx = np.random.randint(0, self.n_pos)
                 isRandomImg = False
             else:
                 isRandom = False
@@ -95,28 +232,32 @@ class DataBowl3Detector(Dataset):
         
         if self.phase == 'train' or self.phase == 'val':
             if not isRandomImg:
-                bbox = self.bboxes[idx]
-                filename = self.filenames[int(bbox[0])]
-                imgs = np.load(filename)[0:self.channel]
-                bboxes = self.sample_bboxes[int(bbox[0])]
+                bbox = self.bboxes[self.nodule(idx) if plan is None else int(plan['row'])]
+                filename = self.filenames[bbox['case']]
+                imgs = self.load_volume(filename)[0:self.channel]
+                bboxes = self.sample_bboxes[bbox['case']]
                 isScale = self.augtype['scale'] and (self.phase=='train')
-                sample, target, bboxes, coord = self.crop(imgs, bbox[1:], bboxes, isScale=isScale, isRand=isRandom)
-
-                if self.phase=='train' and not isRandom:
-                     sample, target, bboxes, coord = augment(sample, target, bboxes, coord,
-                        ifflip=self.augtype['flip'], ifrotate=self.augtype['rotate'], ifswap=self.augtype['swap'])
+                isAug = self.phase=='train' and not isRandom
+                params = None if plan is None else plan_params(plan)
+                sample, target, bboxes, coord, *affine = self.crop(imgs, bbox['target'], bboxes, isScale=isScale, isRand=isRandom,
+                    ifflip=isAug and self.augtype['flip'], ifrotate=isAug and self.augtype['rotate'],
+                    ifswap=isAug and self.augtype['swap'], defer=self.defer_augment, params=params)
             else:
                 randimid = np.random.randint(len(self.filenames))
                 filename = self.filenames[randimid]
-                imgs = np.load(filename)[0:self.channel]
+                imgs = self.load_volume(filename)[0:self.channel]
                 bboxes = self.sample_bboxes[randimid]
-                sample, target, bboxes, coord = self.crop(imgs, [], bboxes, isScale=False, isRand=True)
+                sample, target, bboxes, coord, *affine = self.crop(imgs, [], bboxes, isScale=False, isRand=True,
+                                                                   defer=self.defer_augment)
 
             try:
-                label = self.label_mapping(sample.shape[1:], target, bboxes, filename)
+                label = self.label_mapping(self.crop.crop_size if affine else sample.shape[1:], target, bboxes, filename)
             except ZeroDivisionError:
                 raise Exception('Bug in {}'.format(os.path.basename(filename).split('_clean')[0]))
 
+            if affine:
+                # resampled and normalised by augment_batch
+                return torch.from_numpy(sample), torch.from_numpy(label), coord, torch.from_numpy(affine[0])
             sample = (sample.astype(np.float32)-128)/128
 
             # print('sample_shape: ', sample.shape, '  label_shape: ', label.shape)
@@ -124,7 +265,7 @@ class DataBowl3Detector(Dataset):
 
 
         elif self.phase == 'test':
-            imgs = np.load(self.filenames[idx])
+            imgs = np.asarray(self.load_volume(self.filenames[idx]))
             bboxes = self.sample_bboxes[idx]
             nz, nh, nw = imgs.shape[1:]
             pz = int(np.ceil(float(nz) / self.stride)) * self.stride
@@ -146,9 +287,9 @@ class DataBowl3Detector(Dataset):
 
     def __len__(self):
         if self.phase == 'train':
-            return int(len(self.bboxes)//(1-self.r_rand))
+            return int(self.n_pos//(1-self.r_rand))
         elif self.phase =='val':
-            return len(self.bboxes)
+            return self.n_pos
         else:
             return len(self.sample_bboxes)
 
@@ -157,18 +298,34 @@ class NoduleMalignancyDetector(Dataset):
     """ Save malignancy label of each nodule in label.npy with [z, y, x, d, malignancy]
 
     """
-    def __init__(self, data_dir, split, config, phase='train', split_comber=None):
+    def __init__(self, data_dir, split, config, phase='train', split_comber=None, shard_dir=None, staging=None, level=0,
+                 cache=None, arena=None, defer_augment=False, r_rand=None):
+        # shard_dir: read the volumes from the shards packed there by shard_store.py
+        # staging: staging.Staging of the fold, staged files are read from the local copy
+        # cache: volume_cache.VolumeCache, volumes read again by the same worker come from memory
+        # arena: volume_arena.VolumeArena holding the volumes, shared by all workers (built from open_volume)
+        # defer_augment: train samples are (window, label, coord, malignancy, affine), augment_batch makes the crops of a batch
+        # level: pyramid level of id_clean (voxels 2**level times larger), labels and sizelim are rescaled to it
+        # r_rand: fraction of random crops in the train epochs, config['r_rand_crop'] by default
         assert phase in ['train', 'val', 'test']
         self.phase = phase
+        self.level = level
+        self.shards = ShardIndex(shard_dir, data_dir) if shard_dir else None
+        self.staging = staging
+        self.cache = cache
+        self.arena = arena
+        self.defer_augment = defer_augment and phase == 'train'
         self.max_stride = config['max_stride']
         self.stride = config['stride']
-        sizelim = config['sizelim'] / config['reso']
-        sizelim2 = config['sizelim2'] / config['reso']
-        sizelim3 = config['sizelim3'] / config['reso']
-        sizelim4 = config['sizelim4'] / config['reso']
+        sizelim = config['sizelim'] / config['reso'] / 2**level
+        sizelim2 = config['sizelim2'] / config['reso'] / 2**level
+        sizelim3 = config['sizelim3'] / config['reso'] / 2**level
+        sizelim4 = config['sizelim4'] / config['reso'] / 2**level
         self.blacklist = config['blacklist']
         self.isScale = config['aug_scale']
-        self.r_rand = config['r_rand_crop']  # random ratio for sample augmentation == 0.3
+        self.r_rand = config['r_rand_crop'] if r_rand is None else r_rand  # random ratio for sample augmentation == 0.3
+        if not 0 <= self.r_rand < 1:
+            raise ValueError('r_rand has to be in [0, 1), not {}'.format(self.r_rand))
         self.augtype = config['augtype']
         self.pad_value = config['pad_value']
         self.split_comber = split_comber
@@ -187,9 +344,10 @@ class NoduleMalignancyDetector(Dataset):
         self.filenames = [os.path.join(data_dir, '{}_clean.npy'.format(idx)) for idx in idcs]
 
         self.sample_bboxes = []
-
+        case_index = load_case_index(data_dir)
+        check_resolution(case_index, idcs, config['reso'])
         for idx in idcs:
-            l = np.load(Path(data_dir)/'{}_label.npy'.format(idx))   # l = [z, y, x, d, malignancy]
+            l = load_label(data_dir, idx, case_index, level)   # l = [z, y, x, d, malignancy]
             if np.all(l==0):
                 l = np.array([])
             self.sample_bboxes.append(l)
@@ -197,37 +355,40 @@ class NoduleMalignancyDetector(Dataset):
 
         # Balance nodules of different diameters by sizelim. sizelim2, sizelim3 by augment bigger nodules, which are fewer in dataset.
         if self.phase != 'test':
-            self.bboxes = []
-            for index, label in enumerate(self.sample_bboxes):
-                if len(label) > 0:
-                    for t in label:  # t = (z, y, x, d, malignancy)
-                        if t[3] > sizelim:
-                            self.bboxes.append([np.concatenate([[index], t])])
-                        if t[3] > sizelim2:
-                            self.bboxes += [[np.concatenate([[index], t])]] * 2
-                        if t[3] > sizelim3:
-                            self.bboxes += [[np.concatenate([[index], t])]] * 4
-                        if t[3] > sizelim4:
-                            self.bboxes += [[np.concatenate([[index], t])]] * 8
-
-            # Finally, a balanced label collection is generated.
-            if len(self.bboxes) > 0:
-                self.bboxes = np.concatenate(self.bboxes, axis=0)
-            else:
-                self.bboxes = np.array(self.bboxes)
+            self.bboxes = nodule_table(self.sample_bboxes, [sizelim, sizelim2, sizelim3, sizelim4])
+            self._cumweight = np.cumsum(self.bboxes['weight'], dtype=np.float64)
+            self.n_pos = int(round(self._cumweight[-1])) if len(self.bboxes) else 0
 
-        self.crop = Crop(config)
+        self.crop = Crop(config, level)
         self.label_mapping = LabelMapping(config, self.phase)
 
+    def nodule(self, i):
+        """ Row of self.bboxes of positive sample i, 0 <= i < n_pos: each nodule comes up `weight` times """
+        return int(np.searchsorted(self._cumweight, i, side='right'))
+
+    def load_volume(self, filename):
+        if self.arena is not None and filename in self.arena:
+            return self.arena[filename]
+        if self.cache is not None:
+            return self.cache.get((filename, self.level), lambda: self.open_volume(filename))
+        return self.open_volume(filename)
+
+    def open_volume(self, filename):
+        """ The volume as stored (memory-mapped or lazily decoded), from the shards / staged copy if any """
+        resolve = self.staging.resolve if self.staging is not None else None
+        if self.shards is not None:
+            return self.shards.load_volume(filename, resolve, self.level)
+        return load_volume(resolve(filename) if resolve else filename, self.level)
+
     def __getitem__(self, idx, split=None):
         t = time.time()
         np.random.seed(int(str(t % 1)[2:7]))
 
         isRandomImg = False
         if self.phase == 'train' or self.phase == 'val':
-            if idx >= len(self.bboxes):
+            if idx >= self.n_pos:
                 isRandom = True
-                idx = idx % len(self.bboxes)
+                idx = idx % self.n_pos
                 isRandomImg = np.random.randint(2)
             else:
                 isRandom = False
@@ -236,40 +397,42 @@ class NoduleMalignancyDetector(Dataset):
 
         if self.phase == 'train' or self.phase == 'val':
             if not isRandomImg:
-                bbox = self.bboxes[idx]   # bbox = (idx, z, y, x, d, malignancy)
-                filename = self.filenames[int(bbox[0])]
-                imgs = np.load(filename)[0:self.channel]
-                bboxes = self.sample_bboxes[int(bbox[0])]
+                bbox = self.bboxes[self.nodule(idx)]
+                filename = self.filenames[bbox['case']]
+                imgs = self.load_volume(filename)[0:self.channel]
+                bboxes = self.sample_bboxes[bbox['case']]
                 isScale = self.augtype['scale'] and (self.phase == 'train')
-                sample, target, bboxes, coord = self.crop(imgs, bbox[1:5], bboxes, isScale=isScale, isRand=isRandom)
-                try:
-                    malignancy = bbox[5]
-                except IndexError:
-                    malignancy = 0
-
-                if self.phase == 'train' and not isRandom:
-                    sample, target, bboxes, coord = augment(sample, target, bboxes, coord,
-                                                            ifflip=self.augtype['flip'],
-                                                            ifrotate=self.augtype['rotate'],
-                                                            ifswap=self.augtype['swap'])
+                isAug = self.phase == 'train' and not isRandom
+                sample, target, bboxes, coord, *affine = self.crop(imgs, bbox['target'], bboxes, isScale=isScale,
+                                                                   isRand=isRandom,
+                                                                   ifflip=isAug and self.augtype['flip'],
+                                                                   ifrotate=isAug and self.augtype['rotate'],
+                                                                   ifswap=isAug and self.augtype['swap'],
+                                                                   defer=self.defer_augment)
+                malignancy = bbox['malignancy']
             else:
                 randimid = np.random.randint(len(self.filenames))
                 filename = self.filenames[randimid]
-                imgs = np.load(filename)[0:self.channel]
+                imgs = self.load_volume(filename)[0:self.channel]
                 bboxes = self.sample_bboxes[randimid]
-                sample, target, bboxes, coord = self.crop(imgs, [], bboxes, isScale=False, isRand=True)
+                sample, target, bboxes, coord, *affine = self.crop(imgs, [], bboxes, isScale=False, isRand=True,
+                                                                   defer=self.defer_augment)
                 malignancy = 0  # it's randomly selected, so the malignancy is unknown.
 
             try:
-                label = self.label_mapping(sample.shape[1:], target, bboxes, filename)
+                label = self.label_mapping(self.crop.crop_size if affine else sample.shape[1:], target, bboxes, filename)
             except ZeroDivisionError:
                 raise Exception('Bug in {}'.format(os.path.basename(filename).split('_clean')[0]))
 
+            if affine:
+                # resampled and normalised by augment_batch
+                return (torch.from_numpy(sample), torch.from_numpy(label), coord, torch.tensor(malignancy, dtype=torch.int),
+                        torch.from_numpy(affine[0]))
             sample = (sample.astype(np.float32) - 128) / 128
             return torch.from_numpy(sample), torch.from_numpy(label), coord, torch.tensor(malignancy, dtype=torch.int)
 
         elif self.phase == 'test':
-            imgs = np.load(self.filenames[idx])
+            imgs = np.asarray(self.load_volume(self.filenames[idx]))
             bboxes = self.sample_bboxes[idx]
             nz, nh, nw = imgs.shape[1:]
             pz = int(np.ceil(float(nz) / self.stride)) * self.stride
@@ -292,34 +455,47 @@ class NoduleMalignancyDetector(Dataset):
 
     def __len__(self):
         if self.phase == 'train':
-            return int(len(self.bboxes) // (1 - self.r_rand))
+            return int(self.n_pos // (1 - self.r_rand))
         elif self.phase == 'val':
-            return len(self.bboxes)
+            return self.n_pos
         else:
             return len(self.sample_bboxes)
 
 
 class Crop(object):
-    def __init__(self, config):
+    def __init__(self, config, level=0):
+        # level: pyramid level of the volumes, radius_lim (mm) is rescaled to its voxels like sizelim
         self.crop_size = config['crop_size']  #int: [96,96,96]
         self.bound_size = config['bound_size']  #12
         self.stride = config['stride']  #4
         self.pad_value = config['pad_value']  #170
-
-    def __call__(self, imgs, target, bboxes, isScale=False, isRand=False):
+        self.radius_lim = [r / config['reso'] / 2**level for r in config['radius_lim']]  # voxels
+        self.scale_lim = [0.75, 1.25]
+        self.max_angle = 10.   # degrees
+        # side of the windows of defer=True: the source of any scaled / rotated crop fits in it
+        angle = self.max_angle / 180 * np.pi
+        self.window_size = int(np.ceil(max(self.crop_size) / self.scale_lim[0] * (np.cos(angle) + np.sin(angle)))) + 3
+
+    def draw(self, shape, target, isScale=False, isRand=False, ifflip=False, ifrotate=False, ifswap=False, rng=np.random):
+        """ Random parameters (start, scale, angle, axisorder, flipid) of a crop of a volume of shape (z, y, x).
+
+        start is the first voxel of the crop in the volume before scaling, angle (degrees) rotates the (y, x)
+        plane, axisorder permutes the axes and flipid is -1 on the flipped ones.
+        """
+        out_size = np.array(self.crop_size)
+        scale = 1.
         if isScale:
             # target: (z,y,x,d)
-            radiusLim = [8., 120.]
-            scaleLim = [0.75, 1.25]
+            radiusLim = self.radius_lim
+            scaleLim = self.scale_lim
             scaleRange = [np.min([np.max([(radiusLim[0] / target[3]), scaleLim[0]]), 1]),
                           np.max([np.min([(radiusLim[1] / target[3]), scaleLim[1]]), 1])]
-            scale = np.random.rand() * (scaleRange[1] - scaleRange[0]) + scaleRange[0]
-            crop_size = (np.array(self.crop_size).astype('float') / scale).astype('int')
+            scale = rng.rand() * (scaleRange[1] - scaleRange[0]) + scaleRange[0]
+            crop_size = (out_size.astype('float') / scale).astype('int')
         else:
-            crop_size = self.crop_size
+            crop_size = out_size
         bound_size = self.bound_size
-        target = np.copy(target)
-        bboxes = np.copy(bboxes)
+        target = np.array(target, np.float64)
 
         start = []
         for i in range(3):
@@ -328,61 +504,146 @@ class Crop(object):
                 s = np.floor(target[i] - r) + 1 - bound_size
                 e = np.ceil(target[i] + r) + 1 + bound_size - crop_size[i]
             else:
-                s = np.max([imgs.shape[i + 1] - crop_size[i] / 2, imgs.shape[i + 1] / 2 + bound_size])
-                e = np.min([crop_size[i] / 2, imgs.shape[i + 1] / 2 - bound_size])
+                s = np.max([shape[i] - crop_size[i] / 2, shape[i] / 2 + bound_size])
+                e = np.min([crop_size[i] / 2, shape[i] / 2 - bound_size])
                 target = np.array([np.nan, np.nan, np.nan, np.nan])
 
             if s > e:
-                start.append(np.random.randint(e, s))  # !
+                start.append(rng.randint(e, s))  # !
             else:
-                start.append(int(target[i] - crop_size[i] / 2 + np.random.randint(-bound_size / 2, bound_size / 2)))
+                start.append(int(target[i] - crop_size[i] / 2 + rng.randint(-bound_size / 2, bound_size / 2)))
+        start = np.array(start)
+
+        angle = 0.
+        if ifrotate:
+            for _ in range(3):
+                newangle = (rng.rand() - 0.5) * 2 * self.max_angle
+                newtarget = self.forward(target[:3], start, scale, self.transform(newangle))
+                d = target[3] * scale
+                if np.all(newtarget > d) and np.all(newtarget < out_size - d):
+                    angle = newangle
+                    break
+        axisorder = np.arange(3)
+        if ifswap and np.all(out_size == out_size[0]):
+            axisorder = rng.permutation(3)
+        flipid = np.ones(3, int)
+        if ifflip:
+            flipid = np.array([1, rng.randint(2), rng.randint(2)]) * 2 - 1
+        return start, scale, angle, axisorder, flipid
+
+    def transform(self, angle=0., axisorder=(0, 1, 2), flipid=(1, 1, 1)):
+        """ Orthogonal G of the rotation, then axis swap, then flip """
+        angle = angle / 180 * np.pi
+        G = np.eye(3)
+        G[1:, 1:] = [[np.cos(angle), -np.sin(angle)], [np.sin(angle), np.cos(angle)]]
+        return np.array(flipid)[:, np.newaxis] * G[list(axisorder)]
+
+    def forward(self, p, start, scale, G):
+        # crop voxel = G (scale * (volume voxel - start) - centre) + centre
+        centre = (np.array(self.crop_size) - 1) / 2.
+        return (scale * (p - start) - centre).dot(G.T) + centre
+
+    def affine(self, params):
+        """ G of params and (matrix, offset), volume voxel = matrix . crop voxel + offset """
+        start, scale, angle, axisorder, flipid = params
+        G = self.transform(angle, axisorder, flipid)
+        centre = (np.array(self.crop_size) - 1) / 2.
+        return G, G.T / scale, np.asarray(start, int) + (centre - G.T.dot(centre)) / scale
+
+    def source_box(self, params, defer=False):
+        """ (lo, hi): the box of the volume the crop of params is read from (before clipping to the volume) """
+        start, scale, angle, axisorder, flipid = params
+        start = np.asarray(start, int)
+        out_size = np.array(self.crop_size)
+        if defer:
+            lo = np.floor(start + (out_size - 1) / 2. / scale).astype(int) - self.window_size // 2
+            return lo, lo + self.window_size
+        if scale == 1 and angle == 0:
+            return start, start + out_size
+        _, matrix, offset = self.affine(params)
+        corners = np.array(np.meshgrid(*[[0, n - 1] for n in out_size], indexing='ij')).reshape((3, -1))
+        corners = matrix.dot(corners) + offset[:, np.newaxis]
+        return np.floor(corners.min(1)).astype(int) - 1, np.ceil(corners.max(1)).astype(int) + 2
+
+    def __call__(self, imgs, target, bboxes, isScale=False, isRand=False, ifflip=False, ifrotate=False, ifswap=False,
+                 defer=False, params=None):
+        """ Crop of crop_size around target (random one with isRand), with target / bboxes in crop voxels and the
+        coord grid of the crop.
+
+        Scale, rotation in the (y, x) plane, axis swap and flip are composed into one affine transform and the crop
+        is resampled from the volume in a single pass (trilinear), target and bboxes are mapped analytically.
+        Without scale and rotation the crop is cut, transposed and flipped exactly.
+
+        params: the parameters of draw to use, drawn from np.random when None.
+
+        With defer the crop is not resampled: the first value is a window of the volume of window_size around the
+        crop, and a (3, 4) float32 affine is returned as fifth value, crop voxel p being window voxel affine . (p, 1)
+        (see augment_batch).
+        """
+        if params is None:
+            params = self.draw(imgs.shape[1:], target, isScale, isRand, ifflip, ifrotate, ifswap)
+        start, scale, angle, axisorder, flipid = params
+        start, axisorder, flipid = np.asarray(start, int), np.asarray(axisorder), np.asarray(flipid)
+        out_size = np.array(self.crop_size)
+        crop_size = (out_size.astype('float') / scale).astype('int')
+        target = np.full(4, np.nan) if isRand else np.array(target, np.float64)
+        bboxes = np.array(bboxes, np.float64)
+
+        centre = (out_size - 1) / 2.
+        G, matrix, offset = self.affine(params)
+        lo, hi = self.source_box(params, defer)
+        if defer:
+            crop = self.cut(imgs, lo, hi - lo)
+            affine = np.concatenate([matrix, (offset - lo)[:, np.newaxis]], 1).astype('float32')
+        elif scale == 1 and angle == 0:
+            crop = self.cut(imgs, lo, hi - lo)
+            crop = np.ascontiguousarray(crop.transpose([0] + list(axisorder + 1))[:, ::flipid[0], ::flipid[1], ::flipid[2]])
+        else:
+            crop = self.resample(imgs, matrix, offset, lo, hi)
 
-        normstart = np.array(start).astype('float32') / np.array(imgs.shape[1:]) - 0.5
-        normsize = np.array(crop_size).astype('float32') / np.array(imgs.shape[1:])
-        xx, yy, zz = np.meshgrid(np.linspace(normstart[0], normstart[0] + normsize[0], self.crop_size[0] // self.stride),
-                                 np.linspace(normstart[1], normstart[1] + normsize[1], self.crop_size[1] // self.stride),
-                                 np.linspace(normstart[2], normstart[2] + normsize[2], self.crop_size[2] // self.stride),
-                                 indexing='ij')
-        coord = np.concatenate([xx[np.newaxis, ...], yy[np.newaxis, ...], zz[np.newaxis, :]], 0).astype('float32')
+        target[:3] = self.forward(target[:3], start, scale, G)
+        target[3] = target[3] * scale
+        if bboxes.ndim == 2:
+            bboxes[:, :3] = self.forward(bboxes[:, :3], start, scale, G)
+            bboxes[:, 3] = bboxes[:, 3] * scale
 
-        pad = []
-        pad.append([0, 0])
+        # position in the volume of every stride-th crop voxel, in [-0.5, 0.5]
+        coord = (start + centre / scale) / np.array(imgs.shape[1:]) - 0.5
+        coord = coord.reshape((3, 1, 1, 1)).astype('float32')
+        for i in range(3):
+            axis = np.linspace(0, scale * crop_size[i], self.crop_size[i] // self.stride) - centre[i]
+            step = np.outer(G[i] / scale / np.array(imgs.shape[1:]), axis).astype('float32')
+            coord = coord + step.reshape([3] + [-1 if j == i else 1 for j in range(3)])
+        if defer:
+            return crop, target, bboxes, coord, affine
+        return crop, target, bboxes, coord
 
+    def cut(self, imgs, start, size):
+        """ imgs[:, start:start + size], padded with pad_value where it is out of the volume """
+        pad = [[0, 0]]
         for i in range(3):
             leftpad = max(0, -start[i])
-            rightpad = max(0, start[i] + crop_size[i] - imgs.shape[i + 1])
+            rightpad = max(0, start[i] + size[i] - imgs.shape[i + 1])
             pad.append([leftpad, rightpad])
-
         crop = imgs[:,
-               max(start[0], 0):min(start[0] + crop_size[0], imgs.shape[1]),
-               max(start[1], 0):min(start[1] + crop_size[1], imgs.shape[2]),
-               max(start[2], 0):min(start[2] + crop_size[2], imgs.shape[3])]
-        crop = np.pad(crop, pad, 'constant', constant_values=self.pad_value)
-
-        for i in range(3):
-            target[i] = target[i] - start[i]
-        for i in range(len(bboxes)):
-            for j in range(3):
-                bboxes[i][j] = bboxes[i][j] - start[j]
-
-        if isScale:
-            with warnings.catch_warnings():
-                warnings.simplefilter("ignore")
-                crop = zoom(crop, [1, scale, scale, scale], order=2)
-            newpad = self.crop_size[0] - crop.shape[1:][0]
-
-            if newpad < 0:
-                crop = crop[:, :-newpad, :-newpad, :-newpad]
-            elif newpad > 0:
-                pad2 = [[0, 0], [0, newpad], [0, newpad], [0, newpad]]
-                crop = np.pad(crop, pad2, 'constant', constant_values=self.pad_value)
-
-            for i in range(4):
-                target[i] = target[i] * scale
-            for i in range(len(bboxes)):
-                for j in range(4):
-                    bboxes[i][j] = bboxes[i][j] * scale
-        return crop, target, bboxes, coord
+               max(start[0], 0):min(start[0] + size[0], imgs.shape[1]),
+               max(start[1], 0):min(start[1] + size[1], imgs.shape[2]),
+               max(start[2], 0):min(start[2] + size[2], imgs.shape[3])]
+        return np.pad(crop, pad, 'constant', constant_values=self.pad_value)
+
+    def resample(self, imgs, matrix, offset, lo, hi):
+        """ imgs[:, matrix . p + offset] for every voxel p of the crop, pad_value outside of the volume; [lo, hi) is
+        the source_box of the crop """
+        crop = np.empty([imgs.shape[0]] + list(self.crop_size), imgs.dtype)
+        if np.any(hi <= 0) or np.any(lo >= imgs.shape[1:]):
+            crop[...] = self.pad_value
+            return crop
+        # padded where it is out of the volume, voxels at the border blend into pad_value like in the windows of defer
+        region = self.cut(imgs, lo, hi - lo)
+        for c in range(len(region)):
+            affine_transform(region[c], matrix, offset - lo, output=crop[c], order=1,
+                             mode='constant', cval=self.pad_value)
+        return crop
 
 
 class LabelMapping(object):
@@ -396,6 +657,20 @@ class LabelMapping(object):
             self.th_pos = config['th_pos_train']   #0.5
         elif phase == 'val':
             self.th_pos = config['th_pos_val']     #1
+        self._grids = {}  # output_size: (oz, oh, ow) anchor centres, label template
+
+    def grids(self, output_size):
+        """ Anchor centres along each axis and the initial label of an output size, computed once per size """
+        key = tuple(output_size)
+        if key not in self._grids:
+            stride = self.stride
+            offset = ((stride.astype('float')) - 1) / 2
+            centres = tuple(np.arange(offset, offset + stride * (n - 1) + 1, stride) for n in output_size)
+            template = -1 * np.ones(list(output_size) + [len(self.anchors), 5], np.float32)  #(24, 24, 24, #anchor, 5)
+            if self.phase == 'train' and self.num_neg > 0:
+                template[..., 0] = 0   # only the sampled negatives get -1
+            self._grids[key] = centres, template
+        return self._grids[key]
 
     def __call__(self, input_size, target, bboxes, filename):
         stride = self.stride
@@ -409,45 +684,35 @@ class LabelMapping(object):
             assert(input_size[i] % stride == 0), 'input_size[{}]={}, stride={}, filename={}'.format(i, input_size[i], str(stride), filename)
             output_size.append(input_size[i] // stride)
 
-        # Initialize all grid labels to -1
-        label = -1 * np.ones(output_size + [len(anchors), 5], np.float32)  #(24, 24, 24, #anchor, 5)
+        # Initialize all grid labels to -1 (train: 0, see below)
+        (oz, oh, ow), template = self.grids(output_size)
+        label = template.copy()
         offset = ((stride.astype('float')) - 1) / 2
-        oz = np.arange(offset, offset + stride * (output_size[0] - 1) + 1, stride)
-        oh = np.arange(offset, offset + stride * (output_size[1] - 1) + 1, stride)
-        ow = np.arange(offset, offset + stride * (output_size[2] - 1) + 1, stride)
 
-        # Find the positively-labeled grids in bboxes, and set them to 0
-        for bbox in bboxes:
-            for i, anchor in enumerate(anchors):
-                iz, ih, iw = select_samples(bbox, anchor, th_neg, oz, oh, ow)
-                label[iz, ih, iw, i, 0] = 0
+        # Find the positively-labeled grids in bboxes (IoU >= th_neg with a bbox), they are never negative
+        near = np.zeros(label.shape[:4], bool)
+        if len(bboxes) > 0:
+            _, ia, iz, ih, iw = match_anchors(bboxes, anchors, th_neg, (oz, oh, ow))
+            near[iz, ih, iw, ia] = True
 
         if self.phase == 'train' and self.num_neg > 0:
-            # Now, all grids which are labeled as -1 are negative grids.
-            neg_z, neg_h, neg_w, neg_a = np.where(label[:, :, :, :, 0] == -1)
-
-            # Select num_neg(=800) of them, set as -1, leave all others(including positive grid) to 0
-            neg_idcs = random.sample(range(len(neg_z)), min(num_neg, len(neg_z)))
-            neg_z, neg_h, neg_w, neg_a = neg_z[neg_idcs], neg_h[neg_idcs], neg_w[neg_idcs], neg_a[neg_idcs]
-            label[:, :, :, :, 0] = 0
-            label[neg_z, neg_h, neg_w, neg_a, 0] = -1
+            # Now, all other grids are negative grids.
+            neg = np.flatnonzero(~near)
+
+            # Select num_neg(=800) of them, set as -1, leave all others(including positive grid) to 0.
+            # Drawn from a generator seeded by np.random, so that np.random.seed still fixes the labels
+            rng = np.random.default_rng(np.random.randint(1 << 31))
+            neg = neg[rng.choice(len(neg), min(num_neg, len(neg)), replace=False, shuffle=False)]
+            label.reshape((-1, 5))[neg, 0] = -1
+        else:
+            label[..., 0][near] = 0
 
         # If no target in this crop, return negative grids(labeled as -1) only.
         if np.isnan(target[0]):
             return label
 
         # Locate the target on the grids
-        iz, ih, iw, ia = [], [], [], []
-        for i, anchor in enumerate(anchors):
-            iiz, iih, iiw = select_samples(target, anchor, th_pos, oz, oh, ow)
-            iz.append(iiz)
-            ih.append(iih)
-            iw.append(iiw)
-            ia.append(i * np.ones((len(iiz),), np.int64))
-        iz = np.concatenate(iz, 0)
-        ih = np.concatenate(ih, 0)
-        iw = np.concatenate(iw, 0)
-        ia = np.concatenate(ia, 0)
+        _, ia, iz, ih, iw = match_anchors(np.reshape(target, (1, -1)), anchors, th_pos, (oz, oh, ow))
 
         if len(iz) == 0:
             pos = []
@@ -456,7 +721,7 @@ class LabelMapping(object):
             idx = np.argmin(np.abs(np.log(target[3] / anchors)))
             pos.append(idx)
         else:  # randomly choose one if there is more than one positive grid
-            idx = random.sample(range(len(iz)), 1)[0]
+            idx = np.random.randint(len(iz))
             pos = [iz[idx], ih[idx], iw[idx], ia[idx]]
 
         # Calculate the difference ratio of (z,h,w,d) between target and positive grid(=pos) relative to anchor
@@ -468,116 +733,71 @@ class LabelMapping(object):
         return label
 
 
-def augment(sample, target, bboxes, coord, ifflip=True, ifrotate=True, ifswap=True):
-    if ifrotate:
-        validrot = False
-        counter = 0
-        while not validrot:
-            newtarget = np.copy(target)
-            angle1 = (np.random.rand()-0.5)*20
-            size = np.array(sample.shape[2:4]).astype('float')
-            rotmat = np.array([[np.cos(angle1/180*np.pi),-np.sin(angle1/180*np.pi)],[np.sin(angle1/180*np.pi),np.cos(angle1/180*np.pi)]])
-            newtarget[1:3] = np.dot(rotmat,target[1:3]-size/2)+size/2
-            if np.all(newtarget[:3]>target[3]) and np.all(newtarget[:3]< np.array(sample.shape[1:4])-newtarget[3]):
-                validrot = True
-                target = newtarget
-                sample = rotate(sample,angle1,axes=(2,3),reshape=False)
-                coord = rotate(coord,angle1,axes=(2,3),reshape=False)
-                for box in bboxes:
-                    box[1:3] = np.dot(rotmat,box[1:3]-size/2)+size/2
-            else:
-                counter += 1
-                if counter ==3:
-                    break
-    if ifswap:
-        if sample.shape[1]==sample.shape[2] and sample.shape[1]==sample.shape[3]:
-            axisorder = np.random.permutation(3)
-            sample = np.transpose(sample,np.concatenate([[0],axisorder+1]))
-            coord = np.transpose(coord,np.concatenate([[0],axisorder+1]))
-            target[:3] = target[:3][axisorder]
-            bboxes[:,:3] = bboxes[:,:3][:,axisorder]
-            
-    if ifflip:
-        flipid = np.array([1,np.random.randint(2),np.random.randint(2)])*2-1
-        sample = np.ascontiguousarray(sample[:,::flipid[0],::flipid[1],::flipid[2]])
-        coord = np.ascontiguousarray(coord[:,::flipid[0],::flipid[1],::flipid[2]])
-        for ax in range(3):
-            if flipid[ax]==-1:
-                target[ax] = np.array(sample.shape[ax+1])-target[ax]
-                bboxes[:,ax]= np.array(sample.shape[ax+1])-bboxes[:,ax]
-
-    # normal = np.random.uniform(-0.1, 0.1, sample.shape)
-    # if np.random.randint(0, 2):
-    #     sample = sample + normal
-
-    return sample, target, bboxes, coord 
-
-def select_samples(bbox, anchor, th, oz, oh, ow):
-    z, h, w, d = bbox
-
-    if d == 0:
-        return np.zeros((0,), np.int64), np.zeros((0,), np.int64), np.zeros((0,), np.int64)
-
-    max_overlap = min(d, anchor)
-    min_overlap = np.power(max(d, anchor), 3) * th / max_overlap / max_overlap
-
-    if min_overlap > max_overlap:
-        return np.zeros((0,), np.int64), np.zeros((0,), np.int64), np.zeros((0,), np.int64)
-    else:
-        s = z - 0.5 * np.abs(d - anchor) - (max_overlap - min_overlap)
-        e = z + 0.5 * np.abs(d - anchor) + (max_overlap - min_overlap)
-        mz = np.logical_and(oz >= s, oz <= e)
-        iz = np.where(mz)[0]
-        
-        s = h - 0.5 * np.abs(d - anchor) - (max_overlap - min_overlap)
-        e = h + 0.5 * np.abs(d - anchor) + (max_overlap - min_overlap)
-        mh = np.logical_and(oh >= s, oh <= e)
-        ih = np.where(mh)[0]
-            
-        s = w - 0.5 * np.abs(d - anchor) - (max_overlap - min_overlap)
-        e = w + 0.5 * np.abs(d - anchor) + (max_overlap - min_overlap)
-        mw = np.logical_and(ow >= s, ow <= e)
-        iw = np.where(mw)[0]
-
-        if len(iz) == 0 or len(ih) == 0 or len(iw) == 0:
-            return np.zeros((0,), np.int64), np.zeros((0,), np.int64), np.zeros((0,), np.int64)
-        
-        lz, lh, lw = len(iz), len(ih), len(iw)
-        iz = iz.reshape((-1, 1, 1))
-        ih = ih.reshape((1, -1, 1))
-        iw = iw.reshape((1, 1, -1))
-        iz = np.tile(iz, (1, lh, lw)).reshape((-1))
-        ih = np.tile(ih, (lz, 1, lw)).reshape((-1))
-        iw = np.tile(iw, (lz, lh, 1)).reshape((-1))
-
-        centers = np.concatenate([
-            oz[iz].reshape((-1, 1)),
-            oh[ih].reshape((-1, 1)),
-            ow[iw].reshape((-1, 1))], axis=1)
-        
-        r0 = anchor / 2
-        s0 = centers - r0
-        e0 = centers + r0
-        
-        r1 = d / 2
-        s1 = bbox[:3] - r1
-        s1 = s1.reshape((1, -1))
-        e1 = bbox[:3] + r1
-        e1 = e1.reshape((1, -1))
-        
-        overlap = np.maximum(0, np.minimum(e0, e1) - np.maximum(s0, s1))
-        
-        intersection = overlap[:, 0] * overlap[:, 1] * overlap[:, 2]
-        union = anchor * anchor * anchor + d * d * d - intersection
+def match_anchors(bboxes, anchors, th, centres):
+    """ Indices (ib, ia, iz, ih, iw), in C order, of the anchor boxes at the grid centres (oz, oh, ow) with IoU >= th
+    with bbox ib.
 
+    All bboxes (z, h, w, d, ...) x anchors x candidate cells in one batched pass. Along each axis the candidates
+    of a (bbox, anchor) are the cells whose centre lies in the window where the overlap can still reach
+    min_overlap (a contiguous run of cells); the overlap of two cubes being the product of their overlaps along
+    each axis, the IoU of all candidates is an outer product of per-axis overlaps.
+    """
+    bboxes = np.asarray(bboxes, np.float64)[:, :4]
+    d = bboxes[:, 3].reshape((-1, 1))
+    anchor = np.asarray(anchors, np.float64).reshape((1, -1))
+    none = (np.zeros((0,), np.int64),) * 5
+    max_overlap = np.minimum(d, anchor)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        min_overlap = np.power(np.maximum(d, anchor), 3) * th / max_overlap / max_overlap
+    valid = (d > 0) & (min_overlap <= max_overlap)   # (bbox, anchor)
+
+    half = (0.5 * np.abs(d - anchor))[..., np.newaxis]
+    slack = (max_overlap - min_overlap)[..., np.newaxis]
+    r0 = (anchor / 2)[..., np.newaxis]
+    r1 = (d / 2)[..., np.newaxis]
+    cells, inside, overlaps = [], [], []
+    for axis, o in enumerate(centres):
+        c = bboxes[:, axis].reshape((-1, 1, 1))
+        window = np.logical_and(o >= c - half - slack, o <= c + half + slack) & valid[..., np.newaxis]
+        count = window.sum(axis=-1)
+        width = count.max() if count.size else 0
+        if width == 0:
+            return none
+        steps = np.arange(width)
+        idx = np.minimum(window.argmax(axis=-1)[..., np.newaxis] + steps, len(o) - 1)   # (bbox, anchor, width)
+        oc = o[idx]
+        overlap = np.maximum(0, np.minimum(oc + r0, c + r1) - np.maximum(oc - r0, c - r1))
+        shape = [valid.shape[0], valid.shape[1], 1, 1, 1]
+        shape[2 + axis] = width
+        cells.append(idx)
+        inside.append((steps < count[..., np.newaxis]).reshape(shape))
+        overlaps.append(overlap.reshape(shape))
+
+    intersection = overlaps[0] * overlaps[1] * overlaps[2]
+    union = (anchor * anchor * anchor + d * d * d).reshape(valid.shape + (1, 1, 1)) - intersection
+    with np.errstate(divide='ignore', invalid='ignore'):
         iou = intersection / union
-        mask = iou >= th
+    b, a, i, j, k = np.nonzero((iou >= th) & inside[0] & inside[1] & inside[2])
+    return b, a, cells[0][b, a, i], cells[1][b, a, j], cells[2][b, a, k]
 
-        iz = iz[mask]
-        ih = ih[mask]
-        iw = iw[mask]
+def augment_batch(windows, affines, crop_size, pad_value):
+    """ The crops of a batch of Crop(defer=True) windows, resampled on their device (CPU or GPU) in one
+    grid_sample call and normalised like DataBowl3Detector samples.
+
+    windows (B, C, W, W, W), affines (B, 3, 4): crop voxel p of sample b is window voxel affines[b] . (p, 1).
+    """
+    device = windows.device
+    affines = affines.to(device, torch.float32)
+    axes = [torch.arange(n, dtype=torch.float32, device=device) for n in crop_size]
+    grid = torch.stack(torch.meshgrid(*axes, indexing='ij'), -1).reshape((-1, 3))
+    points = torch.matmul(grid, affines[:, :, :3].transpose(1, 2)) + affines[:, np.newaxis, :, 3]
+    # grid_sample takes (x, y, z) in [-1, 1], -1 / 1 being the centres of the first / last voxels
+    size = torch.tensor(windows.shape[2:], dtype=torch.float32, device=device)
+    points = (points * 2 / (size - 1) - 1).flip(-1).reshape([len(windows)] + list(crop_size) + [3])
+    crops = torch.nn.functional.grid_sample(windows.float() - pad_value, points, mode='bilinear',
+                                            padding_mode='zeros', align_corners=True) + pad_value
+    return (crops - 128) / 128
 
-        return iz, ih, iw
 
 def collate(batch):
     if torch.is_tensor(batch[0]):
@@ -0,0 +1,126 @@
+#!/usr/bin/python3
+#coding=utf-8
+
+"""
+Epoch sampling plans of DataBowl3Detector.
+
+EpochPlanSampler draws every random choice of an epoch up front into one PLAN_DTYPE array: the volume (case) and
+bboxes row of each sample, random crop or not, the crop start / scale / rotation / axis swap / flip of Crop.draw and
+a seed for the rest (the label sampling of LabelMapping). The DataLoader hands the rows to
+DataBowl3Detector.__getitem__, which uses them instead of drawing from the wall clock, so an epoch is replayed
+exactly from (seed, epoch).
+
+The rows are ordered in runs of up to `run` samples of the same volume and the runs are shuffled over the epoch:
+a worker crops a volume several times in a row (VolumeCache hits, pages still in memory) while the order of the
+volumes stays random. run=1 is a plain shuffle.
+
+EpochPlanBatchSampler makes the batches of whole runs instead (DataLoader batch_sampler), so a run is in one batch
+and DataBowl3Detector.__getitems__ reads the overlapping crops of a run (mostly the repeated crops of one nodule)
+from one read of the part of the volume they cover. The plan, hence the positive / random crop mix of the epoch,
+is the same.
+"""
+
+import numpy as np
+import torch.utils.data
+
+PLAN_DTYPE = np.dtype([('case', 'i4'), ('row', 'i4'), ('random', '?'), ('start', 'i4', 3), ('scale', 'f8'),
+                       ('angle', 'f8'), ('axisorder', 'i1', 3), ('flip', 'i1', 3), ('seed', 'u4')])
+
+
+def build_plan(dataset, rng):
+    """ PLAN_DTYPE rows of one epoch of a 'train' / 'val' dataset, row i standing for dataset[i] """
+    plan = np.zeros(len(dataset), PLAN_DTYPE)
+    augtype = dataset.augtype
+    isScale = augtype['scale'] and dataset.phase == 'train'
+    for i in range(len(plan)):
+        isRandom = i >= dataset.n_pos
+        row = dataset.nodule(rng.randint(dataset.n_pos) if isRandom else i)
+        bbox = dataset.bboxes[row]
+        case = int(bbox['case'])
+        isAug = dataset.phase == 'train' and not isRandom
+        params = dataset.crop.draw(dataset.volume_shape(case), bbox['target'], isScale, isRandom,
+                                   isAug and augtype['flip'], isAug and augtype['rotate'], isAug and augtype['swap'],
+                                   rng=rng)
+        plan[i] = (case, row, isRandom) + tuple(params) + (rng.randint(1 << 31),)
+    return plan
+
+
+def locality_runs(plan, rng, run):
+    """ Plan rows in runs of up to `run` rows of the same case, the runs shuffled. Within a case the crops of the same
+    nodule come together (then the random crops), so the crops of a run mostly overlap. """
+    order = rng.permutation(len(plan))
+    order = order[np.lexsort((plan['row'][order], plan['random'][order], plan['case'][order]))]
+    cases = plan['case'][order]
+    first = np.r_[0, np.flatnonzero(np.diff(cases)) + 1]
+    rank = np.arange(len(order)) - np.repeat(first, np.diff(np.r_[first, len(order)]))
+    runs = np.split(order, np.flatnonzero(rank % run == 0)[1:])
+    return [runs[k] for k in rng.permutation(len(runs))]
+
+
+def pack_runs(runs, batch_size):
+    """ Batches of batch_size rows made of whole runs (each run to the first batch with room for it, runs of at
+    most batch_size rows); the runs of the batches left incomplete are split to fill them, the last batch may be
+    smaller """
+    batches, incomplete = [], []
+    for run in runs:
+        for batch in incomplete:
+            if len(batch) + len(run) <= batch_size:
+                batch.extend(run)
+                break
+        else:
+            batch = list(run)
+            incomplete.append(batch)
+        if len(batch) == batch_size:
+            incomplete.remove(batch)
+            batches.append(batch)
+    rest = [i for batch in incomplete for i in batch]
+    return batches + [rest[k:k + batch_size] for k in range(0, len(rest), batch_size)]
+
+
+class EpochPlanSampler(torch.utils.data.Sampler):
+    """ Yields the ordered plan rows of the current epoch (set_epoch) as DataLoader indices """
+    def __init__(self, dataset, seed=0, run=4):
+        self.dataset = dataset
+        self.seed = seed
+        self.run = run
+        self.epoch = 0
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+
+    def runs(self, epoch=None):
+        """ The plan of an epoch, in dataset order, and its locality_runs """
+        rng = np.random.RandomState([self.seed, self.epoch if epoch is None else epoch])
+        plan = build_plan(self.dataset, rng)
+        return plan, locality_runs(plan, rng, self.run)
+
+    def plan(self, epoch=None):
+        plan, runs = self.runs(epoch)
+        return plan[np.concatenate(runs)]
+
+    def __iter__(self):
+        return iter(self.plan())
+
+    def __len__(self):
+        return len(self.dataset)
+
+
+class EpochPlanBatchSampler(EpochPlanSampler):
+    """ Yields the batches of the current epoch, lists of plan rows made of whole runs of up to `run` crops of a
+    volume (pack_runs) """
+    def __init__(self, dataset, batch_size, seed=0, run=4):
+        super(EpochPlanBatchSampler, self).__init__(dataset, seed, min(run, batch_size))
+        self.batch_size = batch_size
+        self._batches = (None, None)
+
+    def batches(self):
+        if self._batches[0] != self.epoch:
+            plan, runs = self.runs()
+            self._batches = (self.epoch, [list(plan[batch]) for batch in pack_runs(runs, self.batch_size)])
+        return self._batches[1]
+
+    def __iter__(self):
+        return iter(self.batches())
+
+    def __len__(self):
+        return len(self.batches())
@@ -9,6 +9,7 @@ from importlib import import_module
 import shutil
 from pathlib import Path
 import sys
+import json
 from tqdm import tqdm
 # from tensorboardX import SummaryWriter
 
@@ -17,10 +18,16 @@ from torch.nn import DataParallel
 from torch.backends import cudnn
 from torch.utils.data import DataLoader
 
-from data_detector import DataBowl3Detector, collate
+from data_detector import DataBowl3Detector, collate, resolution_config, augment_batch
 # from data_detector import NoduleMalignancyDetector
 # from utils import setgpu
 from split_combine import SplitComb
+from layers import GetPBB
+import shard_store
+from staging import Staging, fold_files
+from volume_cache import VolumeCache
+from volume_arena import VolumeArena
+from epoch_plan import EpochPlanSampler, EpochPlanBatchSampler
 from adable import AdaBelief
 
 parser = argparse.ArgumentParser(description='PyTorch DataBowl3 Detector')
@@ -56,6 +63,27 @@ parser.add_argument('--n_test', default=4, type=int, metavar='N',
                     help='number of gpu for test')
 parser.add_argument('--cross', default=None, type=str, metavar='N',
                     help='which data cross be used')
+parser.add_argument('--shards', action='store_true', default=False,
+                    help='read the volumes from the shards of the fold (python shard_store.py pack --cross N)')
+parser.add_argument('--stage-dir', default=None, type=str, metavar='DIR',
+                    help='copy the volumes of the fold to this node-local directory in the background')
+parser.add_argument('--level', default=0, type=int, metavar='N',
+                    help='train / test on pyramid level N of the volumes (needs pyramid_levels >= N in preprocessing)')
+parser.add_argument('--volume-cache', default=0., type=float, metavar='GB',
+                    help='keep up to GB of decoded volumes in memory per train data loading worker (LRU)')
+parser.add_argument('--shared-arena', nargs='?', const='/dev/shm', default=None, type=str, metavar='DIR',
+                    help='load the train / val volumes once into shared memory (DIR, /dev/shm by default) for all workers')
+parser.add_argument('--device-augment', action='store_true', default=False,
+                    help='scale / rotate / swap / flip the train batches on the training device instead of in the workers')
+parser.add_argument('--r-rand', default=None, type=float, metavar='R',
+                    help='fraction of random crops in the train epochs (r_rand_crop of the model config by default)')
+parser.add_argument('--epoch-plan', default=None, type=int, metavar='SEED',
+                    help='draw the train epochs from this seed up front (replayable), crops of a volume grouped in runs')
+parser.add_argument('--plan-run', default=4, type=int, metavar='N',
+                    help='with --epoch-plan, up to N crops of a volume in a row (1: plain shuffle)')
+parser.add_argument('--crops-per-load', default=1, type=int, metavar='K',
+                    help='batches of runs of up to K crops of a volume, overlapping crops of a run cut from one read '
+                         '(epoch plan of --epoch-plan SEED, or of a random seed)')
 parser.add_argument('--cluster', action='store_true', default=False,
                     help='enables CUDA training (default: False)')
 
@@ -63,10 +91,11 @@ args = parser.parse_args()
 best_loss = 100.0
 device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
 
+from config_training import config as config_training
 if args.cluster:
-    from config_training import config_cluster as config_training
-else:
-    from config_training import config as config_training
+    # config_cluster overrides config, as in prepare.py --cluster (resolution, pyramid_levels, ...)
+    from config_training import config_cluster
+    config_training = dict(config_training, **config_cluster)
 
 use_tqdm = True
 
@@ -86,6 +115,15 @@ def main():
     train_id = './json/' + args.cross + '/LUNA_train.json'
     val_id = './json/' + args.cross + '/LUNA_val.json'
     test_id = './json/' + args.cross + '/LUNA_test.json'
+    shard_dir = shard_store.shard_dir(datadir, args.cross) if args.shards else None
+    staging = None
+    if args.stage_dir:
+        names = []
+        for split_file in ([test_id] if args.test == 1 else [train_id, val_id, test_id]):
+            with open(split_file, 'rt', encoding='utf-8') as fp:
+                names += [n for n in json.load(fp) if n not in names]
+        staging = Staging(fold_files(datadir, names, shard_dir), args.stage_dir)
+    cache = VolumeCache(args.volume_cache * 1024 ** 3) if args.volume_cache > 0 else None
 
     torch.manual_seed(0)
     cudnn.benchmark = False
@@ -95,6 +133,12 @@ def main():
     model_root = 'net'
     model = import_module('{}.{}'.format(model_root, args.model))
     config, net, criterion, get_pbb = model.get_model(output_feature=False)
+    # the model config is in 1 mm voxels, rescale it to the spacing / pyramid level of id_clean
+    reso = config_training.get('resolution', [1, 1, 1])
+    if len(set(reso)) != 1:
+        raise ValueError('the detector needs an isotropic resolution, config_training has {}'.format(reso))
+    config = resolution_config(config, reso[0], args.level)
+    get_pbb = GetPBB(config)
 
     #############################################################
     # Setup GPU    
@@ -164,25 +208,50 @@ def main():
         sidelen = 48#64#144
         split_comber = SplitComb(sidelen, config['max_stride'], config['stride'], margin, config['pad_value'])
         testset = DataBowl3Detector(datadir, test_id, config,
-                                           phase='test', split_comber=split_comber)
+                                           phase='test', split_comber=split_comber, shard_dir=shard_dir, staging=staging, level=args.level,
+                                           cache=cache)
         test_loader = DataLoader(testset, batch_size=1, shuffle=False, num_workers=0,
                                  collate_fn=collate, pin_memory=False)
         test(test_loader, net, get_pbb, save_dir, config)        
         return
 
-    trainset = DataBowl3Detector(datadir, train_id, config, phase='train')
-    train_loader = DataLoader(trainset, batch_size=args.batch_size, shuffle=True, num_workers=args.workers,
-                              pin_memory=True)
-    valset = DataBowl3Detector(datadir, val_id, config, phase='val')
+    trainset = DataBowl3Detector(datadir, train_id, config, phase='train', shard_dir=shard_dir, staging=staging, level=args.level,
+                                 cache=cache, defer_augment=args.device_augment, r_rand=args.r_rand)
+    # no volume cache for val: its workers would hold one next to the persistent train workers' caches
+    valset = DataBowl3Detector(datadir, val_id, config, phase='val', shard_dir=shard_dir, staging=staging, level=args.level)
+    if args.shared_arena:
+        # one copy of the fold in shared memory for all the workers, instead of one per worker
+        t = time.time()
+        arena = VolumeArena.create(trainset.filenames + valset.filenames, trainset.open_volume, args.shared_arena)
+        trainset.arena = valset.arena = arena
+        print('{} volumes ({:.1f} GB) loaded into {} in {:.0f}s'.format(
+            len(arena), arena.nbytes / 1024. ** 3, arena.path, time.time() - t))
+    # the workers keep their volume cache from one epoch to the next
+    persistent = cache is not None and args.workers > 0
+    if args.crops_per_load > 1:
+        seed = args.epoch_plan if args.epoch_plan is not None else int(time.time())
+        sampler = EpochPlanBatchSampler(trainset, args.batch_size, seed, args.crops_per_load)
+        train_loader = DataLoader(trainset, batch_sampler=sampler, num_workers=args.workers, pin_memory=True,
+                                  persistent_workers=persistent)
+    else:
+        sampler = EpochPlanSampler(trainset, args.epoch_plan, args.plan_run) if args.epoch_plan is not None else None
+        train_loader = DataLoader(trainset, batch_size=args.batch_size, shuffle=sampler is None, sampler=sampler,
+                                  num_workers=args.workers, pin_memory=True, persistent_workers=persistent)
     val_loader = DataLoader(valset, batch_size=1, shuffle=False, num_workers=args.workers,
                             pin_memory=True)
 
     # run train and validate
     for epoch in range(start_epoch, args.epochs + 1):
         # Train for one epoch
+        if sampler is not None:
+            sampler.set_epoch(epoch)
         train(train_loader, net, criterion, epoch, optimizer)
         # Evaluate on validation set
         val_loss = validate(val_loader, net, criterion, epoch, save_dir)
+        if cache is not None:
+            print('volume cache, epoch {}: {hits} hits, {misses} misses ({hit_rate:.1%} hit rate), {evictions} evictions, '
+                  '{uncached} volumes over the budget, {bytes_read} bytes read'.format(epoch, **cache.stats()))
+            cache.reset_stats()
         # Remember the best val_loss and save checkpoint
         is_best = val_loss < best_loss
         best_loss = min(val_loss, best_loss)
@@ -209,9 +278,13 @@ def train(data_loader, net, criterion, epoch, optimizer, lr_adjuster=None):
 
     metrics = []
     pbar = tqdm(data_loader) if use_tqdm else data_loader
-    for i, (input, target, coord) in enumerate(pbar):
+    for i, (input, target, coord, *affine) in enumerate(pbar):
         # input, target, coord = input.to(device), target.to(device), coord.to(device)
         input, target, coord = input.cuda(), target.cuda(), coord.cuda()
+        if affine:
+            # --device-augment: the workers gave the windows around the crops, resample the batch here
+            crop = data_loader.dataset.crop
+            input = augment_batch(input, affine[0], crop.crop_size, crop.pad_value)
         # print('input.shape = ', input.shape)
         # Compute output
         output, _ = net(input, coord)
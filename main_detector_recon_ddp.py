@@ -19,7 +19,8 @@ from torch.backends import cudnn
 from torch.utils.data import DataLoader
 from torch.utils.data.distributed import DistributedSampler
 
-from data_detector import DataBowl3Detector, collate
+from data_detector import DataBowl3Detector, collate, resolution_config
+from layers import GetPBB
 # from data_detector import NoduleMalignancyDetector
 # from utils import setgpu
 from split_combine import SplitComb
@@ -62,6 +63,8 @@ parser.add_argument('--n_test', default=4, type=int, metavar='N',
                     help='number of gpu for test')
 parser.add_argument('--cross', default=None, type=str, metavar='N',
                     help='which data cross be used')
+parser.add_argument('--level', default=0, type=int, metavar='N',
+                    help='train on pyramid level N of the volumes (needs pyramid_levels >= N in preprocessing)')
 parser.add_argument('--cluster', action='store_true', default=False,
                     help='enables CUDA training (default: False)')
 
@@ -75,10 +78,11 @@ parser.add_argument('--rank', default=0, type=int)
 args = parser.parse_args()
 best_loss = 100.0
 
+from config_training import config as config_training
 if args.cluster:
-    from config_training import config_cluster as config_training
-else:
-    from config_training import config as config_training
+    # config_cluster overrides config, as in prepare.py --cluster (resolution, pyramid_levels, ...)
+    from config_training import config_cluster
+    config_training = dict(config_training, **config_cluster)
 
 use_tqdm = True
 
@@ -134,6 +138,12 @@ def main():
     model_root = 'net'
     model = import_module('{}.{}'.format(model_root, args.model))
     config, net, criterion, get_pbb = model.get_model(output_feature=False)
+    # the model config is in 1 mm voxels, rescale it to the spacing / pyramid level of id_clean
+    reso = config_training.get('resolution', [1, 1, 1])
+    if len(set(reso)) != 1:
+        raise ValueError('the detector needs an isotropic resolution, config_training has {}'.format(reso))
+    config = resolution_config(config, reso[0], args.level)
+    get_pbb = GetPBB(config)
 
     # If possible, resume from a checkpoint
     if args.resume:
@@ -215,12 +225,12 @@ def main():
     #     return
     #########################################################################################
 
-    trainset = DataBowl3Detector(datadir, train_id, config, phase='train')
+    trainset = DataBowl3Detector(datadir, train_id, config, phase='train', level=args.level)
     distsampler_train = DistributedSampler(trainset)
     train_loader = DataLoader(trainset, batch_size=args.batch_size, shuffle=False, num_workers=args.workers,
                               pin_memory=True, sampler=distsampler_train)
 
-    valset = DataBowl3Detector(datadir, val_id, config, phase='val')
+    valset = DataBowl3Detector(datadir, val_id, config, phase='val', level=args.level)
     distsampler_val = DistributedSampler(valset)
     val_loader = DataLoader(valset, batch_size=1, shuffle=False, num_workers=args.workers,
                             pin_memory=True, sampler=distsampler_val)
@@ -0,0 +1,101 @@
+#!/usr/bin/python3
+#coding=utf-8
+
+"""
+MetaImage (.mhd + .raw/.zraw) reading without SimpleITK where it is not needed.
+
+read_mhd_header parses the text header only (no pixel data is touched), memmap_raw maps an
+uncompressed .raw file so that sub-regions can be read, and load_itk_image is a drop-in for the
+SimpleITK based loader of prepare.py / GenerateCSV.py. All arrays and vectors are in (z, y, x) order.
+"""
+
+import os
+import numpy as np
+
+MET_TYPES = {'MET_CHAR': np.int8, 'MET_UCHAR': np.uint8,
+             'MET_SHORT': np.int16, 'MET_USHORT': np.uint16,
+             'MET_INT': np.int32, 'MET_UINT': np.uint32,
+             'MET_LONG': np.int32, 'MET_ULONG': np.uint32,
+             'MET_LONG_LONG': np.int64, 'MET_ULONG_LONG': np.uint64,
+             'MET_FLOAT': np.float32, 'MET_DOUBLE': np.float64}
+
+_TRUE = ('true', '1')
+
+
+def read_mhd_header(filename):
+    """ Header of a .mhd file as a dict.
+
+    Parsed keys: 'dims', 'origin', 'spacing' (z, y, x), 'transform' (3x3, as written), 'isflip',
+    'dtype', 'channels', 'compressed', 'data_file' (absolute path, or filename for LOCAL data) and
+    'header_size' (byte offset of the pixel data in data_file). All raw fields are kept under 'fields'.
+    """
+    fields = {}
+    local_offset = None
+    with open(filename, 'rb') as f:
+        for line in iter(f.readline, b''):
+            key, sep, value = line.decode('latin-1').partition('=')
+            if not sep:
+                continue
+            key, value = key.strip(), value.strip()
+            fields[key] = value
+            if key == 'ElementDataFile':
+                local_offset = f.tell()
+                break
+
+    ndims = int(fields.get('NDims', 3))
+    dims = [int(v) for v in fields['DimSize'].split()][::-1]
+    spacing = fields.get('ElementSpacing', fields.get('ElementSize', ' '.join(['1'] * ndims)))
+    origin = fields.get('Offset', fields.get('Origin', fields.get('Position', ' '.join(['0'] * ndims))))
+    transform = fields.get('TransformMatrix', fields.get('Rotation', fields.get('Orientation')))
+    transform = np.eye(ndims) if transform is None else np.array(transform.split()).astype('float').reshape((ndims, ndims))
+
+    dtype = np.dtype(MET_TYPES[fields['ElementType']])
+    msb = fields.get('BinaryDataByteOrderMSB', fields.get('ElementByteOrderMSB', 'False')).lower() in _TRUE
+    dtype = dtype.newbyteorder('>' if msb else '<')
+    channels = int(fields.get('ElementNumberOfChannels', 1))
+
+    data_file = fields['ElementDataFile']
+    if data_file == 'LOCAL':
+        data_file, header_size = os.path.abspath(filename), local_offset
+    else:
+        data_file = os.path.join(os.path.dirname(os.path.abspath(filename)), data_file)
+        header_size = int(fields.get('HeaderSize', 0))
+    compressed = fields.get('CompressedData', 'False').lower() in _TRUE
+    if header_size == -1 and not compressed:
+        # -1: the pixel data is at the end of the file
+        header_size = os.path.getsize(data_file) - int(np.prod(dims)) * channels * dtype.itemsize
+
+    return {'dims': np.array(dims),
+            'origin': np.array(origin.split()).astype('float')[::-1],
+            'spacing': np.array(spacing.split()).astype('float')[::-1],
+            'transform': transform,
+            'isflip': bool(np.any(np.round(transform.ravel()) != np.eye(3).ravel())) if ndims == 3 else False,
+            'dtype': dtype,
+            'channels': channels,
+            'compressed': compressed,
+            'data_file': data_file,
+            'header_size': header_size,
+            'fields': fields}
+
+
+def memmap_raw(filename, header=None):
+    """ Read-only memory map (z, y, x[, channel]) of the pixel data of an uncompressed .mhd """
+    header = header or read_mhd_header(filename)
+    if header['compressed']:
+        raise ValueError('{} has compressed pixel data and cannot be memory-mapped'.format(filename))
+    shape = tuple(header['dims']) + ((header['channels'],) if header['channels'] > 1 else ())
+    return np.memmap(header['data_file'], dtype=header['dtype'], mode='r',
+                     offset=header['header_size'], shape=shape)
+
+
+def load_itk_image(filename):
+    """ (image, origin, spacing, isflip) like the SimpleITK loader, uncompressed data is read without ITK """
+    header = read_mhd_header(filename)
+    if header['compressed']:
+        import SimpleITK as sitk
+        numpyImage = sitk.GetArrayFromImage(sitk.ReadImage(filename))
+    else:
+        numpyImage = np.array(memmap_raw(filename, header))
+        if not numpyImage.dtype.isnative:
+            numpyImage = numpyImage.astype(numpyImage.dtype.newbyteorder('='))
+    return numpyImage, header['origin'], header['spacing'], header['isflip']
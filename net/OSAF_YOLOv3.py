@@ -25,6 +25,7 @@ config['sizelim'] = 3. #mm, smallest nodule size
 config['sizelim2'] = 10
 config['sizelim3'] = 20
 config['sizelim4'] = 30
+config['radius_lim'] = [8., 120.] #mm, nodule radius range of the scale augmentation
 config['aug_scale'] = True
 config['r_rand_crop'] = 0.3
 config['pad_value'] = 0
@@ -4,19 +4,42 @@
 import os
 import shutil
 import numpy as np
-from scipy.ndimage.interpolation import zoom
-import SimpleITK as sitk
-from scipy.ndimage.morphology import binary_dilation, generate_binary_structure
+from scipy.ndimage.interpolation import zoom, affine_transform
+from scipy.ndimage.morphology import distance_transform_cdt
+from scipy.ndimage import correlate1d
 from skimage.morphology import convex_hull_image
 import pandas
 import warnings
 from glob import glob
 import concurrent.futures
-from config_training import config
+from concurrent.futures.process import BrokenProcessPool
+import argparse
+import time
+import traceback
+import json
+import hashlib
+from config_training import config, config_cluster
+from volume_store import save_chunked, VOLUME_EXT
+from mhd_io import load_itk_image, read_mhd_header
+from preprocess_manifest import Manifest, Leases, atomic_save, atomic_write, sha1sum, worker_id
+from case_index import CaseIndex, index_path
+from telemetry import StageProbe, TelemetryLog, step
 
-def resample(imgs, spacing, new_spacing, order=2):
+RESAMPLE_BACKENDS = ('scipy', 'scipy_slab', 'torch')
+
+def resample(imgs, spacing, new_spacing, order=2, backend='scipy', slab=32, workers=4):
+    """ Resample imgs from spacing to (about) new_spacing, returns (imgs, true_spacing).
+
+    backend: 'scipy'      one scipy.ndimage.zoom call over the whole volume
+             'scipy_slab' the output is cut into slabs of `slab` z-slices interpolated by `workers` threads
+             'torch'      the same slabs through torch.nn.functional.grid_sample on CPU (order=1 only)
+    The slab backends never hold more than `workers` slabs of temporaries at a time, see resample_box.
+    """
     if len(imgs.shape)==3:
         new_shape = np.round(imgs.shape * spacing / new_spacing)
+        if backend != 'scipy':
+            box = np.stack([np.zeros(3), new_shape], axis=1)
+            return resample_box(imgs, spacing, new_spacing, box, order=order, backend=backend, slab=slab, workers=workers)
         true_spacing = spacing * imgs.shape / new_shape
         resize_factor = new_shape / imgs.shape
         imgs = zoom(imgs, resize_factor, mode='nearest', order=order)
@@ -26,52 +49,133 @@ def resample(imgs, spacing, new_spacing, order=2):
         newimg = []
         for i in range(n):
             slice = imgs[:,:,:,i]
-            newslice,true_spacing = resample(slice, spacing, new_spacing)
+            newslice,true_spacing = resample(slice, spacing, new_spacing, backend=backend, slab=slab, workers=workers)
             newimg.append(newslice)
         newimg = np.transpose(np.array(newimg), [1, 2, 3, 0])
         return newimg, true_spacing
     else:
         raise ValueError('wrong shape')
 
+def _source_region(box, scale, shape, halo):
+    """ Input voxels [lo, hi) needed to interpolate the output voxels in box. """
+    lo = np.maximum(np.floor(box[:, 0] * scale).astype('int') - halo, 0)
+    hi = np.minimum(np.ceil((box[:, 1] - 1) * scale).astype('int') + 1 + halo, shape)
+    return lo, hi
+
+def _resample_scipy(imgs, scale, box, order, halo, out):
+    lo, hi = _source_region(box, scale, np.array(imgs.shape), halo)
+    crop = imgs[lo[0]:hi[0], lo[1]:hi[1], lo[2]:hi[2]]
+    affine_transform(crop, scale, offset=box[:, 0] * scale - lo, output_shape=out.shape,
+                     output=out, order=order, mode='nearest')
+
+def _resample_torch(imgs, scale, box, order, halo, out):
+    import torch
+    import torch.nn.functional as F
+    if order != 1:
+        raise ValueError('torch resampling backend only supports order=1, got {}'.format(order))
+    lo, hi = _source_region(box, scale, np.array(imgs.shape), halo)
+    crop = torch.from_numpy(np.ascontiguousarray(imgs[lo[0]:hi[0], lo[1]:hi[1], lo[2]:hi[2]], np.float32))
+    # Sample coordinates in the crop, normalized to [-1, 1] (align_corners=True), grid_sample wants (x, y, z)
+    axes = []
+    for i in range(3):
+        coord = np.arange(box[i, 0], box[i, 1]) * scale[i] - lo[i]
+        n = hi[i] - lo[i]
+        axes.append(torch.from_numpy((2 * coord / max(n - 1, 1) - 1).astype(np.float32)))
+    gz, gy, gx = torch.meshgrid(axes[0], axes[1], axes[2], indexing='ij')
+    grid = torch.stack([gx, gy, gz], dim=-1)[None]
+    res = F.grid_sample(crop[None, None], grid, mode='bilinear', padding_mode='border', align_corners=True)[0, 0]
+    if np.issubdtype(out.dtype, np.integer):
+        info = np.iinfo(out.dtype)
+        res = res.round().clamp(info.min, info.max)
+    out[...] = res.numpy()
+
+_RESAMPLE_SLAB_FN = {'scipy_slab': _resample_scipy, 'torch': _resample_torch}
+
+def resample_box(imgs, spacing, new_spacing, box, order=2, halo=None, backend='scipy_slab', slab=None, workers=1):
+    """ Same as resample(imgs, spacing, new_spacing, order)[0][box] for a 3D image, but only the part of
+    imgs that maps into box = [[z0, z1], [y0, y1], [x0, x1]] (output voxels) is interpolated.
+
+    zoom samples output voxel o at input coordinate o * (n_in - 1) / (n_out - 1); the same coordinates are
+    sampled with affine_transform on the matching input region, grown by `halo` voxels so the border
+    interpolation (and the spline prefilter for order > 1) sees the same neighbourhood.
+    With `slab`, the box is further cut into slabs of that many output z-slices, run by `workers` threads.
+    """
+    if halo is None:
+        halo = 2 if order <= 1 else 8
+    shape = np.array(imgs.shape)
+    new_shape = np.round(shape * spacing / new_spacing)
+    true_spacing = spacing * shape / new_shape
+    scale = np.where(new_shape > 1, (shape - 1) / np.maximum(new_shape - 1, 1), 1.)
+    box = np.clip(np.asarray(box), 0, new_shape[:, np.newaxis]).astype('int')
+    fn = _RESAMPLE_SLAB_FN[backend]
+
+    out = np.empty(tuple(box[:, 1] - box[:, 0]), imgs.dtype)
+    slab = slab or max(out.shape[0], 1)
+    slabs = []
+    for z0 in range(box[0, 0], box[0, 1], slab):
+        z1 = min(z0 + slab, box[0, 1])
+        slab_box = np.array([[z0, z1], box[1], box[2]])
+        slabs.append((slab_box, out[z0 - box[0, 0]:z1 - box[0, 0]]))
+    if workers > 1 and len(slabs) > 1:
+        with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+            list(executor.map(lambda s: fn(imgs, scale, s[0], order, halo, s[1]), slabs))
+    else:
+        for slab_box, slab_out in slabs:
+            fn(imgs, scale, slab_box, order, halo, slab_out)
+    return out, true_spacing
+
 def worldToVoxelCoord(worldCoord, origin, spacing):
     stretchedVoxelCoord = np.absolute(worldCoord - origin)
     voxelCoord = stretchedVoxelCoord / spacing
     return voxelCoord
 
-def load_itk_image(filename):
-    with open(filename) as f:
-        contents = f.readlines()
-        line = [k for k in contents if k.startswith('TransformMatrix')][0]
-        transformM = np.array(line.split(' = ')[1].split(' ')).astype('float')
-        transformM = np.round(transformM)
-        if np.any(transformM!=np.array([1, 0, 0, 0, 1, 0, 0, 0, 1])):
-            isflip = True
-        else:
-            isflip = False
+def _convex_slice(mask1):
+    # The hull lies inside the bounding box of the slice, so it is computed on that crop only
+    rows = np.flatnonzero(mask1.any(1))
+    cols = np.flatnonzero(mask1.any(0))
+    crop = np.ascontiguousarray(mask1[rows[0]:rows[-1]+1, cols[0]:cols[-1]+1])
+    hull = convex_hull_image(crop)
+    if np.sum(hull) > 1.5 * np.sum(crop):
+        return mask1
+    mask2 = np.zeros_like(mask1)
+    mask2[rows[0]:rows[-1]+1, cols[0]:cols[-1]+1] = hull
+    return mask2
 
-    itkimage = sitk.ReadImage(filename)
-    numpyImage = sitk.GetArrayFromImage(itkimage)
-     
-    numpyOrigin = np.array(list(reversed(itkimage.GetOrigin())))
-    numpySpacing = np.array(list(reversed(itkimage.GetSpacing())))
-     
-    return numpyImage, numpyOrigin, numpySpacing, isflip
+def process_mask(mask, workers=4):
+    """ Slice-wise convex hull (kept only if it adds less than 50% area), then a 10 voxel 6-connected dilation.
 
-def process_mask(mask):
+    The slices are processed by a thread pool. binary_dilation with the 6-connected structure iterated
+    10 times is the set of voxels within taxicab distance 10 of the mask, which is computed in one pass
+    with a chamfer distance transform on the bounding box of the mask (plus the 10 voxel margin).
+    """
     convex_mask = np.copy(mask)
-    for i_layer in range(convex_mask.shape[0]):
-        mask1  = np.ascontiguousarray(mask[i_layer])
-        if np.sum(mask1) > 0:
-            mask2 = convex_hull_image(mask1)
-            if np.sum(mask2) > 1.5 * np.sum(mask1):
-                mask2 = mask1
-        else:
-            mask2 = mask1
-        convex_mask[i_layer] = mask2
-    struct = generate_binary_structure(3, 1)
-    dilatedMask = binary_dilation(convex_mask, structure=struct, iterations=10)
+    layers = np.flatnonzero(mask.any(axis=(1, 2)))
+    if len(layers) == 0:
+        return np.zeros(mask.shape, bool)
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+        for i_layer, mask2 in zip(layers, executor.map(_convex_slice, [mask[i] for i in layers])):
+            convex_mask[i_layer] = mask2
+
+    iterations = 10
+    lo, hi = mask_bbox(convex_mask)
+    lo = np.maximum(lo - iterations, 0)
+    hi = np.minimum(hi + iterations + 1, mask.shape)
+    region = tuple(slice(l, h) for l, h in zip(lo, hi))
+    dist = distance_transform_cdt(~convex_mask[region], metric='taxicab')
+    dilatedMask = np.zeros(mask.shape, bool)
+    dilatedMask[region] = dist <= iterations
     return dilatedMask
 
+def mask_bbox(mask):
+    """ Inclusive [min, max] voxel index of a non-empty mask along each axis, from per-axis projections. """
+    lo, hi = [], []
+    for axis in range(mask.ndim):
+        others = tuple(a for a in range(mask.ndim) if a != axis)
+        idx = np.flatnonzero(mask.any(axis=others))
+        lo.append(idx[0])
+        hi.append(idx[-1])
+    return np.array(lo), np.array(hi)
+
 def lumTrans(img):
     lungwin = np.array([-1200., 600.])
     newimg = (img - lungwin[0]) / (lungwin[1] - lungwin[0])
@@ -80,134 +184,542 @@ def lumTrans(img):
     newimg = (newimg*255).astype('uint8')
     return newimg
 
-def savenpy_luna(id, annos, filelist, luna_segment, luna_data, savepath):
-    """
-    Note: Dr. Chen adds malignancy label, so the label becomes (z,y,x,d,malignancy), <- but I cancelled it !
+# lumTrans of every int16 value, indexed by the uint16 bit pattern of the value
+_LUM_LUT = lumTrans(np.arange(1 << 16, dtype=np.uint16).view(np.int16))
+
+def fuse_intensity(img, dilatedMask, Mask, pad_value=170, bone_thresh=210):
+    """ lumTrans, padding outside dilatedMask and bone removal in dilatedMask ^ Mask, in one uint8 pass.
+
+    Same result as:
+        sliceim = lumTrans(img)
+        sliceim = sliceim*dilatedMask+pad_value*(1-dilatedMask).astype('uint8')
+        sliceim[(sliceim*(dilatedMask ^ Mask))>bone_thresh] = pad_value
+    but int16 CTs go through a lookup table, so no full-volume float64 temporaries are created.
     """
-    islabel = True
-    isClean = True
-    resolution = np.array([1, 1, 1])
-    name = filelist[id]
+    if img.dtype == np.int16:
+        sliceim = _LUM_LUT[img.view(np.uint16)]
+    else:
+        sliceim = lumTrans(img)
+    sliceim[~dilatedMask] = pad_value
+    bones = sliceim > bone_thresh
+    bones &= dilatedMask
+    bones &= ~Mask
+    sliceim[bones] = pad_value
+    return sliceim
 
-    # Load mask, and calculate extendbox from the mask
-    Mask, origin, spacing, isflip = load_itk_image(os.path.join(luna_segment, name+'.mhd'))
-    if isflip:
+# Everything the outputs depend on besides the input files and the annotations. Bump 'version' when
+# the algorithm itself changes, so that incremental runs (see case_fingerprints) redo every case.
+PARAMS = {'version': 1,
+          'resolution': [1, 1, 1],
+          'margin': 5,
+          'bone_thresh': 210,
+          'pad_value': 170}
+
+def load_case(name, luna_segment, luna_data):
+    """ Stage 1 (I/O): read the lung mask and the CT, flips already applied. """
+    with step('read_mask'):
+        Mask, _, mask_spacing, mask_isflip = load_itk_image(os.path.join(luna_segment, name+'.mhd'))
+    if mask_isflip:
         Mask = Mask[:,::-1,::-1]
+    with step('read_ct'):
+        sliceim, origin, spacing, isflip = load_itk_image(os.path.join(luna_data, name+'.mhd'))
+    if isflip:
+        sliceim = sliceim[:,::-1,::-1]
+        print('{}: flip!'.format(name))
+    return {'name': name, 'Mask': Mask, 'mask_spacing': mask_spacing, 'sliceim': sliceim,
+            'origin': origin, 'spacing': spacing, 'isflip': isflip}
+
+def clean_case(case, params=PARAMS):
+    """ Stage 2 (CPU): extendbox from the mask, lung mask post-processing, intensity window and bone removal. """
+    resolution = np.array(params['resolution'])
+    Mask = case.pop('Mask')
+    spacing = case['mask_spacing']
     newshape = np.round(np.array(Mask.shape)*spacing/resolution).astype('int')
     m1 = Mask==3
     m2 = Mask==4
     Mask = m1+m2
-    
-    xx,yy,zz= np.where(Mask)
-    box = np.array([[np.min(xx),np.max(xx)],[np.min(yy),np.max(yy)],[np.min(zz),np.max(zz)]])
+
+    box = np.stack(mask_bbox(Mask), axis=1)
     box = box*np.expand_dims(spacing,1)/np.expand_dims(resolution,1)
     box = np.floor(box).astype('int')
-    margin = 5
+    margin = params['margin']
     extendbox = np.vstack([np.max([[0,0,0],box[:,0]-margin],0),np.min([newshape,box[:,1]+2*margin],axis=0).T]).T
 
-
-    if isClean:
+    with step('process_mask'):
         dm1 = process_mask(m1)
         dm2 = process_mask(m2)
         dilatedMask = dm1 + dm2
-        Mask = m1 + m2
-        extramask = dilatedMask ^ Mask  # '-' substration is deprecated in numpy, use '^'
-        bone_thresh = 210
-        pad_value = 170
+    bone_thresh = params['bone_thresh']
+    pad_value = params['pad_value']
 
-        sliceim, origin, spacing, isflip = load_itk_image(os.path.join(luna_data, name+'.mhd'))
-        if isflip:
-            sliceim = sliceim[:,::-1,::-1]
-            print('{}: flip!'.format(name))
-        sliceim = lumTrans(sliceim)
-        sliceim = sliceim*dilatedMask+pad_value*(1-dilatedMask).astype('uint8')
-        bones = (sliceim*extramask)>bone_thresh
-        sliceim[bones] = pad_value
-        
-        sliceim1,_ = resample(sliceim,spacing,resolution,order=1)
-        sliceim2 = sliceim1[extendbox[0,0]:extendbox[0,1],
-                            extendbox[1,0]:extendbox[1,1],
-                            extendbox[2,0]:extendbox[2,1]]
-        sliceim = sliceim2[np.newaxis,...]
-
-        np.save(os.path.join(savepath, name + '_clean.npy'),sliceim)
-
-        np.save(os.path.join(savepath, name+'_spacing.npy'), spacing)
-        np.save(os.path.join(savepath, name+'_extendbox.npy'), extendbox)
-        np.save(os.path.join(savepath, name+'_origin.npy'), origin)
-        np.save(os.path.join(savepath, name+'_mask.npy'), Mask)
-
-
-    if islabel:
-        this_annos = np.copy(annos[annos[:,0] == name])
-        label = []
-
-        if len(this_annos)>0:
-            for c in this_annos:   # unit in mm  -->  voxel
-                pos = worldToVoxelCoord(c[1:4][::-1], origin=origin, spacing=spacing)  # (z,y,x)
-                if isflip:
-                    pos[1:] = Mask.shape[1:3] - pos[1:]   # flip in y and x coordinates
-                d = c[4]/spacing[1]
-                try:
-                    malignancy = int(c[5])
-                except IndexError:
-                    malignancy = 0
-                # label.append(np.concatenate([pos,[d],[malignancy]]))  # (z,y,x,d,malignancy)
-                label.append(np.concatenate([pos,[d]]))  # (z,y,x,d)
-            
-        label = np.array(label)
-
-        # Voxel --> resample to (1mm,1mm,1mm) voxel coordinate
-        if len(label)==0:
-            # label2 = np.array([[0,0,0,0,0]])
-            label2 = np.array([[0,0,0,0]])
+    with step('fuse_intensity'):   # lumTrans, padding and bone removal
+        sliceim = fuse_intensity(case.pop('sliceim'), dilatedMask, Mask, pad_value, bone_thresh)
+
+    case.update({'sliceim': sliceim, 'Mask': Mask, 'extendbox': extendbox, 'pad_value': pad_value})
+    return case
+
+def downsample2(img):
+    """ Halve a (C, Z, Y, X) volume: [1/4, 1/2, 1/4] smoothing then every other voxel, along each axis.
+
+    Voxel i of the result is centred on voxel 2*i of img, so coordinates and sizes simply scale by 1/2.
+    """
+    out = img.astype(np.float32)
+    for axis in range(1, 4):
+        out = correlate1d(out, [0.25, 0.5, 0.25], axis=axis, mode='nearest')
+        out = out[(slice(None),) * axis + (slice(None, None, 2),)]
+    if np.issubdtype(img.dtype, np.integer):
+        out = np.round(out)
+    return out.astype(img.dtype)
+
+def resample_case(case, params=PARAMS, backend='scipy_slab', workers=1, slab=32, pyramid_levels=0):
+    """ Stage 3 (CPU): resample to params['resolution'], only the voxels inside extendbox.
+
+    pyramid_levels: also make that many coarser levels (2x, 4x, ... the resolution) of the volume.
+    """
+    resolution = np.array(params['resolution'])
+    extendbox = case['extendbox']
+    with step('resample'):
+        sliceim,_ = resample_box(case.pop('sliceim'),case['spacing'],resolution,extendbox,order=1,
+                                 backend=backend,workers=workers,slab=slab)
+    case['sliceim'] = sliceim[np.newaxis,...]
+    case['pyramid'] = []
+    with step('pyramid'):
+        for level in range(pyramid_levels):
+            case['pyramid'].append(downsample2(case['pyramid'][-1] if case['pyramid'] else case['sliceim']))
+    return case
+
+def make_label(name, annos, origin, spacing, isflip, mask_shape, extendbox, resolution=np.array([1, 1, 1])):
+    """ World coordinates of the annotations -> (z,y,x,d) in the voxels of id_clean """
+    this_annos = np.copy(annos[annos[:,0] == name])
+    label = []
+
+    if len(this_annos)>0:
+        for c in this_annos:   # unit in mm  -->  voxel
+            pos = worldToVoxelCoord(c[1:4][::-1], origin=origin, spacing=spacing)  # (z,y,x)
+            if isflip:
+                pos[1:] = mask_shape[1:3] - pos[1:]   # flip in y and x coordinates
+            d = c[4]/spacing[1]
+            try:
+                malignancy = int(c[5])
+            except IndexError:
+                malignancy = 0
+            # label.append(np.concatenate([pos,[d],[malignancy]]))  # (z,y,x,d,malignancy)
+            label.append(np.concatenate([pos,[d]]))  # (z,y,x,d)
+
+    label = np.array(label)
+
+    # Voxel --> resample to (1mm,1mm,1mm) voxel coordinate
+    if len(label)==0:
+        # label2 = np.array([[0,0,0,0,0]])
+        label2 = np.array([[0,0,0,0]])
+    else:
+        label2 = np.copy(label).T
+        label2[:3] = label2[:3]*np.expand_dims(spacing,1)/np.expand_dims(resolution,1)
+        label2[3] = label2[3]*spacing[1]/resolution[1]
+        label2[:3] = label2[:3]-np.expand_dims(extendbox[:,0],1)
+        # label2 = label2[:5].T   #(z,y,x,d,malignancy)
+        label2 = label2[:4].T   #(z,y,x,d)
+    return label2
+
+def case_meta(case, label, resolution):
+    """ Entry of the case in case_index.npz, JSON-serializable so that it can be kept in the manifest """
+    return {'spacing': case['spacing'].tolist(), 'origin': case['origin'].tolist(), 'resolution': list(resolution),
+            'extendbox': case['extendbox'].tolist(), 'shape': list(case['sliceim'].shape[1:]),
+            'mask_shape': list(case['Mask'].shape), 'isflip': bool(case['isflip']),
+            'label': np.asarray(label, np.float64).tolist()}
+
+def write_case(case, annos, savepath, volume_format='npy', params=PARAMS, volume_codec='raw'):
+    """ Stage 4 (I/O): write the volumes atomically.
+
+    volume_codec: with a codec other than 'raw' (see volume_store.CODECS) id_clean and id_mask are both
+    written as compressed chunked volumes, the mask bit-packed.
+    id_clean is always chunked when the case has a pyramid (see resample_case), its levels go in the same file.
+    Returns ({filename: {'sha1', 'size'}}, meta), meta goes to case_index.npz (see case_meta).
+    """
+    name = case['name']
+    label = make_label(name, annos, case['origin'], case['spacing'], case['isflip'],
+                       case['Mask'].shape, case['extendbox'], np.array(params['resolution']))
+    outputs = {}
+    pyramid = case.get('pyramid', [])
+    for suffix, array, fill_value, chunked, levels in [
+            ('_mask', case['Mask'], False, volume_codec != 'raw', []),
+            ('_clean', case['sliceim'], case['pad_value'], volume_format == 'chunked' or volume_codec != 'raw' or pyramid, pyramid)]:
+        with step('save' + suffix):
+            if chunked:
+                filename, stale = name + suffix + VOLUME_EXT, name + suffix + '.npy'
+                atomic_write(os.path.join(savepath, filename),
+                             lambda tmp: save_chunked(tmp, array, fill_value=fill_value, codec=volume_codec, pyramid=levels))
+            else:
+                filename, stale = name + suffix + '.npy', name + suffix + VOLUME_EXT
+                atomic_save(os.path.join(savepath, filename), array)
+        # a copy in the other format would shadow / duplicate this one, see volume_store.load_volume
+        if os.path.exists(os.path.join(savepath, stale)):
+            os.remove(os.path.join(savepath, stale))
+        outputs[filename] = None
+    with step('checksum'):
+        for filename in outputs:
+            path = os.path.join(savepath, filename)
+            outputs[filename] = {'sha1': sha1sum(path), 'size': os.path.getsize(path)}
+    return outputs, case_meta(case, label, params['resolution'])
+
+def savenpy_luna(id, annos, filelist, luna_segment, luna_data, savepath, volume_format='npy', volume_codec='raw',
+                 pyramid_levels=0, params=PARAMS):
+    """
+    Note: Dr. Chen adds malignancy label, so the label becomes (z,y,x,d,malignancy), <- but I cancelled it !
+    volume_format: 'npy' writes id_clean.npy, 'chunked' writes id_clean.vol (see volume_store.py)
+    volume_codec: compress id_clean.vol / id_mask.vol, see write_case
+    pyramid_levels: number of coarser levels (2 mm, 4 mm, ...) stored in id_clean.vol, see resample_case
+    params: PARAMS, e.g. with another 'resolution' (target spacing in mm, z y x)
+    Returns (outputs, meta) of write_case, meta is not written anywhere by this function.
+    """
+    name = filelist[id]
+    with StageProbe() as probe:
+        case = load_case(name, luna_segment, luna_data)
+        case = clean_case(case, params)
+        case = resample_case(case, params, pyramid_levels=pyramid_levels)
+        result = write_case(case, annos, savepath, volume_format, params, volume_codec)
+    print('{} is done in {:.1f}s ({}).'.format(name, probe.seconds, ', '.join(
+        '{} {:.1f}s'.format(s, v['seconds']) for s, v in probe.steps.items())))
+    return result
+
+def write_case_index(manifest, savepath):
+    """ Collect the metadata of every finished case of the manifest into savepath/case_index.npz """
+    index = CaseIndex()
+    for name, entry in manifest.entries.items():
+        if entry.get('status') == 'done' and 'meta' in entry:
+            index.update(name, entry['meta'])
+    index.save(index_path(savepath))
+    return index
+
+def mhd_files(filename):
+    """ The .mhd header and the pixel data file it points to """
+    data_file = read_mhd_header(filename)['data_file']
+    return [filename] if data_file == os.path.abspath(filename) else [filename, data_file]
+
+def input_checksums(files, cache=None):
+    """ {path: {'size', 'mtime_ns', 'sha1'}}, the sha1 is reused from cache while size and mtime are unchanged """
+    cache = cache or {}
+    checksums = {}
+    for path in files:
+        st = os.stat(path)
+        old = cache.get(path)
+        if old is not None and old['size'] == st.st_size and old['mtime_ns'] == st.st_mtime_ns:
+            checksums[path] = old
         else:
-            label2 = np.copy(label).T
-            label2[:3] = label2[:3]*np.expand_dims(spacing,1)/np.expand_dims(resolution,1)
-            label2[3] = label2[3]*spacing[1]/resolution[1]
-            label2[:3] = label2[:3]-np.expand_dims(extendbox[:,0],1)
-            # label2 = label2[:5].T   #(z,y,x,d,malignancy)
-            label2 = label2[:4].T   #(z,y,x,d)
-
-        np.save(os.path.join(savepath, name+'_label.npy'), label2)
-        
-    print('{} is done.'.format(name))
-
-def preprocess_luna():
+            checksums[path] = {'size': st.st_size, 'mtime_ns': st.st_mtime_ns, 'sha1': sha1sum(path)}
+    return checksums
+
+def _digest(obj):
+    return hashlib.sha1(json.dumps(obj, sort_keys=True, default=str).encode('utf-8')).hexdigest()
+
+def case_fingerprints(name, annos, luna_segment, luna_data, params, cache=None):
+    """ (inputs, volume_fp, label_fp) of a case.
+
+    volume_fp covers the CT and mask files and params, i.e. everything id_clean / id_mask depend on.
+    label_fp covers the annotation rows of the case (plus volume_fp, labels live in id_clean voxels).
+    """
+    files = mhd_files(os.path.join(luna_data, name+'.mhd')) + mhd_files(os.path.join(luna_segment, name+'.mhd'))
+    inputs = input_checksums(files, cache)
+    volume_fp = _digest([[inputs[f]['sha1'] for f in files], params])
+    label_fp = _digest([volume_fp, annos[annos[:,0] == name].tolist()])
+    return inputs, volume_fp, label_fp
+
+def relabel_case(name, meta, annos, params=PARAMS):
+    """ New label rows for a case whose annotations changed, from the metadata of its last run """
+    meta = dict(meta)
+    meta['label'] = make_label(name, annos, np.array(meta['origin']), np.array(meta['spacing']), meta['isflip'],
+                               np.array(meta['mask_shape']), np.array(meta['extendbox']),
+                               np.array(meta.get('resolution', params['resolution']))).tolist()
+    return meta
+
+def _payload_mb(payload):
+    if isinstance(payload, dict):
+        return sum(v.nbytes for v in payload.values() if isinstance(v, np.ndarray)) / 1024. ** 2
+    return 0.
+
+def _timed(measure_rss, fn, *args, **kwargs):
+    """ (result, seconds, peak MB, steps) of fn(*args, **kwargs), steps: see telemetry.step.
+
+    With measure_rss (process workers, one case at a time) the peak is the memory of the case in the worker:
+    the arrays it was sent plus the peak RSS growth while running. Otherwise (thread stages, in the main process
+    with the others) the RSS growth is sampled, see telemetry.py.
+    """
+    with StageProbe(measure_rss, _payload_mb(args[0]), sample_rss=not measure_rss) as probe:
+        result = fn(*args, **kwargs)
+    return result, probe.seconds, probe.peak, probe.steps
+
+# Peak memory of a case in bytes per voxel of the CT and per voxel of the resampled volume (upper bound:
+# the whole CT resampled), measured on a 200x512x512 scan: load peaks at ~7 B/voxel, the mask stage at ~11 B/voxel
+# with its input. Scaled at run time by the peaks recorded in the manifest, see memory_scale.
+MEMORY_MODEL = {'ct_voxel': 12., 'out_voxel': 2., 'base_mb': 50.}
+
+def estimate_case_memory(name, luna_data, params=PARAMS, model=MEMORY_MODEL):
+    """ Estimated peak MB of a case, from its MHD header only """
+    header = read_mhd_header(os.path.join(luna_data, name+'.mhd'))
+    n_ct = float(np.prod(header['dims']))
+    n_out = n_ct * np.prod(header['spacing'] / np.array(params['resolution'], float))
+    itemsize = header['dtype'].itemsize / 2.   # the model is for int16 CTs
+    return model['base_mb'] + (model['ct_voxel'] * itemsize * n_ct + model['out_voxel'] * n_out) / 1024. ** 2
+
+def memory_scale(manifest, min_cases=3):
+    """ Recorded peak / estimated memory summed over the finished cases of the manifest (1 if too few).
+
+    Sums rather than a per-case ratio, so that the large cases, the ones that matter for the budget, dominate.
+    """
+    pairs = [(max(e['peak_rss_mb'].values()), e['mem_estimate_mb']) for e in manifest.entries.values()
+             if e.get('status') == 'done' and e.get('peak_rss_mb') and e.get('mem_estimate_mb')]
+    if len(pairs) < min_cases:
+        return 1.
+    peaks, estimates = zip(*pairs)
+    return sum(peaks) / sum(estimates)
+
+def total_memory_mb():
+    try:
+        return os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES') / 1024. ** 2
+    except (ValueError, OSError, AttributeError):
+        return None
+
+# (stage name, function, pool kind) in pipeline order
+STAGES = [('load', load_case, 'thread'),
+          ('mask', clean_case, 'process'),
+          ('resample', resample_case, 'process'),
+          ('write', write_case, 'thread')]
+
+def final_pass(savepath, names, fingerprints):
+    """ Merge the worker manifests into manifest.json, checksum the outputs of every case and write case_index.npz.
+
+    Returns the cases that are not done with their current fingerprint or whose outputs do not match,
+    None when another worker already ran the final pass.
+    """
+    manifest = Manifest(savepath)
+    if not Manifest.worker_files(savepath):
+        return None   # already done by another worker
+    bad = [n for n in names if not (manifest.is_done(n, verify=True) and 'meta' in manifest.get(n)
+                                    and manifest.get(n).get('volume_fp') == fingerprints[n][1])]
+    manifest.save()
+    for path in Manifest.worker_files(savepath):
+        os.remove(path)
+    index = write_case_index(manifest, savepath)
+    print('final pass: {} cases in {}, {} cases missing or invalid'.format(len(index), index_path(savepath), len(bad)))
+    return bad
+
+def preprocess_luna(workers=None, max_inflight=None, verify=False, resample_backend='scipy_slab', resample_threads=1,
+                    mem_budget=None, worker=False, lease_timeout=600.):
+    """ Run the stages of every case through their own worker pools.
+
+    workers: {stage: number of workers}, see STAGES. resample_backend / resample_threads: see resample.
+    mem_budget: MB the cases in flight may use together (default: config 'mem_budget_gb', else 75% of the RAM).
+    Cases are started largest first, as long as their estimated peak memory (estimate_case_memory, scaled by
+    memory_scale) fits in what is left of the budget; a case larger than the whole budget runs alone.
+    The measured peak of each stage is kept in the manifest ('peak_rss_mb') to calibrate the estimates.
+    Every stage run is also logged with the time / peak of its steps to savepath/telemetry.jsonl, see telemetry.py.
+    Progress of each case is kept in savepath/manifest.json. A case is only processed again when it is not
+    recorded as done or when its fingerprint changed (input files, PARAMS, resolution / volume_format / volume_codec / pyramid_levels); when only its
+    annotations changed, just its labels in case_index.npz are recomputed.
+
+    worker: run as one of several workers (possibly on several nodes) sharing savepath, without a coordinator.
+    Cases are claimed through lease files (see preprocess_manifest.Leases), leases not renewed for lease_timeout
+    seconds are taken over, and the last worker to finish runs final_pass.
+    """
     luna_segment = config['luna_segment']
     savepath = config['preprocess_result_path']
     luna_data = config['luna_data']
     luna_label = config['luna_label']
+    volume_format = config.get('volume_format', 'npy')
+    volume_codec = config.get('volume_codec', 'raw')
+    pyramid_levels = config.get('pyramid_levels', 0)
+    case_params = dict(PARAMS, resolution=list(config.get('resolution', PARAMS['resolution'])))
     finished_flag = '.flag_preprocess_luna'
+    workers = dict({'load': 2, 'mask': 4, 'resample': 4, 'write': 2}, **(workers or {}))
+    if max_inflight is None:
+        max_inflight = sum(workers.values())
+    if mem_budget is None and config.get('mem_budget_gb'):
+        mem_budget = config['mem_budget_gb'] * 1024.
+    if mem_budget is None:
+        mem_budget = 0.75 * (total_memory_mb() or float('inf'))
 
     print('starting preprocessing luna')
-    
-    if True:
-        exist_files = {f.split('_clean.npy')[0] for f in os.listdir(savepath) if f.endswith('_clean.npy')}
-        filelist = {f.split('.mhd')[0] for f in os.listdir(luna_data) if f.endswith('.mhd')}
-        filelist = list(filelist - exist_files)
-        annos = np.array(pandas.read_csv(luna_label))
-
-        if not os.path.isdir(savepath):
-            os.mkdir(savepath)
-
-        with concurrent.futures.ProcessPoolExecutor(max_workers=4) as executor:
-            futures = {executor.submit(savenpy_luna, f, annos=annos, filelist=filelist,
-                                       luna_segment=luna_segment, luna_data=luna_data, savepath=savepath):f for f in range(len(filelist))}
-            for future in concurrent.futures.as_completed(futures):
-                filename = filelist[futures[future]]
-                try:
-                    _ = future.result()
-                except:
-                    print('{} failed.'.format(filename))
 
+    os.makedirs(savepath, exist_ok=True)
+    leases = None
+    if worker:
+        leases = Leases(savepath, worker_id(), lease_timeout)
+        print('worker {}'.format(leases.worker))
+    manifest = Manifest(savepath, leases and leases.worker)
+    telemetry = TelemetryLog(savepath, leases and leases.worker)
+    allfiles = sorted(f.split('.mhd')[0] for f in os.listdir(luna_data) if f.endswith('.mhd'))
+    annos = np.array(pandas.read_csv(luna_label))
+    params = dict(case_params, volume_format=volume_format, volume_codec=volume_codec, pyramid_levels=pyramid_levels,
+                  resample_backend=resample_backend)
 
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers['load']) as executor:
+        fingerprints = dict(zip(allfiles, executor.map(
+            lambda f: case_fingerprints(f, annos, luna_segment, luna_data, params, manifest.get(f).get('inputs')),
+            allfiles)))
+    filelist = []
+    relabel = []
+    for f in allfiles:
+        inputs, volume_fp, label_fp = fingerprints[f]
+        entry = manifest.get(f)
+        if not (manifest.is_done(f, verify=verify) and 'meta' in entry and entry.get('volume_fp') == volume_fp):
+            filelist.append(f)
+        elif entry.get('label_fp') != label_fp:
+            relabel.append(f)
+    print('{} cases to process, {} cases to relabel'.format(len(filelist), len(relabel)))
+
+    for name in relabel:
+        inputs, volume_fp, label_fp = fingerprints[name]
+        manifest.update(name, meta=relabel_case(name, manifest.get(name)['meta'], annos, case_params), label_fp=label_fp)
+
+    scale = memory_scale(manifest)
+    estimates = {f: estimate_case_memory(f, luna_data, case_params) for f in filelist}
+    print('memory budget {:.0f} MB, estimates scaled by {:.2f}'.format(mem_budget, scale))
+    for f in filelist:
+        if estimates[f] * scale > mem_budget:
+            print('{}: estimated {:.0f} MB, more than the budget, it will run alone'.format(f, estimates[f] * scale))
+
+    pools = {}
+    for stage, _, kind in STAGES:
+        executor = concurrent.futures.ThreadPoolExecutor if kind == 'thread' else concurrent.futures.ProcessPoolExecutor
+        pools[stage] = executor(max_workers=workers[stage])
+    stage_args = {'load': lambda name: (name, luna_segment, luna_data),
+                  'mask': lambda case: (case, case_params),
+                  'resample': lambda case: (case, case_params, resample_backend, resample_threads, 32, pyramid_levels),
+                  'write': lambda case: (case, annos, savepath, volume_format, case_params, volume_codec)}
+
+    def submit(i_stage, name, payload):
+        stage, fn, kind = STAGES[i_stage]
+        future = pools[stage].submit(_timed, kind == 'process', fn, *stage_args[stage](payload))
+        running[future] = (i_stage, name, pools[stage])
+
+    todo = sorted(filelist, key=lambda f: -estimates[f])
+    running = {}
+    inflight = {}  # name: estimated MB
+    waiting = []   # leased by other workers
+    claimed = []
+    try:
+        while todo or running or waiting:
+            # Largest case that fits in the rest of the budget, at most max_inflight cases in memory
+            while todo and len(inflight) < max_inflight:
+                free = mem_budget - sum(inflight.values())
+                fits = [f for f in todo if estimates[f] * scale <= free]
+                if not fits and inflight:
+                    break
+                name = fits[0] if fits else todo[0]
+                todo.remove(name)
+                if leases is not None and not leases.claim(name, fingerprints[name][1]):
+                    if not leases.is_done(name, fingerprints[name][1]):
+                        waiting.append(name)
+                    continue
+                claimed.append(name)
+                inflight[name] = estimates[name] * scale
+                manifest.update(name, status='running', error=None, mem_estimate_mb=estimates[name], peak_rss_mb={})
+                submit(0, name, name)
+            if not running:
+                # Only cases leased by other workers are left: wait until they are done or their leases go stale
+                time.sleep(min(30., lease_timeout / 4.))
+                todo, waiting = waiting, []
+                continue
+            done, _ = concurrent.futures.wait(running, return_when=concurrent.futures.FIRST_COMPLETED)
+            for future in done:
+                i_stage, name, pool = running.pop(future)
+                stage = STAGES[i_stage][0]
+                try:
+                    result, elapsed, peak, steps = future.result()
+                except Exception as e:
+                    if isinstance(e, BrokenProcessPool):
+                        # A worker died (typically OOM-killed): every case in that pool fails, start a fresh pool
+                        e = 'worker process died, out of memory? (estimated {:.0f} MB)'.format(inflight[name])
+                        if pools[stage] is pool:
+                            pool.shutdown(wait=False)
+                            pools[stage] = concurrent.futures.ProcessPoolExecutor(max_workers=workers[stage])
+                    print('{} failed at {}: {}'.format(name, stage, e))
+                    manifest.update(name, status='failed', error=traceback.format_exc())
+                    telemetry.write(name, stage, status='failed', error=str(e), estimate_mb=estimates[name])
+                    inflight.pop(name)
+                    if leases is not None:
+                        leases.release(name)
+                    continue
+                telemetry.write(name, stage, status='done', seconds=elapsed, peak_rss_mb=peak, steps=steps,
+                                rss_sampled=STAGES[i_stage][2] == 'thread', estimate_mb=estimates[name])
+                peaks = dict(manifest.get(name).get('peak_rss_mb', {}))
+                if peak is not None and STAGES[i_stage][2] == 'process':
+                    # the sampled peaks of the thread stages also count the other cases, memory_scale leaves them out
+                    peaks[stage] = round(peak, 1)
+                if i_stage + 1 < len(STAGES):
+                    manifest.update(name, timings={stage: elapsed}, peak_rss_mb=peaks)
+                    submit(i_stage + 1, name, result)
+                else:
+                    outputs, meta = result
+                    inputs, volume_fp, label_fp = fingerprints[name]
+                    manifest.update(name, status='done', timings={stage: elapsed}, outputs=outputs, meta=meta,
+                                    inputs=inputs, volume_fp=volume_fp, label_fp=label_fp, peak_rss_mb=peaks)
+                    inflight.pop(name)
+                    if leases is not None:
+                        leases.release(name, volume_fp)
+                    print('{} is done.'.format(name))
+    finally:
+        for pool in pools.values():
+            pool.shutdown()
+        if leases is not None:
+            leases.close()
+        else:
+            index = write_case_index(manifest, savepath)
+            print('{} cases in {}'.format(len(index), index_path(savepath)))
+
+    failed = [f for f in claimed if manifest.get(f).get('status') != 'done']
+    if failed:
+        print('{} cases failed, see {}: {}'.format(len(failed), manifest.path, ' '.join(failed)))
+    if leases is not None and not leases.active() and leases.try_lock('final_pass'):
+        try:
+            bad = final_pass(savepath, allfiles, fingerprints)
+        finally:
+            leases.unlock('final_pass')
+        if bad:
+            print('missing or invalid after the final pass: {}'.format(' '.join(bad)))
     print('end preprocessing luna')
     f = open(finished_flag,"w+")
     f.close()
     return
-    
 
-if __name__=='__main__':    
+
+if __name__=='__main__':
+    parser = argparse.ArgumentParser(description='LUNA16 preprocessing')
+    parser.add_argument('--cluster', action='store_true', default=False,
+                        help='use config_cluster from config_training')
+    for stage, _, kind in STAGES:
+        parser.add_argument('--{}-workers'.format(stage), default=None, type=int, metavar='N',
+                            help='number of {} workers for the {} stage'.format(kind, stage))
+    parser.add_argument('-j', '--workers', default=None, type=int, metavar='N',
+                        help='number of workers for the CPU stages (mask, resample)')
+    parser.add_argument('--max-inflight', default=None, type=int, metavar='N',
+                        help='max number of cases held in memory at once')
+    parser.add_argument('--resample-backend', default='scipy_slab', choices=RESAMPLE_BACKENDS,
+                        help='interpolation backend of the resample stage')
+    parser.add_argument('--resample-threads', default=1, type=int, metavar='N',
+                        help='threads per case in the resample stage (slab backends)')
+    parser.add_argument('--mem-budget', default=None, type=float, metavar='GB',
+                        help='memory the cases in flight may use together (default: 75%% of the RAM)')
+    parser.add_argument('--worker', action='store_true', default=False,
+                        help='run as one of several workers sharing the output directory (one per node)')
+    parser.add_argument('--lease-timeout', default=600., type=float, metavar='S',
+                        help='seconds after which the lease of a silent worker is taken over (with --worker)')
+    parser.add_argument('--verify', action='store_true', default=False,
+                        help='also check the checksums of finished cases before skipping them')
+    args = parser.parse_args()
+
+    if args.cluster:
+        config.update(config_cluster)
+    workers = {}
+    for stage, _, kind in STAGES:
+        n = getattr(args, '{}_workers'.format(stage))
+        if n is None and kind == 'process':
+            n = args.workers
+        if n is not None:
+            workers[stage] = n
+
     # Pre-process LUNA16 MHD files
-    preprocess_luna()
+    preprocess_luna(workers=workers, max_inflight=args.max_inflight, verify=args.verify,
+                    resample_backend=args.resample_backend, resample_threads=args.resample_threads,
+                    mem_budget=None if args.mem_budget is None else args.mem_budget * 1024.,
+                    worker=args.worker, lease_timeout=args.lease_timeout)
@@ -0,0 +1,221 @@
+#!/usr/bin/python3
+#coding=utf-8
+
+import os
+import json
+import time
+import glob
+import socket
+import hashlib
+import threading
+import numpy as np
+
+
+def sha1sum(filename, blocksize=1 << 20):
+    h = hashlib.sha1()
+    with open(filename, 'rb') as f:
+        for block in iter(lambda: f.read(blocksize), b''):
+            h.update(block)
+    return h.hexdigest()
+
+
+def atomic_write(filename, write_fn):
+    """ Call write_fn(tmp_filename), fsync it and rename it onto filename.
+
+    A crash in the middle of writing leaves only a `.tmp` file behind, never a truncated output.
+    """
+    tmp = '{}.tmp.{}'.format(filename, os.getpid())
+    try:
+        write_fn(tmp)
+        with open(tmp, 'rb+') as f:
+            os.fsync(f.fileno())
+        os.replace(tmp, filename)
+    finally:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+
+
+def atomic_save(filename, array):
+    """ np.save through atomic_write, the file name is kept as given. """
+    def write(tmp):
+        with open(tmp, 'wb') as f:
+            np.save(f, array)
+    atomic_write(filename, write)
+
+
+class Manifest(object):
+    """ Per-case status of a preprocessing run, kept as JSON next to the outputs.
+
+    entries[name] = {'status': 'running' | 'done' | 'failed',
+                     'timings': {stage: seconds},
+                     'outputs': {filename: {'sha1': ..., 'size': ...}},
+                     'meta': case metadata / labels, see case_index.py,
+                     'inputs', 'volume_fp', 'label_fp': see prepare.case_fingerprints,
+                     'error': traceback of the last failure,
+                     'updated': unix time}
+
+    With `worker`, updates go to manifest.<worker>.json so that workers on several nodes never write the
+    same file. Loading always merges manifest.json and every manifest.<worker>.json, newest entry first.
+    """
+    FILENAME = 'manifest.json'
+
+    def __init__(self, savepath, worker=None):
+        self.path = os.path.join(savepath, self.FILENAME if worker is None else 'manifest.{}.json'.format(worker))
+        self.savepath = savepath
+        self.lock = threading.Lock()
+        self.entries = {}
+        for path in [os.path.join(savepath, self.FILENAME)] + self.worker_files(savepath):
+            if not os.path.exists(path):
+                continue
+            with open(path, 'rt', encoding='utf-8') as fp:
+                for name, entry in json.load(fp).items():
+                    if entry.get('updated', 0) >= self.entries.get(name, {}).get('updated', 0):
+                        self.entries[name] = entry
+
+    @staticmethod
+    def worker_files(savepath):
+        return sorted(glob.glob(os.path.join(savepath, 'manifest.*.json')))
+
+    def get(self, name):
+        return self.entries.get(name, {})
+
+    def is_done(self, name, verify=False):
+        """ Done means: recorded as done and every recorded output is on disk with the recorded size (and checksum). """
+        entry = self.entries.get(name)
+        if entry is None or entry.get('status') != 'done':
+            return False
+        for filename, info in entry.get('outputs', {}).items():
+            path = os.path.join(self.savepath, filename)
+            if not os.path.exists(path) or os.path.getsize(path) != info['size']:
+                return False
+            if verify and sha1sum(path) != info['sha1']:
+                return False
+        return True
+
+    def update(self, name, **fields):
+        with self.lock:
+            entry = self.entries.setdefault(name, {'timings': {}, 'outputs': {}})
+            for key, value in fields.items():
+                if key == 'timings':
+                    entry[key].update(value)
+                else:
+                    entry[key] = value
+            entry['updated'] = time.time()
+            self.save()
+
+    def save(self):
+        def write(tmp):
+            with open(tmp, 'wt', encoding='utf-8') as fp:
+                json.dump(self.entries, fp, indent=1, sort_keys=True)
+        atomic_write(self.path, write)
+
+
+def worker_id():
+    return '{}-{}'.format(socket.gethostname(), os.getpid())
+
+
+class Leases(object):
+    """ Coordinator-free claiming of cases by workers sharing savepath (e.g. on lustre).
+
+    savepath/leases/<name>.lease is created with O_EXCL by the worker processing the case, and touched every
+    timeout / 4 seconds while it does. A lease not touched for `timeout` seconds belongs to a crashed worker and
+    is taken over. savepath/leases/<name>.done holds the volume fingerprint of the finished case.
+    """
+    def __init__(self, savepath, worker, timeout=600.):
+        self.dir = os.path.join(savepath, 'leases')
+        self.worker = worker
+        self.timeout = timeout
+        self.held = set()
+        self.lock = threading.Lock()
+        os.makedirs(self.dir, exist_ok=True)
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._heartbeat, daemon=True)
+        self._thread.start()
+
+    def _path(self, name, suffix='.lease'):
+        return os.path.join(self.dir, name + suffix)
+
+    def is_done(self, name, fingerprint):
+        try:
+            with open(self._path(name, '.done'), 'rt') as f:
+                return f.read() == fingerprint
+        except OSError:
+            return False
+
+    def claim(self, name, fingerprint):
+        """ True when this worker now holds the lease of a case that is not done yet """
+        if self.is_done(name, fingerprint):
+            return False
+        path = self._path(name)
+        try:
+            if time.time() - os.path.getmtime(path) > self.timeout:
+                # Only one worker wins the rename of a stale lease, the others get an OSError
+                os.rename(path, '{}.stale.{}'.format(path, self.worker))
+                os.remove('{}.stale.{}'.format(path, self.worker))
+                print('{}: reclaimed a stale lease'.format(name))
+        except OSError:
+            pass
+        try:
+            fd = os.open(path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+        except FileExistsError:
+            return False
+        with os.fdopen(fd, 'wt') as f:
+            json.dump({'worker': self.worker, 'time': time.time()}, f)
+        with self.lock:
+            self.held.add(name)
+        if self.is_done(name, fingerprint):
+            # finished by another worker between the check and the claim
+            self.release(name)
+            return False
+        return True
+
+    def release(self, name, fingerprint=None):
+        """ Give the case up, with `fingerprint` it is marked done first """
+        if fingerprint is not None:
+            def write(tmp):
+                with open(tmp, 'wt') as f:
+                    f.write(fingerprint)
+            atomic_write(self._path(name, '.done'), write)
+        with self.lock:
+            self.held.discard(name)
+        try:
+            os.remove(self._path(name))
+        except OSError:
+            pass
+
+    def active(self):
+        """ Names of the cases leased by any worker and not stale """
+        names = []
+        for path in glob.glob(os.path.join(self.dir, '*.lease')):
+            try:
+                if time.time() - os.path.getmtime(path) <= self.timeout:
+                    names.append(os.path.basename(path)[:-len('.lease')])
+            except OSError:
+                pass
+        return names
+
+    def try_lock(self, name):
+        """ One-shot exclusive lock (e.g. for the final pass), False when another worker has it """
+        try:
+            os.close(os.open(self._path(name, '.lock'), os.O_CREAT | os.O_EXCL | os.O_WRONLY))
+            return True
+        except FileExistsError:
+            return False
+
+    def unlock(self, name):
+        os.remove(self._path(name, '.lock'))
+
+    def _heartbeat(self):
+        while not self._stop.wait(self.timeout / 4.):
+            with self.lock:
+                held = list(self.held)
+            for name in held:
+                try:
+                    os.utime(self._path(name))
+                except OSError:
+                    pass
+
+    def close(self):
+        self._stop.set()
+        for name in list(self.held):
+            self.release(name)
@@ -0,0 +1,160 @@
+#!/usr/bin/python3
+#coding=utf-8
+
+"""
+Packed fold shards: the id_clean volumes of a fold in a few large files instead of hundreds of small ones.
+
+preprocess_result_path/shards/<cross>/ holds
+    <split>_<k>.shard   the volume files (.npy or .vol, see volume_store.py) of json/<cross>/LUNA_<split>.json
+                        copied back to back, each starting on a 4 KB boundary
+    shard_index.json    {'id_clean.npy': {'shard', 'offset', 'nbytes', 'kind', ...}}
+
+Volumes are read by (shard, offset) through memory-mapping, cases missing from the index fall back to
+preprocess_result_path, and so do the cases whose volume in preprocess_result_path changed (size / mtime) since
+they were packed. The shards are large sequential files, which lustre serves much better than many small
+files, and a fold can be copied to a node-local disk in one pass.
+
+Usage:
+    python shard_store.py pack --cross 1 [--cluster] [--shard-size 4]
+"""
+
+import os
+import json
+import argparse
+import numpy as np
+from volume_store import ChunkedVolume, chunked_path, load_volume
+
+INDEX_FILENAME = 'shard_index.json'
+SPLITS = ('train', 'val', 'test')
+_ALIGN = 4096
+
+
+def shard_dir(data_dir, cross):
+    return os.path.join(data_dir, 'shards', str(cross))
+
+
+def _source(data_dir, name):
+    """ (path, kind) of the id_clean volume of a case, the chunked copy first like load_volume """
+    path = os.path.join(data_dir, '{}_clean.npy'.format(name))
+    if os.path.exists(chunked_path(path)):
+        return chunked_path(path), 'vol'
+    return path, 'npy'
+
+
+def pack_fold(data_dir, splits, out_dir, shard_size=4 << 30, blocksize=64 << 20):
+    """ Pack the id_clean volumes of splits = {split: [seriesuid]} into out_dir.
+
+    A case listed in several splits (e.g. val and test) is stored once. Returns the index.
+    """
+    from preprocess_manifest import atomic_write
+    os.makedirs(out_dir, exist_ok=True)
+    index = {}
+    for split in SPLITS:
+        names = [n for n in splits.get(split, []) if '{}_clean.npy'.format(n) not in index]
+        k, f, shard, pos = 0, None, None, 0
+        for name in names:
+            path, kind = _source(data_dir, name)
+            nbytes = os.path.getsize(path)
+            if f is None or (pos > 0 and pos + nbytes > shard_size):
+                if f is not None:
+                    f.close()
+                    os.replace(shard + '.tmp', shard)
+                    k += 1
+                shard = os.path.join(out_dir, '{}_{:03d}.shard'.format(split, k))
+                f, pos = open(shard + '.tmp', 'wb'), 0
+            f.write(b'\x00' * ((-pos) % _ALIGN))
+            pos += (-pos) % _ALIGN
+            entry = {'shard': os.path.basename(shard), 'offset': pos, 'nbytes': nbytes, 'kind': kind,
+                     'source_size': nbytes, 'source_mtime': os.path.getmtime(path)}
+            if kind == 'npy':
+                array = np.load(path, mmap_mode='r')
+                entry.update({'offset': pos + array.offset, 'nbytes': array.nbytes, 'shape': list(array.shape),
+                              'dtype': array.dtype.str, 'fortran_order': bool(np.isfortran(array))})
+            with open(path, 'rb') as src:
+                for block in iter(lambda: src.read(blocksize), b''):
+                    f.write(block)
+            pos += nbytes
+            index['{}_clean.npy'.format(name)] = entry
+        if f is not None:
+            f.close()
+            os.replace(shard + '.tmp', shard)
+
+    def write(tmp):
+        with open(tmp, 'wt', encoding='utf-8') as fp:
+            json.dump(index, fp, indent=1, sort_keys=True)
+    atomic_write(os.path.join(out_dir, INDEX_FILENAME), write)
+    return index
+
+
+def _changed(data_dir, filename, entry):
+    """ Whether the source of a packed volume is in data_dir but not the file that was packed """
+    path, kind = _source(data_dir, filename[:-len('_clean.npy')])
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return False
+    return (kind, stat.st_size, stat.st_mtime) != (entry['kind'], entry['source_size'], entry['source_mtime'])
+
+
+class ShardIndex(object):
+    """ Opens volumes from the shards of a fold, by the file name they had in preprocess_result_path.
+
+    data_dir: preprocess_result_path (by default the one out_dir is in, see shard_dir); the packed volumes whose
+    source there is not the one packed any more (re-preprocessed) are left out of the index, they are read from
+    data_dir. Sources that are not there at all (only the shards were copied) are not checked.
+    """
+    def __init__(self, out_dir, data_dir=None):
+        self.dir = out_dir
+        with open(os.path.join(out_dir, INDEX_FILENAME), 'rt', encoding='utf-8') as fp:
+            self.entries = json.load(fp)
+        if data_dir is None:
+            data_dir = os.path.dirname(os.path.dirname(os.path.abspath(out_dir)))
+        self.stale = sorted(f for f, entry in self.entries.items() if _changed(data_dir, f, entry))
+        for filename in self.stale:
+            del self.entries[filename]
+        if self.stale:
+            print('{} volumes changed since they were packed in {}, they are read from {} (pack the fold again): {}'.format(
+                len(self.stale), out_dir, data_dir, ' '.join(self.stale)))
+
+    def __contains__(self, filename):
+        return os.path.basename(filename) in self.entries
+
+    def load_volume(self, filename, resolve=None, level=0):
+        """ Drop-in for volume_store.load_volume: memory-mapped from its shard, or from filename if not packed.
+
+        resolve: maps the path of a shard / volume to the path to read it from (see staging.Staging.resolve)
+        """
+        resolve = resolve or (lambda path: path)
+        entry = self.entries.get(os.path.basename(filename))
+        if entry is None:
+            return load_volume(resolve(filename), level)
+        shard = resolve(os.path.join(self.dir, entry['shard']))
+        if entry['kind'] == 'vol':
+            return ChunkedVolume(shard, offset=entry['offset'], nbytes=entry['nbytes'], level=level)
+        if level:
+            raise ValueError('pyramid level {} needs a chunked volume, {} is npy'.format(level, filename))
+        return np.memmap(shard, dtype=np.dtype(entry['dtype']), mode='r', offset=entry['offset'],
+                         shape=tuple(entry['shape']), order='F' if entry['fortran_order'] else 'C')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Pack the volumes of a fold into shards')
+    subparsers = parser.add_subparsers(dest='command')
+    p = subparsers.add_parser('pack', help='pack json/<cross>/LUNA_{train,val,test}.json')
+    p.add_argument('--cross', required=True, type=str, help='fold, as in main_detector_recon.py --cross')
+    p.add_argument('--cluster', action='store_true', default=False, help='use config_cluster from config_training')
+    p.add_argument('--shard-size', default=4., type=float, metavar='GB', help='max size of a shard')
+    args = parser.parse_args()
+    if args.command is None:
+        parser.print_help()
+    else:
+        from config_training import config, config_cluster
+        data_dir = (config_cluster if args.cluster else config)['preprocess_result_path']
+        splits = {}
+        for split in SPLITS:
+            with open('./json/{}/LUNA_{}.json'.format(args.cross, split), 'rt', encoding='utf-8') as fp:
+                splits[split] = json.load(fp)
+        out_dir = shard_dir(data_dir, args.cross)
+        index = pack_fold(data_dir, splits, out_dir, int(args.shard_size * (1 << 30)))
+        n_shards = len({e['shard'] for e in index.values()})
+        print('{} volumes in {} shards in {}'.format(len(index), n_shards, out_dir))
@@ -0,0 +1,124 @@
+#!/usr/bin/python3
+#coding=utf-8
+
+"""
+Node-local staging of the files of a fold (id_clean volumes or shards).
+
+Staging copies (or hard-links, when on the same filesystem) the files to stage_dir in a background thread.
+Until a file is staged, resolve() returns its remote path, so training starts right away. A staged copy is
+reused when its size and mtime still match the remote file, so several jobs on one node share the copy in
+stage_dir/<hash of the remote directory>/, with a lock file per file so that each file is copied once.
+The remote files are only stat-ed / read by the staging thread, never by resolve(). Which files are staged is
+kept in shared memory, one flag per file, so DataLoader workers (forked or spawned, persistent or not) see the
+files staged after they started.
+"""
+
+import os
+import time
+import shutil
+import fcntl
+import hashlib
+import threading
+import multiprocessing
+from volume_store import chunked_path
+
+
+def fold_files(data_dir, names, shard_dir=None):
+    """ Remote files the loaders of these cases read: the shards and their index, or each id_clean volume """
+    if shard_dir is not None:
+        return sorted(os.path.join(shard_dir, f) for f in os.listdir(shard_dir))
+    files = []
+    for name in names:
+        path = os.path.join(data_dir, '{}_clean.npy'.format(name))
+        files.append(chunked_path(path) if os.path.exists(chunked_path(path)) else path)
+    return files
+
+
+def _fresh(src_stat, dst):
+    try:
+        dst_stat = os.stat(dst)
+    except OSError:
+        return False
+    return (dst_stat.st_size, dst_stat.st_mtime_ns) == (src_stat.st_size, src_stat.st_mtime_ns)
+
+
+def stage_file(src, dst, link=True):
+    """ Make dst an up-to-date copy of src, True when something was copied """
+    with open(dst + '.lock', 'w') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        src_stat = os.stat(src)
+        if _fresh(src_stat, dst):
+            return False
+        tmp = '{}.tmp.{}'.format(dst, os.getpid())
+        try:
+            try:
+                if not link:
+                    raise OSError
+                os.link(src, tmp)
+            except OSError:
+                shutil.copyfile(src, tmp)
+                os.utime(tmp, ns=(src_stat.st_atime_ns, src_stat.st_mtime_ns))
+            os.replace(tmp, dst)   # readers that mapped an older copy keep it until they close it
+        finally:
+            if os.path.exists(tmp):
+                os.remove(tmp)
+        return True
+
+
+class Staging(object):
+    def __init__(self, files, stage_dir, link=True):
+        self.files = list(files)
+        self.stage_dir = stage_dir
+        self.link = link
+        self._index = {os.path.abspath(path): i for i, path in enumerate(self.files)}
+        self._ready = multiprocessing.RawArray('b', max(len(self.files), 1))   # shared with the workers
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def local_path(self, path):
+        remote_dir, name = os.path.split(os.path.abspath(path))
+        return os.path.join(self.stage_dir, hashlib.sha1(remote_dir.encode('utf-8')).hexdigest()[:16], name)
+
+    def _run(self):
+        t = time.time()
+        copied, nbytes = 0, 0
+        for i, path in enumerate(self.files):
+            dst = self.local_path(path)
+            try:
+                os.makedirs(os.path.dirname(dst), exist_ok=True)
+                if stage_file(path, dst, self.link):
+                    copied += 1
+                    nbytes += os.path.getsize(dst)
+            except OSError as e:
+                print('staging {} failed, it is read from the remote path: {}'.format(path, e))
+                continue
+            self._ready[i] = 1
+        print('staging: {} files ready in {}, {} copied ({:.1f} GB) in {:.0f}s'.format(
+            len(self.staged), self.stage_dir, copied, nbytes / 1024. ** 3, time.time() - t))
+
+    @property
+    def staged(self):
+        """ Remote paths of the files staged so far """
+        return {path for path, i in self._index.items() if self._ready[i]}
+
+    def done(self):
+        return self._thread is None or not self._thread.is_alive()
+
+    def wait(self):
+        if self._thread is not None:
+            self._thread.join()
+
+    def resolve(self, path):
+        """ Local copy of path if it is staged (path may be id_clean.npy of a staged id_clean.vol), else path """
+        path = os.path.abspath(path)
+        for staged in (path, chunked_path(path)):
+            i = self._index.get(staged)
+            if i is not None and self._ready[i]:
+                return self.local_path(path)
+        return path
+
+    def __getstate__(self):
+        # spawned DataLoader workers get the shared flags, the thread stays in the main process
+        state = dict(self.__dict__)
+        state['_thread'] = None
+        return state
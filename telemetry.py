@@ -0,0 +1,259 @@
+#!/usr/bin/python3
+#coding=utf-8
+
+"""
+Per-stage telemetry of preprocessing runs.
+
+prepare.preprocess_luna appends one JSON line per stage run of a case to preprocess_result_path/telemetry.jsonl
+(telemetry.<worker>.jsonl with --worker):
+    {'run', 'worker', 'case', 'stage', 'status': 'done' | 'failed', 'time' (unix, end of the stage),
+     'seconds', 'peak_rss_mb', 'rss_sampled', 'estimate_mb', 'steps': {step: {'seconds', 'peak_rss_mb'}}, 'error'}
+Steps are the parts of a stage timed with `step` (e.g. process_mask, fuse_intensity, save_clean). In process
+workers (one case at a time) the peak is the RSS growth of the worker, VmHWM being reset for each step. The thread
+stages (load, write) share the main process, so their peak is sampled: the highest RSS of the process while the
+stage / step ran (polled every RSS_INTERVAL s) less the RSS at its start, which also counts the other thread
+stages running at the same time (an upper bound).
+
+Usage:
+    python telemetry.py summary PREPROCESS_DIR [--top 10] [--all-runs]
+"""
+
+import os
+import glob
+import json
+import time
+import argparse
+import threading
+import contextlib
+import numpy as np
+
+FILENAME = 'telemetry.jsonl'
+RSS_INTERVAL = 0.02
+_local = threading.local()
+
+
+def rss_mb(field='VmRSS'):
+    """ VmRSS / VmHWM (peak) of this process in MB, None where /proc is not available """
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith(field + ':'):
+                    return int(line.split()[1]) / 1024.
+    except OSError:
+        pass
+    return None
+
+
+def reset_peak_rss():
+    # Linux >= 4.0: writing 5 to clear_refs resets VmHWM to the current RSS
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+        return True
+    except OSError:
+        return False
+
+
+class _RSSWatch(object):
+    """ Highest VmRSS of the process from now until stop(), polled by one thread shared by all the watches """
+    _watches = set()
+    _lock = threading.Lock()
+    _thread = None
+
+    def __init__(self):
+        self.max = rss_mb()
+        with self._lock:
+            self._watches.add(self)
+            if _RSSWatch._thread is None:
+                _RSSWatch._thread = threading.Thread(target=_RSSWatch._poll, daemon=True)
+                _RSSWatch._thread.start()
+
+    @classmethod
+    def _poll(cls):
+        while True:
+            time.sleep(RSS_INTERVAL)
+            rss = rss_mb()
+            with cls._lock:
+                for watch in cls._watches:
+                    watch.max = max(watch.max, rss)
+
+    def stop(self):
+        rss = rss_mb()
+        with self._lock:
+            self._watches.discard(self)
+            self.max = max(self.max, rss)
+        return self.max
+
+
+class StageProbe(object):
+    """ Times a stage run in this thread and the steps it marks with `step`.
+
+    With measure_rss (the only stage running in the process) the peak of the stage (and of each step) is
+    payload_mb plus the peak RSS growth of the process, VmHWM being reset at the start of every step. With
+    sample_rss (other threads running stages too) it is payload_mb plus the growth of the polled RSS.
+    """
+    def __init__(self, measure_rss=False, payload_mb=0., sample_rss=False):
+        self.measure_rss = measure_rss and reset_peak_rss()
+        self.sample_rss = not self.measure_rss and sample_rss and rss_mb() is not None
+        self.payload = payload_mb
+        self.base = self.hwm = rss_mb() if self.measure_rss or self.sample_rss else None
+        self.steps = {}
+        self.seconds = None
+        self._watch = None
+
+    def _update_hwm(self):
+        self.hwm = max(self.hwm, rss_mb('VmHWM'))
+        return self.hwm
+
+    @property
+    def peak(self):
+        return self.payload + self.hwm - self.base if self.measure_rss or self.sample_rss else None
+
+    def __enter__(self):
+        _local.probe = self
+        if self.sample_rss:
+            self._watch = _RSSWatch()
+        self.t = time.time()
+        return self
+
+    def __exit__(self, *exc):
+        self.seconds = time.time() - self.t
+        if self.measure_rss:
+            self._update_hwm()
+        if self.sample_rss:
+            self.hwm = self._watch.stop()
+        _local.probe = None
+        return False
+
+
+@contextlib.contextmanager
+def step(name):
+    """ Time the enclosed code as step `name` of the current StageProbe (no-op outside of one) """
+    probe = getattr(_local, 'probe', None)
+    if probe is None:
+        yield
+        return
+    if probe.measure_rss:
+        probe._update_hwm()
+        reset_peak_rss()
+    watch = _RSSWatch() if probe.sample_rss else None
+    t = time.time()
+    try:
+        yield
+    finally:
+        entry = probe.steps.setdefault(name, {'seconds': 0.})
+        entry['seconds'] += time.time() - t
+        if probe.measure_rss or probe.sample_rss:
+            peak = probe.payload + (rss_mb('VmHWM') if probe.measure_rss else watch.stop()) - probe.base
+            entry['peak_rss_mb'] = max(entry.get('peak_rss_mb', peak), peak)
+        if probe.measure_rss:
+            probe._update_hwm()
+
+
+class TelemetryLog(object):
+    """ Appends the records of one run; only the main process of prepare.py writes to it. """
+    def __init__(self, savepath, worker=None):
+        self.path = os.path.join(savepath, FILENAME if worker is None else 'telemetry.{}.jsonl'.format(worker))
+        self.worker = worker
+        self.run = '{}-{}'.format(time.strftime('%Y%m%d-%H%M%S'), os.getpid())
+
+    def write(self, case, stage, **fields):
+        record = dict(fields, run=self.run, worker=self.worker, case=case, stage=stage, time=time.time())
+        with open(self.path, 'at', encoding='utf-8') as f:
+            f.write(json.dumps(record) + '\n')
+
+
+def load_records(savepath):
+    """ Records of telemetry.jsonl and every telemetry.<worker>.jsonl, oldest first """
+    records = []
+    for path in sorted(glob.glob(os.path.join(savepath, 'telemetry*.jsonl'))):
+        with open(path, 'rt', encoding='utf-8') as f:
+            for line in f:
+                try:
+                    records.append(json.loads(line))
+                except ValueError:
+                    pass   # last line of a run that was killed while writing
+    return sorted(records, key=lambda r: r['time'])
+
+
+def latest(records):
+    """ The last record of each (case, stage): re-runs of a case replace its older numbers """
+    return list({(r['case'], r['stage']): r for r in records}.values())
+
+
+def _row(label, seconds, peaks):
+    seconds = np.array(seconds)
+    row = '{:<22}{:>6}'.format(label, len(seconds))
+    row += ''.join('{:>9.2f}'.format(v) for v in np.percentile(seconds, [50, 90, 99]))
+    row += '{:>9.2f}{:>10.1f}'.format(seconds.max(), seconds.sum())
+    peaks = [p for p in peaks if p is not None]
+    if peaks:
+        row += ''.join('{:>9.0f}'.format(v) for v in np.percentile(peaks, [50, 90])) + '{:>9.0f}'.format(max(peaks))
+    return row
+
+
+def summarize(records, top=10, stages=None):
+    """ Percentiles of the stages and steps over the cases, and the `top` slowest cases """
+    done = [r for r in records if r['status'] == 'done']
+    failed = sorted({(r['case'], r['stage']) for r in records if r['status'] != 'done'})
+    if stages is None:
+        stages = []
+        for r in done:
+            if r['stage'] not in stages:
+                stages.append(r['stage'])
+    lines = ['{:<22}{:>6}{:>9}{:>9}{:>9}{:>9}{:>10}{:>9}{:>9}{:>9}'.format(
+        'stage / step', 'n', 'p50 s', 'p90 s', 'p99 s', 'max s', 'total s', 'p50 MB', 'p90 MB', 'max MB')]
+    for stage in stages:
+        runs = [r for r in done if r['stage'] == stage]
+        if not runs:
+            continue
+        sampled = any(r.get('rss_sampled') for r in runs)
+        lines.append(_row(stage + (' *' if sampled else ''), [r['seconds'] for r in runs],
+                          [r.get('peak_rss_mb') for r in runs]))
+        steps = []
+        for r in runs:
+            steps += [s for s in r.get('steps', {}) if s not in steps]
+        for s in steps:
+            values = [r['steps'][s] for r in runs if s in r.get('steps', {})]
+            lines.append(_row('  ' + s, [v['seconds'] for v in values], [v.get('peak_rss_mb') for v in values]))
+
+    if any(r.get('rss_sampled') for r in done):
+        lines.append('* MB sampled from the RSS of the whole process, other cases running at the same time included')
+
+    cases = {}
+    for r in done:
+        cases.setdefault(r['case'], {})[r['stage']] = r
+    slowest = sorted(cases, key=lambda c: -sum(r['seconds'] for r in cases[c].values()))[:top]
+    if slowest:
+        lines.append('')
+        lines.append('{} slowest cases (seconds per stage, peak MB):'.format(len(slowest)))
+    for case in slowest:
+        runs = cases[case]
+        peaks = [r.get('peak_rss_mb') for r in runs.values() if r.get('peak_rss_mb') is not None]
+        lines.append('  {}  {:.1f} s  {}{}'.format(
+            case, sum(r['seconds'] for r in runs.values()),
+            '  '.join('{} {:.1f}'.format(s, runs[s]['seconds']) for s in stages if s in runs),
+            '  peak {:.0f} MB'.format(max(peaks)) if peaks else ''))
+    if failed:
+        lines.append('')
+        lines.append('{} failed stage runs: {}'.format(len(failed), ' '.join('{}:{}'.format(c, s) for c, s in failed)))
+    return '\n'.join(lines)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Preprocessing telemetry')
+    subparsers = parser.add_subparsers(dest='command')
+    p = subparsers.add_parser('summary', help='percentiles per stage / step and the slowest cases')
+    p.add_argument('data_dir', help='preprocess_result_path of the run')
+    p.add_argument('--top', default=10, type=int, metavar='N', help='number of slowest cases to list')
+    p.add_argument('--all-runs', action='store_true', default=False,
+                   help='count every run of a case, not only its latest one')
+    args = parser.parse_args()
+    if args.command is None:
+        parser.print_help()
+    else:
+        records = load_records(args.data_dir)
+        if not args.all_runs:
+            records = latest(records)
+        print('{} stage runs of {} cases'.format(len(records), len({r['case'] for r in records})))
+        print(summarize(records, args.top))
@@ -0,0 +1,85 @@
+import numpy as np
+
+from data_detector import LabelMapping, match_anchors
+
+CONFIG = {'stride': 4, 'num_neg': 800, 'th_neg': 0.02, 'th_pos_train': 0.5, 'th_pos_val': 1.0,
+          'anchors': [5.0, 10.0, 20.0]}
+
+
+def select_samples(bbox, anchor, th, oz, oh, ow):
+    """ The per (bbox, anchor) loop match_anchors replaced """
+    z, h, w, d = bbox
+    none = np.zeros((0,), np.int64), np.zeros((0,), np.int64), np.zeros((0,), np.int64)
+    if d == 0:
+        return none
+    max_overlap = min(d, anchor)
+    min_overlap = np.power(max(d, anchor), 3) * th / max_overlap / max_overlap
+    if min_overlap > max_overlap:
+        return none
+    idx = []
+    for c, o in zip((z, h, w), (oz, oh, ow)):
+        s = c - 0.5 * np.abs(d - anchor) - (max_overlap - min_overlap)
+        e = c + 0.5 * np.abs(d - anchor) + (max_overlap - min_overlap)
+        idx.append(np.where(np.logical_and(o >= s, o <= e))[0])
+    iz, ih, iw = idx
+    if len(iz) == 0 or len(ih) == 0 or len(iw) == 0:
+        return none
+    lz, lh, lw = len(iz), len(ih), len(iw)
+    iz = np.tile(iz.reshape((-1, 1, 1)), (1, lh, lw)).reshape((-1))
+    ih = np.tile(ih.reshape((1, -1, 1)), (lz, 1, lw)).reshape((-1))
+    iw = np.tile(iw.reshape((1, 1, -1)), (lz, lh, 1)).reshape((-1))
+    centers = np.concatenate([oz[iz].reshape((-1, 1)), oh[ih].reshape((-1, 1)), ow[iw].reshape((-1, 1))], axis=1)
+    s0, e0 = centers - anchor / 2, centers + anchor / 2
+    s1, e1 = (bbox[:3] - d / 2).reshape((1, -1)), (bbox[:3] + d / 2).reshape((1, -1))
+    overlap = np.maximum(0, np.minimum(e0, e1) - np.maximum(s0, s1))
+    intersection = overlap[:, 0] * overlap[:, 1] * overlap[:, 2]
+    iou = intersection / (anchor * anchor * anchor + d * d * d - intersection)
+    mask = iou >= th
+    return iz[mask], ih[mask], iw[mask]
+
+
+def random_bboxes(rng, size):
+    n = rng.randint(0, 6)
+    bboxes = np.column_stack([rng.uniform(-20, size + 20, (n, 3)), rng.uniform(0, 40, n)])
+    bboxes[rng.rand(n) < 0.2, 3] = 0
+    return bboxes
+
+
+def test_match_anchors_same_as_select_samples():
+    rng = np.random.RandomState(0)
+    anchors = np.array(CONFIG['anchors'])
+    for output_size in (20, 24):
+        centres = (np.arange(output_size) * 4 + 1.5,) * 3
+        for _ in range(500):
+            bboxes = random_bboxes(rng, output_size * 4)
+            for th in (CONFIG['th_neg'], CONFIG['th_pos_train'], CONFIG['th_pos_val']):
+                expected = [[], [], [], [], []]
+                for ib, bbox in enumerate(bboxes):
+                    for ia, anchor in enumerate(anchors):
+                        iz, ih, iw = select_samples(bbox, anchor, th, *centres)
+                        for out, values in zip(expected, ([ib] * len(iz), [ia] * len(iz), iz, ih, iw)):
+                            out.extend(values)
+                got = match_anchors(bboxes.reshape((-1, 4)), anchors, th, centres)
+                for g, e in zip(got, expected):
+                    np.testing.assert_array_equal(g, np.array(e, np.int64))
+
+
+def test_match_anchors_no_bboxes():
+    centres = (np.arange(20) * 4 + 1.5,) * 3
+    assert all(len(i) == 0 for i in match_anchors(np.zeros((0, 4)), CONFIG['anchors'], 0.02, centres))
+    assert all(len(i) == 0 for i in match_anchors(np.array([[40., 40., 40., 0.]]), CONFIG['anchors'], 0.02, centres))
+
+
+def test_label_mapping_fixed_by_seed():
+    rng = np.random.RandomState(1)
+    for phase in ('train', 'val'):
+        mapping = LabelMapping(CONFIG, phase)
+        for _ in range(20):
+            bboxes = random_bboxes(rng, 80)
+            target = np.append(rng.uniform(0, 80, 3), rng.uniform(3, 30)) if len(bboxes) else np.full(4, np.nan)
+            labels = []
+            for _ in range(2):
+                np.random.seed(7)
+                labels.append(mapping([80, 80, 80], target, bboxes, 'case'))
+            np.testing.assert_array_equal(labels[0], labels[1])
+            assert labels[0].shape == (20, 20, 20, 3, 5)
@@ -0,0 +1,88 @@
+import os
+import sys
+import csv
+import glob
+import json
+import subprocess
+
+import numpy as np
+import SimpleITK as sitk
+
+from case_index import load_case_index
+from preprocess_manifest import Manifest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+WORKER = '''
+import sys
+import prepare
+prepare.config.clear()
+prepare.config.update(luna_segment=sys.argv[1], luna_data=sys.argv[2], luna_label=sys.argv[3],
+                      preprocess_result_path=sys.argv[4])
+prepare.preprocess_luna(workers={'load': 1, 'mask': 1, 'resample': 1, 'write': 1}, max_inflight=1, worker=True,
+                        lease_timeout=20.)
+'''
+
+
+def _write_image(array, path, spacing, origin):
+    image = sitk.GetImageFromArray(array)
+    image.SetSpacing(spacing[::-1])
+    image.SetOrigin(origin[::-1])
+    sitk.WriteImage(image, path)
+
+
+def make_luna(root, n_cases=6):
+    """ Small synthetic CTs with two lung halves and one nodule each, laid out like LUNA16 """
+    rng = np.random.RandomState(0)
+    luna_data, luna_segment = os.path.join(root, 'allset'), os.path.join(root, 'seg')
+    os.makedirs(luna_data)
+    os.makedirs(luna_segment)
+    rows = []
+    for k in range(n_cases):
+        name = 'case{}'.format(k)
+        shape, spacing, origin = (24 + 2 * k, 56, 48), (2.5, 1.2, 1.2), (-100. - k, -60., -50.)
+        z, y, x = np.meshgrid(*[np.arange(s) for s in shape], indexing='ij')
+        c = np.array(shape) / 2.
+        mask = np.zeros(shape, np.uint8)
+        for label, cx in ((3, 0.6), (4, 1.4)):
+            mask[((z - c[0]) / (shape[0] * 0.35)) ** 2 + ((y - c[1]) / (shape[1] * 0.3)) ** 2 +
+                 ((x - c[2] * cx) / (shape[2] * 0.15)) ** 2 < 1] = label
+        _write_image(rng.randint(-1100, 400, size=shape).astype(np.int16), os.path.join(luna_data, name + '.mhd'),
+                     spacing, origin)
+        _write_image(mask, os.path.join(luna_segment, name + '.mhd'), spacing, origin)
+        rows.append([name, origin[2] + c[2] * 0.6 * spacing[2], origin[1] + c[1] * spacing[1],
+                     origin[0] + c[0] * spacing[0], 6.])
+    luna_label = os.path.join(root, 'annotations.csv')
+    with open(luna_label, 'w') as f:
+        writer = csv.writer(f)
+        writer.writerow(['seriesuid', 'coordX', 'coordY', 'coordZ', 'diameter_mm'])
+        writer.writerows(rows)
+    return luna_segment + '/', luna_data + '/', luna_label, ['case{}'.format(k) for k in range(n_cases)]
+
+
+def test_workers_share_a_manifest(tmp_path):
+    luna_segment, luna_data, luna_label, names = make_luna(str(tmp_path / 'luna'))
+    savepath = str(tmp_path / 'out') + '/'
+    env = dict(os.environ, PYTHONPATH=ROOT)
+    workers = [subprocess.Popen([sys.executable, '-c', WORKER, luna_segment, luna_data, luna_label, savepath],
+                                cwd=str(tmp_path), env=env, stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+                                universal_newlines=True) for _ in range(3)]
+    outputs = [w.communicate(timeout=600)[0] for w in workers]
+    assert [w.returncode for w in workers] == [0, 0, 0], '\n'.join(outputs)
+
+    # every case went through the stages in exactly one worker
+    written = []
+    for path in glob.glob(os.path.join(savepath, 'telemetry.*.jsonl')):
+        with open(path) as f:
+            records = [json.loads(line) for line in f]
+        written += [r['case'] for r in records if r['stage'] == 'write' and r['status'] == 'done']
+    assert sorted(written) == names
+
+    # the last worker to finish ran the final pass: one merged manifest, the case index of every case
+    assert sum(out.count('final pass:') for out in outputs) == 1, '\n'.join(outputs)
+    assert Manifest.worker_files(savepath) == []
+    manifest = Manifest(savepath)
+    assert all(manifest.is_done(name, verify=True) for name in names)
+    index = load_case_index(savepath)
+    assert all(name in index for name in names)
+    assert all(os.path.exists(os.path.join(savepath, '{}_clean.npy'.format(name))) for name in names)
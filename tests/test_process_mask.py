@@ -0,0 +1,64 @@
+import numpy as np
+from scipy.ndimage import binary_dilation, generate_binary_structure
+from skimage.morphology import convex_hull_image
+
+from prepare import process_mask, mask_bbox
+
+
+def process_mask_reference(mask):
+    """ process_mask before the thread pool / distance transform rewrite """
+    convex_mask = np.copy(mask)
+    for i_layer in range(convex_mask.shape[0]):
+        mask1 = np.ascontiguousarray(mask[i_layer])
+        if np.sum(mask1) > 0:
+            mask2 = convex_hull_image(mask1)
+            if np.sum(mask2) > 1.5 * np.sum(mask1):
+                mask2 = mask1
+        else:
+            mask2 = mask1
+        convex_mask[i_layer] = mask2
+    struct = generate_binary_structure(3, 1)
+    return binary_dilation(convex_mask, structure=struct, iterations=10)
+
+
+def random_mask(rng, shape):
+    """ A few random ellipsoids, some of them cut by the border of the volume, and scattered voxels """
+    grid = np.indices(shape, dtype=np.float64)
+    mask = np.zeros(shape, bool)
+    for _ in range(rng.randint(1, 4)):
+        centre = rng.uniform(-5, np.array(shape) + 5)
+        radii = rng.uniform(3, 15, 3)
+        mask |= (((grid - centre.reshape((3, 1, 1, 1))) / radii.reshape((3, 1, 1, 1))) ** 2).sum(0) <= 1
+    mask |= rng.rand(*shape) < 0.001
+    return mask
+
+
+def test_process_mask_same_as_reference():
+    rng = np.random.RandomState(0)
+    for _ in range(8):
+        mask = random_mask(rng, (24, 48, 40))
+        np.testing.assert_array_equal(process_mask(mask), process_mask_reference(mask))
+
+
+def test_process_mask_border():
+    mask = np.zeros((20, 30, 30), bool)
+    mask[0, :5, :5] = True
+    mask[-1, -3:, 10:20] = True
+    mask[5:15, 0, -1] = True
+    np.testing.assert_array_equal(process_mask(mask), process_mask_reference(mask))
+
+
+def test_process_mask_empty():
+    mask = np.zeros((10, 20, 20), bool)
+    out = process_mask(mask)
+    assert out.dtype == bool and out.shape == mask.shape and not out.any()
+    np.testing.assert_array_equal(out, process_mask_reference(mask))
+
+
+def test_mask_bbox_same_as_where():
+    rng = np.random.RandomState(1)
+    for _ in range(8):
+        mask = random_mask(rng, (24, 48, 40))
+        xx, yy, zz = np.where(mask)
+        box = np.array([[np.min(xx), np.max(xx)], [np.min(yy), np.max(yy)], [np.min(zz), np.max(zz)]])
+        np.testing.assert_array_equal(np.stack(mask_bbox(mask), axis=1), box)
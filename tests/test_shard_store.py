@@ -0,0 +1,30 @@
+import os
+
+import numpy as np
+
+from shard_store import pack_fold, shard_dir, ShardIndex
+
+
+def test_repreprocessed_case_read_from_data_dir(tmp_path):
+    data_dir = str(tmp_path)
+    rng = np.random.RandomState(0)
+    for name in ('a', 'b'):
+        np.save(os.path.join(data_dir, '{}_clean.npy'.format(name)), rng.randint(0, 255, (1, 8, 9, 10)).astype(np.uint8))
+    out_dir = shard_dir(data_dir, 1)
+    pack_fold(data_dir, {'train': ['a', 'b']}, out_dir)
+
+    index = ShardIndex(out_dir)
+    assert index.stale == [] and 'a_clean.npy' in index and 'b_clean.npy' in index
+    volume = index.load_volume(os.path.join(data_dir, 'a_clean.npy'))
+    assert isinstance(volume, np.memmap) and os.path.dirname(volume.filename) == os.path.abspath(out_dir)
+
+    # case a preprocessed again after packing: its shard copy is stale
+    new = rng.randint(0, 255, (1, 8, 9, 11)).astype(np.uint8)
+    np.save(os.path.join(data_dir, 'a_clean.npy'), new)
+    index = ShardIndex(out_dir)
+    assert index.stale == ['a_clean.npy'] and 'a_clean.npy' not in index and 'b_clean.npy' in index
+    np.testing.assert_array_equal(index.load_volume(os.path.join(data_dir, 'a_clean.npy')), new)
+
+    # only the shards are there: nothing to compare with, the shards are used
+    index = ShardIndex(out_dir, data_dir=str(tmp_path / 'elsewhere'))
+    assert index.stale == [] and 'a_clean.npy' in index
@@ -0,0 +1,112 @@
+#!/usr/bin/python3
+#coding=utf-8
+
+"""
+Shared-memory arena of the id_clean volumes of a fold, for many DataLoader workers on one node.
+
+VolumeArena.create reads every volume once, in the main process, into a single file on /dev/shm
+(arena_dir/volume_arena.<pid>.<random>) laid out as described by an offset table {filename: (offset, shape,
+dtype)}, each volume starting on a 4 KB boundary. Workers map the file read-only and crop from views of it,
+so the volumes are in memory once whatever the number of workers (forked workers inherit the mapping, spawned
+ones map the file again by name).
+
+The process that created the arena removes the file when it exits; arenas left behind by a killed process
+are removed by the next VolumeArena.create on the node.
+"""
+
+import os
+import glob
+import atexit
+import tempfile
+import concurrent.futures
+import numpy as np
+
+ALIGN = 4096
+PREFIX = 'volume_arena.'
+
+
+def _remove_stale(arena_dir):
+    for path in glob.glob(os.path.join(arena_dir, PREFIX + '*')):
+        try:
+            pid = int(os.path.basename(path)[len(PREFIX):].split('.')[0])
+            os.kill(pid, 0)
+        except ProcessLookupError:
+            os.remove(path)
+        except (ValueError, OSError):
+            pass   # not ours, or a live process of another user
+
+
+class VolumeArena(object):
+    def __init__(self, path, table):
+        self.path = path
+        self.table = table   # {filename: (offset, shape, dtype)}
+        self._owner = None
+        self._mm = None
+
+    @classmethod
+    def create(cls, filenames, load, arena_dir='/dev/shm', workers=4):
+        """ Arena holding np.asarray(load(filename)) for each filename.
+
+        load opens a volume lazily (e.g. DataBowl3Detector.open_volume), workers threads copy the volumes in.
+        """
+        os.makedirs(arena_dir, exist_ok=True)
+        _remove_stale(arena_dir)
+        filenames = list(dict.fromkeys(filenames))
+        table, size = {}, 0
+        for filename in filenames:
+            volume = load(filename)
+            table[filename] = (size, tuple(int(s) for s in volume.shape), np.dtype(volume.dtype).str)
+            size += -(-volume.nbytes // ALIGN) * ALIGN
+        stat = os.statvfs(arena_dir)
+        if size > stat.f_bavail * stat.f_frsize:
+            raise OSError('the volumes need {:.1f} GB, only {:.1f} GB free in {}'.format(
+                size / 1024. ** 3, stat.f_bavail * stat.f_frsize / 1024. ** 3, arena_dir))
+
+        fd, path = tempfile.mkstemp(prefix='{}{}.'.format(PREFIX, os.getpid()), dir=arena_dir)
+        arena = cls(path, table)
+        arena._owner = os.getpid()
+        atexit.register(arena.close)
+        try:
+            os.ftruncate(fd, max(size, 1))
+            mm = np.memmap(path, dtype=np.uint8, mode='r+', shape=max(size, 1))
+
+            def fill(filename):
+                offset, shape, dtype = table[filename]
+                np.ndarray(shape, dtype, buffer=mm, offset=offset)[...] = np.asarray(load(filename))
+
+            with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+                list(executor.map(fill, filenames))
+            del mm
+        except BaseException:
+            arena.close()
+            raise
+        finally:
+            os.close(fd)
+        return arena
+
+    @property
+    def nbytes(self):
+        return sum(int(np.prod(shape)) * np.dtype(dtype).itemsize for _, shape, dtype in self.table.values())
+
+    def __contains__(self, filename):
+        return filename in self.table
+
+    def __len__(self):
+        return len(self.table)
+
+    def __getitem__(self, filename):
+        """ Read-only view of the volume, no copy """
+        if self._mm is None:
+            self._mm = np.memmap(self.path, dtype=np.uint8, mode='r')
+        offset, shape, dtype = self.table[filename]
+        return np.ndarray(shape, dtype, buffer=self._mm, offset=offset)
+
+    def close(self):
+        """ Remove the file (in the process that created it); views stay valid until they are released """
+        if self._owner == os.getpid() and os.path.exists(self.path):
+            os.remove(self.path)
+
+    def __getstate__(self):
+        state = dict(self.__dict__)
+        state['_mm'] = None
+        return state
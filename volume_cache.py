@@ -0,0 +1,91 @@
+#!/usr/bin/python3
+#coding=utf-8
+
+"""
+Byte-budgeted LRU cache of decoded volumes for the dataset classes of data_detector.py.
+
+Nodules above sizelim2/3/4 are sampled up to 15 times per epoch and random crops pick volumes again, so
+a DataLoader worker reads the same id_clean many times. With a VolumeCache, a volume is read once into
+memory (read-only) and kept until the worker needs the room for more recently used ones.
+
+Every process has its own entries and its own budget: a forked DataLoader worker starts with an empty
+cache (nothing of the parent is reused or freed twice), so the memory used is at most
+max_bytes x number of workers. The hit / miss counters are shared by the workers and the main process,
+so stats() in the main process covers all of them.
+"""
+
+import os
+import collections
+import multiprocessing
+import numpy as np
+
+COUNTERS = ('hits', 'misses', 'evictions', 'uncached', 'bytes_read')
+
+
+class VolumeCache(object):
+    def __init__(self, max_bytes):
+        self.max_bytes = int(max_bytes)
+        self._counts = multiprocessing.Array('q', len(COUNTERS))
+        self._reset()
+
+    def _reset(self):
+        self._pid = os.getpid()
+        self._entries = collections.OrderedDict()
+        self._bytes = 0
+
+    def _count(self, counter, n=1):
+        with self._counts.get_lock():
+            self._counts[COUNTERS.index(counter)] += n
+
+    def get(self, key, load):
+        """ The cached array of `key`, else load() read into memory and cached.
+
+        Volumes larger than the whole budget are returned as load() gives them (memory-mapped or lazily
+        decoded), so crops of them still read only what they need.
+        """
+        if os.getpid() != self._pid:
+            self._reset()
+        if key in self._entries:
+            self._entries.move_to_end(key)
+            self._count('hits')
+            return self._entries[key]
+        self._count('misses')
+        volume = load()
+        if volume.nbytes > self.max_bytes:
+            self._count('uncached')
+            return volume
+        array = np.array(volume)
+        array.flags.writeable = False
+        while self._bytes + array.nbytes > self.max_bytes:
+            _, evicted = self._entries.popitem(last=False)
+            self._bytes -= evicted.nbytes
+            self._count('evictions')
+        self._entries[key] = array
+        self._bytes += array.nbytes
+        self._count('bytes_read', array.nbytes)
+        return array
+
+    def clear(self):
+        self._reset()
+
+    def reset_stats(self):
+        """ Zero the counters of all the processes sharing this cache (the entries are kept) """
+        with self._counts.get_lock():
+            self._counts[:] = [0] * len(COUNTERS)
+
+    def stats(self):
+        """ {counter: value} summed over the processes sharing this cache, plus 'hit_rate' """
+        with self._counts.get_lock():
+            stats = dict(zip(COUNTERS, self._counts[:]))
+        lookups = stats['hits'] + stats['misses']
+        stats['hit_rate'] = stats['hits'] / float(lookups) if lookups else 0.
+        return stats
+
+    def __len__(self):
+        return len(self._entries) if os.getpid() == self._pid else 0
+
+    def __getstate__(self):
+        # a spawned DataLoader worker gets the counters but no entries
+        state = dict(self.__dict__)
+        state['_entries'], state['_bytes'] = collections.OrderedDict(), 0
+        return state
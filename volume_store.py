@@ -0,0 +1,314 @@
+#!/usr/bin/python3
+#coding=utf-8
+
+"""
+Chunked on-disk volume store.
+
+Layout of a `*.vol` file:
+    magic (8 bytes) | header length (uint32) | JSON header | padding to 64 bytes
+    chunk index (uint64, n_chunks x [offset, nbytes]) | chunk data
+
+Chunks are fixed (C, 32, 32, 32) blocks written in Z-order (Morton order) of the
+chunk grid, so spatially close chunks are also close on disk. Border chunks are
+padded with `fill_value`. The chunk index is addressed by the C-order position of
+the chunk in the grid, so a reader can jump to any chunk without scanning.
+
+Optionally every chunk is compressed on its own (header 'codec': 'zlib', or 'zstd' /
+'blosc' when those modules are installed), bool volumes are bit-packed before that,
+and chunks holding only `fill_value` (the padding outside the lungs) are not stored
+at all (nbytes 0 in the index). 3-D arrays such as the lung masks are stored with a
+channel axis of 1 and read back as 3-D.
+
+A file may also hold a pyramid of coarser versions of the volume (header 'levels'),
+each with its own grid and chunk index, stored after the index of level 0.
+"""
+
+import os
+import json
+import zlib
+import struct
+import numpy as np
+
+MAGIC = b'LNDVOL1\x00'
+CHUNK_SIZE = 32
+VOLUME_EXT = '.vol'
+_ALIGN = 64
+
+
+def _zlib_codec(level):
+    level = 6 if level is None else level
+    return lambda b: zlib.compress(b, level), zlib.decompress
+
+
+def _zstd_codec(level):
+    import zstandard
+    level = 3 if level is None else level
+    # (de)compressor objects are not thread-safe, make one per call
+    return (lambda b: zstandard.ZstdCompressor(level=level).compress(b),
+            lambda b: zstandard.ZstdDecompressor().decompress(b))
+
+
+def _blosc_codec(level):
+    import blosc
+    level = 5 if level is None else level
+    return (lambda b: blosc.compress(b, typesize=1, clevel=level, shuffle=blosc.NOSHUFFLE, cname='zstd'),
+            blosc.decompress)
+
+
+CODECS = {'raw': lambda level: (None, None), 'zlib': _zlib_codec, 'zstd': _zstd_codec, 'blosc': _blosc_codec}
+
+
+def available_codecs():
+    """ Codecs usable here: zstd and blosc need the `zstandard` / `blosc` modules. """
+    names = []
+    for name, make in CODECS.items():
+        try:
+            make(None)
+        except ImportError:
+            continue
+        names.append(name)
+    return names
+
+
+def morton_order(grid):
+    """ Return the C-order indices of a chunk grid sorted by their Z-order (Morton) code. """
+    cz, cy, cx = np.meshgrid(np.arange(grid[0]), np.arange(grid[1]), np.arange(grid[2]), indexing='ij')
+    coords = [cz.ravel().astype(np.uint64), cy.ravel().astype(np.uint64), cx.ravel().astype(np.uint64)]
+    code = np.zeros(len(coords[0]), np.uint64)
+    for bit in range(21):
+        for axis in range(3):
+            code |= ((coords[axis] >> np.uint64(bit)) & np.uint64(1)) << np.uint64(3 * bit + (2 - axis))
+    return np.argsort(code, kind='stable')
+
+
+def chunked_path(filename):
+    """ `xxx_clean.npy` -> `xxx_clean.vol` """
+    return os.path.splitext(filename)[0] + VOLUME_EXT
+
+
+def save_chunked(filename, array, chunk=CHUNK_SIZE, fill_value=0, codec='raw', clevel=None, pyramid=()):
+    """ Write a (C, Z, Y, X) or (Z, Y, X) array into the chunked format.
+
+    codec: one of CODECS, every chunk is compressed on its own. clevel: compression level of the codec.
+    pyramid: coarser versions of array, stored as levels 1, 2, ... of the same file (see ChunkedVolume level).
+    """
+    ndim = np.ndim(array)
+    arrays = [np.ascontiguousarray(a)[np.newaxis] if ndim == 3 else np.ascontiguousarray(a) for a in [array] + list(pyramid)]
+    assert arrays[0].ndim == 4, 'expect (C, Z, Y, X) or (Z, Y, X), got shape {}'.format(arrays[0].shape)
+    encode = CODECS[codec](clevel)[0]
+    dtype = arrays[0].dtype
+    bitpack = dtype == np.bool_
+    fill_value = bool(fill_value) if bitpack else fill_value
+    grids = [[int(np.ceil(float(s) / chunk)) for s in a.shape[1:]] for a in arrays]
+    n_chunks = [g[0] * g[1] * g[2] for g in grids]
+
+    header = {'shape': list(arrays[0].shape), 'dtype': dtype.str, 'chunk': chunk,
+              'grid': grids[0], 'order': 'zorder', 'fill_value': fill_value,
+              'codec': codec, 'bitpack': bool(bitpack), 'ndim': ndim,
+              'levels': [{'shape': list(a.shape), 'grid': g} for a, g in zip(arrays[1:], grids[1:])]}
+    header_bytes = json.dumps(header).encode('utf-8')
+    prefix = len(MAGIC) + 4 + len(header_bytes)
+    prefix += (-prefix) % _ALIGN
+    offset = prefix + sum(n_chunks) * 16
+
+    # one index per level, back to back: level l starts at row sum(n_chunks[:l])
+    index = np.zeros((sum(n_chunks), 2), np.uint64)
+    with open(filename, 'wb') as f:
+        f.write(MAGIC)
+        f.write(struct.pack('<I', len(header_bytes)))
+        f.write(header_bytes)
+        f.write(b'\x00' * (prefix - len(MAGIC) - 4 - len(header_bytes)))
+        f.write(index.tobytes())  # placeholder, filled in once the chunk sizes are known
+        base = 0
+        for array, grid, n in zip(arrays, grids, n_chunks):
+            block = np.empty((array.shape[0], chunk, chunk, chunk), dtype)
+            for i in morton_order(grid):
+                cz, cy, cx = np.unravel_index(i, grid)
+                src = array[:, cz*chunk:(cz+1)*chunk, cy*chunk:(cy+1)*chunk, cx*chunk:(cx+1)*chunk]
+                block.fill(fill_value)
+                block[:, :src.shape[1], :src.shape[2], :src.shape[3]] = src
+                if not np.any(block != fill_value):
+                    continue
+                data = np.packbits(block).tobytes() if bitpack else block.tobytes()
+                if encode is not None:
+                    data = encode(data)
+                index[base + i] = offset, len(data)
+                f.write(data)
+                offset += len(data)
+            base += n
+        f.seek(prefix)
+        f.write(index.astype('<u8').tobytes())
+
+
+class ChunkedVolume(object):
+    """ Memory-mapped reader of a `*.vol` file.
+
+    Slicing with `[c, z0:z1, y0:y1, x0:x1]` touches only the chunks overlapping the
+    window (and decodes only those when the file is compressed). Slicing only the
+    channel axis returns a lazy view, so that `vol[0:channel]` costs nothing.
+    Volumes saved from a 3-D array are sliced and returned as (Z, Y, X).
+    offset / nbytes: the volume is stored at this byte range of a larger file (see shard_store.py).
+    level: 0 for the volume itself, l > 0 for the l-th coarser level of the pyramid saved with it.
+    """
+    def __init__(self, filename, channels=None, offset=0, nbytes=None, level=0):
+        self.filename = filename
+        self.offset, self.size = offset, nbytes
+        self.level = level
+        self._mm = np.memmap(filename, dtype=np.uint8, mode='r', offset=offset, shape=nbytes)
+        if bytes(self._mm[:len(MAGIC)]) != MAGIC:
+            raise ValueError('{} is not a chunked volume'.format(filename))
+        header_len = struct.unpack('<I', bytes(self._mm[len(MAGIC):len(MAGIC) + 4]))[0]
+        start = len(MAGIC) + 4
+        self.header = json.loads(bytes(self._mm[start:start + header_len]).decode('utf-8'))
+        prefix = start + header_len
+        prefix += (-prefix) % _ALIGN
+
+        levels = [self.header] + self.header.get('levels', [])
+        if level >= len(levels):
+            raise ValueError('{} has no pyramid level {}'.format(filename, level))
+        self.full_shape = tuple(levels[level]['shape'])
+        self.dtype = np.dtype(self.header['dtype'])
+        self.chunk = self.header['chunk']
+        self.grid = tuple(levels[level]['grid'])
+        self.fill_value = self.header['fill_value']
+        self.squeeze = self.header.get('ndim', 4) == 3
+        self.bitpack = self.header.get('bitpack', False)
+        self._decode = CODECS[self.header.get('codec', 'raw')](None)[1]
+        self._fill_chunk = None
+        n_chunks = [int(np.prod(l['grid'])) for l in levels]
+        prefix += 16 * sum(n_chunks[:level])
+        self.index = np.frombuffer(self._mm, dtype='<u8', count=n_chunks[level] * 2, offset=prefix).reshape((-1, 2))
+        self.channels = slice(0, self.full_shape[0]) if channels is None else channels
+
+    @property
+    def shape(self):
+        if self.squeeze:
+            return self.full_shape[1:]
+        return (len(range(*self.channels.indices(self.full_shape[0]))),) + self.full_shape[1:]
+
+    @property
+    def n_levels(self):
+        return 1 + len(self.header.get('levels', []))
+
+    @property
+    def ndim(self):
+        return 3 if self.squeeze else 4
+
+    @property
+    def nbytes(self):
+        return int(np.prod(self.shape)) * self.dtype.itemsize
+
+    def __len__(self):
+        return self.shape[0]
+
+    def _chunk(self, i):
+        start, nbytes = int(self.index[i, 0]), int(self.index[i, 1])
+        c = self.chunk
+        shape = (self.full_shape[0], c, c, c)
+        if nbytes == 0:
+            if self._fill_chunk is None:
+                self._fill_chunk = np.full(shape, self.fill_value, self.dtype)
+            return self._fill_chunk
+        data = self._mm[start:start + nbytes]
+        if self._decode is not None:
+            data = np.frombuffer(self._decode(data), np.uint8)
+        if self.bitpack:
+            return np.unpackbits(data, count=int(np.prod(shape))).view(np.bool_).reshape(shape)
+        return data.view(self.dtype).reshape(shape)
+
+    def read(self, box=None):
+        """ Read `box = [[z0, z1], [y0, y1], [x0, x1]]` (None for the whole volume). """
+        if box is None:
+            box = [[0, s] for s in self.full_shape[1:]]
+        box = np.asarray(box, dtype=np.int64)
+        c = self.chunk
+        out = np.empty((self.full_shape[0],) + tuple(box[:, 1] - box[:, 0]), self.dtype)
+        if out.size == 0:
+            return out[0] if self.squeeze else out[self.channels]
+        lo = box[:, 0] // c
+        hi = (box[:, 1] - 1) // c + 1
+        for cz in range(lo[0], hi[0]):
+            for cy in range(lo[1], hi[1]):
+                for cx in range(lo[2], hi[2]):
+                    i = (cz * self.grid[1] + cy) * self.grid[2] + cx
+                    corner = np.array([cz, cy, cx]) * c
+                    s = np.maximum(box[:, 0], corner)
+                    e = np.minimum(box[:, 1], corner + c)
+                    out[:, s[0]-box[0,0]:e[0]-box[0,0], s[1]-box[1,0]:e[1]-box[1,0], s[2]-box[2,0]:e[2]-box[2,0]] = \
+                        self._chunk(i)[:, s[0]-corner[0]:e[0]-corner[0], s[1]-corner[1]:e[1]-corner[1], s[2]-corner[2]:e[2]-corner[2]]
+        return out[0] if self.squeeze else out[self.channels]
+
+    def __getitem__(self, key):
+        if not isinstance(key, tuple):
+            key = (key,)
+        if self.squeeze:
+            key = (0,) + key
+        elif len(key) == 1 and isinstance(key[0], slice):
+            start, stop, step = key[0].indices(self.shape[0])
+            base = range(*self.channels.indices(self.full_shape[0]))[start:stop:step]
+            return ChunkedVolume(self.filename, slice(base.start, base.stop, base.step), self.offset, self.size, self.level)
+        key = key + (slice(None),) * (4 - len(key))
+        box = []
+        for k, n in zip(key[1:], self.full_shape[1:]):
+            start, stop, step = k.indices(n)
+            assert step == 1, 'strided reads are not supported'
+            box.append([start, max(start, stop)])
+        data = self.read(box)
+        return data if self.squeeze else data[key[0]]
+
+    def __array__(self, dtype=None, copy=None):
+        data = self.read()
+        return data if dtype is None else data.astype(dtype)
+
+
+class VolumeRegion(object):
+    """ A box [[z0, z1], [y0, y1], [x0, x1]] of a (C, Z, Y, X) volume read into memory once, sliced with the
+    coordinates of the whole volume: reads inside the box come from memory, the others from the volume. """
+    def __init__(self, volume, box, data=None):
+        self.volume = volume
+        self.box = np.asarray(box, dtype=np.int64)
+        if data is None:
+            # a copy: slices of a memory-mapped volume would only be views, read again by every crop
+            data = np.array(volume[(slice(None),) + tuple(slice(a, b) for a, b in self.box)], copy=True)
+        self.data = data
+        self.dtype = data.dtype
+
+    @property
+    def shape(self):
+        return (len(self.data),) + tuple(self.volume.shape[1:])
+
+    @property
+    def ndim(self):
+        return 4
+
+    def __len__(self):
+        return len(self.data)
+
+    def __getitem__(self, key):
+        if not isinstance(key, tuple):
+            key = (key,)
+        if len(key) == 1 and isinstance(key[0], slice):
+            return VolumeRegion(self.volume[key[0]], self.box, self.data[key[0]])
+        key = key + (slice(None),) * (4 - len(key))
+        inner = [key[0]]
+        for k, n, (a, b) in zip(key[1:], self.shape[1:], self.box):
+            if not isinstance(k, slice):
+                return self.volume[key]
+            start, stop, step = k.indices(n)
+            if step != 1 or start < a or max(start, stop) > b:
+                return self.volume[key]
+            inner.append(slice(start - a, max(start, stop) - a))
+        return self.data[tuple(inner)]
+
+
+def load_volume(filename, level=0):
+    """ Open a preprocessed volume (id_clean.npy, id_mask.npy), preferring the chunked copy next to `filename`.
+
+    level > 0 opens a coarser level of the pyramid, which only chunked volumes have.
+    """
+    vol_name = chunked_path(filename)
+    if os.path.exists(vol_name):
+        return ChunkedVolume(vol_name, level=level)
+    if level:
+        raise ValueError('pyramid level {} needs a chunked volume, {} not found'.format(level, vol_name))
+    return np.load(filename, mmap_mode='r')